@@ -1,16 +1,89 @@
-import json
-import os
+import atexit
+import functools
 import logging
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import openai
 from azure.identity import DefaultAzureCredential
 from flask import Flask, Response, request, jsonify, send_from_directory
-from dotenv import load_dotenv
 
-from backend.auth.auth_utils import get_authenticated_user_details
+from backend.answer_cache import AnswerCache, new_cached_response, replay_cached_response, replay_cached_response_delta
+from backend.auth.groups import GroupMembershipCache, get_groups_endpoint
+from backend.history.cached_store import CachedConversationStore
 from backend.history.cosmosdbservice import CosmosConversationClient
-
-load_dotenv()
+from backend.history.handlers import (
+    history_error,
+    conversation_not_found,
+    no_conversations_found,
+    get_user_id,
+    require_store,
+    require_conversation_id,
+    parse_generate_request,
+    new_conversation_title,
+    generates_title,
+    new_history_metadata,
+    parse_update_request,
+    update_response,
+    parse_page_request,
+    conversations_page_response,
+    conversations_response,
+    conversation_response,
+    parse_rename_request,
+    conversation_deleted_response,
+    conversations_deleted_response,
+    deletion_job_response,
+    messages_cleared_response,
+    client_has_current,
+    with_etag,
+    answer_messages_to_save,
+    title_setter,
+)
+from backend.history.localstore import create_local_store
+from backend.history.utils import RequestCharge, deletion_job_wait, new_conversation
+from backend.history.write_behind import WriteBehindQueue
+from backend.http_client import get_http_session, get_http_timeout
+from backend.sse import SSE_READ_CHUNK_SIZE, iter_sse_json
+from backend.settings import (
+    AZURE_SEARCH_PERMITTED_GROUPS_COLUMN,
+    AZURE_OPENAI_MODEL,
+    AZURE_OPENAI_KEY,
+    AZURE_OPENAI_MODEL_NAME,
+    SHOULD_STREAM,
+    ANSWER_CACHE_ENABLED,
+    AZURE_COSMOSDB_DATABASE,
+    AZURE_COSMOSDB_ACCOUNT,
+    AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
+    AZURE_COSMOSDB_ACCOUNT_KEY,
+    CONVERSATION_STORE,
+    HISTORY_WRITE_BEHIND,
+    HISTORY_CACHE_ENABLED,
+    HISTORY_WRITE_WAIT_TIMEOUT,
+)
+from backend.utils import (
+    should_use_data,
+    format_as_ndjson,
+    use_delta_stream,
+    format_delta_start,
+    format_delta_end,
+    format_history_metadata_event,
+    format_title_event,
+    with_title,
+    get_aoai_base_url,
+    get_with_data_endpoint,
+    get_without_data_endpoint,
+    AZURE_OPENAI_API_VERSION,
+    get_fallback_filter_string,
+    build_body_headers_with_data,
+    new_with_data_response,
+    update_with_data_response,
+    format_stream_without_data_chunk,
+    build_body_headers_without_data,
+    format_non_streaming_without_data,
+    format_upstream_error,
+    TITLE_WAIT_TIMEOUT,
+    prepare_title_messages,
+    parse_title,
+)
 
 app = Flask(__name__, static_folder="static")
 
@@ -28,50 +101,21 @@ def assets(path):
     return send_from_directory("static/assets", path)
 
 
-# ACS Integration Settings
-AZURE_SEARCH_SERVICE = os.environ.get("AZURE_SEARCH_SERVICE")
-AZURE_SEARCH_INDEX = os.environ.get("AZURE_SEARCH_INDEX")
-AZURE_SEARCH_KEY = os.environ.get("AZURE_SEARCH_KEY")
-AZURE_SEARCH_USE_SEMANTIC_SEARCH = os.environ.get("AZURE_SEARCH_USE_SEMANTIC_SEARCH", "false")
-AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG = os.environ.get("AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG", "default")
-AZURE_SEARCH_TOP_K = os.environ.get("AZURE_SEARCH_TOP_K", 5)
-AZURE_SEARCH_ENABLE_IN_DOMAIN = os.environ.get("AZURE_SEARCH_ENABLE_IN_DOMAIN", "true")
-AZURE_SEARCH_CONTENT_COLUMNS = os.environ.get("AZURE_SEARCH_CONTENT_COLUMNS")
-AZURE_SEARCH_FILENAME_COLUMN = os.environ.get("AZURE_SEARCH_FILENAME_COLUMN")
-AZURE_SEARCH_TITLE_COLUMN = os.environ.get("AZURE_SEARCH_TITLE_COLUMN")
-AZURE_SEARCH_URL_COLUMN = os.environ.get("AZURE_SEARCH_URL_COLUMN")
-AZURE_SEARCH_VECTOR_COLUMNS = os.environ.get("AZURE_SEARCH_VECTOR_COLUMNS")
-AZURE_SEARCH_QUERY_TYPE = os.environ.get("AZURE_SEARCH_QUERY_TYPE")
-AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_COLUMN")
-
-# AOAI Integration Settings
-AZURE_OPENAI_RESOURCE = os.environ.get("AZURE_OPENAI_RESOURCE")
-AZURE_OPENAI_MODEL = os.environ.get("AZURE_OPENAI_MODEL")
-AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT")
-AZURE_OPENAI_KEY = os.environ.get("AZURE_OPENAI_KEY")
-AZURE_OPENAI_TEMPERATURE = os.environ.get("AZURE_OPENAI_TEMPERATURE", 0)
-AZURE_OPENAI_TOP_P = os.environ.get("AZURE_OPENAI_TOP_P", 1.0)
-AZURE_OPENAI_MAX_TOKENS = os.environ.get("AZURE_OPENAI_MAX_TOKENS", 1000)
-AZURE_OPENAI_STOP_SEQUENCE = os.environ.get("AZURE_OPENAI_STOP_SEQUENCE")
-AZURE_OPENAI_SYSTEM_MESSAGE = os.environ.get("AZURE_OPENAI_SYSTEM_MESSAGE", "You are an AI assistant that helps people find information.")
-AZURE_OPENAI_PREVIEW_API_VERSION = os.environ.get("AZURE_OPENAI_PREVIEW_API_VERSION", "2023-06-01-preview")
-AZURE_OPENAI_STREAM = os.environ.get("AZURE_OPENAI_STREAM", "true")
-AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME", "gpt-35-turbo-16k") # Name of the model, e.g. 'gpt-35-turbo-16k' or 'gpt-4'
-AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ.get("AZURE_OPENAI_EMBEDDING_ENDPOINT")
-AZURE_OPENAI_EMBEDDING_KEY = os.environ.get("AZURE_OPENAI_EMBEDDING_KEY")
-
-
-SHOULD_STREAM = True if AZURE_OPENAI_STREAM.lower() == "true" else False
-
-# CosmosDB Integration Settings
-AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
-AZURE_COSMOSDB_ACCOUNT = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
-AZURE_COSMOSDB_CONVERSATIONS_CONTAINER = os.environ.get("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER")
-AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
-
-# Initialize a CosmosDB client with AAD auth and containers
-cosmos_conversation_client = None
-if AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER:
+# Group membership of the signed in users, keyed by user principal id
+group_membership_cache = GroupMembershipCache()
+
+# Conversation titles are generated in the background while the answer streams
+title_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="title")
+
+# Deleted conversations are purged in the background, see start_deletion_job
+purge_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="purge")
+
+# Opt-in cache of complete "on your data" answers, see backend/answer_cache.py
+answer_cache = AnswerCache() if ANSWER_CACHE_ENABLED else None
+
+# Initialize a CosmosDB client with AAD auth and containers, or the local stand-in selected by CONVERSATION_STORE
+cosmos_conversation_client = create_local_store()
+if not cosmos_conversation_client and AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER:
     try :
         cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
 
@@ -90,257 +134,289 @@ if AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERS
         logging.exception("Exception in CosmosDB initialization", e)
         cosmos_conversation_client = None
 
+# Opt-in read-through cache of the chat history, see backend/history/cached_store.py
+if HISTORY_CACHE_ENABLED and cosmos_conversation_client:
+    cosmos_conversation_client = CachedConversationStore(cosmos_conversation_client)
+
+# Opt-in background writes of the chat history, see backend/history/write_behind.py
+history_writer = None
+if HISTORY_WRITE_BEHIND and cosmos_conversation_client:
+    history_writer = WriteBehindQueue(cosmos_conversation_client)
+    atexit.register(history_writer.close)
+
 
 def is_chat_model():
     if 'gpt-4' in AZURE_OPENAI_MODEL_NAME.lower() or AZURE_OPENAI_MODEL_NAME.lower() in ['gpt-35-turbo-4k', 'gpt-35-turbo-16k']:
         return True
     return False
 
-def should_use_data():
-    if AZURE_SEARCH_SERVICE and AZURE_SEARCH_INDEX and AZURE_SEARCH_KEY:
-        return True
-    return False
-
-
-def format_as_ndjson(obj: dict) -> str:
-    return json.dumps(obj, ensure_ascii=False) + "\n"
-
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
-    
+def fetchUserGroups(userToken):
+    # Follow the nextLink pages of the group membership, None if the lookup failed
+    endpoint = get_groups_endpoint()
     headers = {
         'Authorization': "bearer " + userToken
     }
+    groups = []
     try :
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            return []
-        
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r['value'].extend(nextLinkData)
-        
-        return r['value']
+        while endpoint:
+            r = get_http_session().get(endpoint, headers=headers, timeout=get_http_timeout())
+            if r.status_code != 200:
+                return None
+
+            r = r.json()
+            groups.extend(r['value'])
+            endpoint = r.get("@odata.nextLink")
+        return groups
     except Exception as e:
-        return []
+        return None
 
 
-def generateFilterString(userToken):
-    # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
-
-    # Construct filter string
-    if userGroups:
-        group_ids = ", ".join([obj['id'] for obj in userGroups])
-        return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
-    
-    return None
+def generateFilterString(userToken, user_id):
+    # Filter string built from the list of groups user is a member of, both cached per user
+    return group_membership_cache.get_filter_string(user_id, lambda: fetchUserGroups(userToken))
 
 
 def prepare_body_headers_with_data(request):
     request_messages = request.json["messages"]
 
-    # Set query type
-    query_type = "simple"
-    if AZURE_SEARCH_QUERY_TYPE:
-        query_type = AZURE_SEARCH_QUERY_TYPE
-    elif AZURE_SEARCH_USE_SEMANTIC_SEARCH.lower() == "true" and AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG:
-        query_type = "semantic"
-
     # Set filter
     filter = None
     userToken = None
     if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
         userToken = request.headers.get('X-MS-TOKEN-AAD-ACCESS-TOKEN', "")
-        filter = generateFilterString(userToken)
-        ### Für Testzwecke
+        user_id = get_user_id(request.headers)
+        filter = generateFilterString(userToken, user_id)
         if not filter:
-            filter = f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, 'ms-audit'))"
-            print("Filter -> ") 
-            print(filter)
-        ###
-
-    body = {
-        "messages": request_messages,
-        "temperature": float(AZURE_OPENAI_TEMPERATURE),
-        "max_tokens": int(AZURE_OPENAI_MAX_TOKENS),
-        "top_p": float(AZURE_OPENAI_TOP_P),
-        "stop": AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
-        "stream": SHOULD_STREAM,
-        "dataSources": [
-            {
-                "type": "AzureCognitiveSearch",
-                "parameters": {
-                    "endpoint": f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-                    "key": AZURE_SEARCH_KEY,
-                    "indexName": AZURE_SEARCH_INDEX,
-                    "apiVersion": "2020-07-01-Preview",
-                    "fieldsMapping": {
-                        "contentFields": AZURE_SEARCH_CONTENT_COLUMNS.split("|") if AZURE_SEARCH_CONTENT_COLUMNS else [],
-                        "titleField": AZURE_SEARCH_TITLE_COLUMN if AZURE_SEARCH_TITLE_COLUMN else None,
-                        "urlField": AZURE_SEARCH_URL_COLUMN if AZURE_SEARCH_URL_COLUMN else None,
-                        "filepathField": AZURE_SEARCH_FILENAME_COLUMN if AZURE_SEARCH_FILENAME_COLUMN else None,
-                        "vectorFields": AZURE_SEARCH_VECTOR_COLUMNS.split("|") if AZURE_SEARCH_VECTOR_COLUMNS else []
-                    },
-                    "inScope": True if AZURE_SEARCH_ENABLE_IN_DOMAIN.lower() == "true" else False,
-                    "topNDocuments": AZURE_SEARCH_TOP_K,
-                    "queryType": query_type,
-                    "semanticConfiguration": AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG if AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG else "",
-                    "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE,
-                    "embeddingEndpoint": AZURE_OPENAI_EMBEDDING_ENDPOINT,
-                    "embeddingKey": AZURE_OPENAI_EMBEDDING_KEY,
-                    "filter": filter
-                }
-            }
-        ]
-    }
-
-    headers = {
-        'Content-Type': 'application/json',
-        'api-key': AZURE_OPENAI_KEY,
-        "x-ms-useragent": "GitHubSampleWebApp/PublicAPI/2.0.0"
-    }
+            filter = get_fallback_filter_string()
 
-    return body, headers
+    return build_body_headers_with_data(request_messages, filter)
 
 
-def stream_with_data(body, headers, endpoint, history_metadata={}):
-    s = requests.Session()
-    response = {
-        "id": "",
-        "model": "",
-        "created": 0,
-        "object": "",
-        "choices": [{
-            "messages": []
-        }],
-        'history_metadata': history_metadata
-    }
+def stream_with_data(body, headers, endpoint, history_metadata={}, answer_cache_key=None, save_answer=None):
+    s = get_http_session()
+    response = new_with_data_response(history_metadata)
     try:
-        with s.post(endpoint, json=body, headers=headers, stream=True) as r:
-            for line in r.iter_lines(chunk_size=10):
-                if line:
-                    lineJson = json.loads(line.lstrip(b'data:').decode('utf-8'))
-                    if 'error' in lineJson:
-                        yield format_as_ndjson(lineJson)
-                    response["id"] = lineJson["id"]
-                    response["model"] = lineJson["model"]
-                    response["created"] = lineJson["created"]
-                    response["object"] = lineJson["object"]
-
-                    role = lineJson["choices"][0]["messages"][0]["delta"].get("role")
-                    if role == "tool":
-                        response["choices"][0]["messages"].append(lineJson["choices"][0]["messages"][0]["delta"])
-                    elif role == "assistant": 
-                        response["choices"][0]["messages"].append({
-                            "role": "assistant",
-                            "content": ""
-                        })
-                    else:
-                        deltaText = lineJson["choices"][0]["messages"][0]["delta"]["content"]
-                        if deltaText != "[DONE]":
-                            response["choices"][0]["messages"][1]["content"] += deltaText
-
-                    yield format_as_ndjson(response)
+        with s.post(endpoint, json=body, headers=headers, stream=True, timeout=get_http_timeout()) as r:
+            if r.status_code != 200:
+                yield format_as_ndjson(format_upstream_error(r.status_code, r.text))
+                return
+            for lineJson in iter_sse_json(r.iter_content(chunk_size=SSE_READ_CHUNK_SIZE)):
+                if 'error' in lineJson:
+                    yield format_as_ndjson(lineJson)
+                    return
+                update_with_data_response(response, lineJson)
+                yield format_as_ndjson(response)
+        if answer_cache_key:
+            answer_cache.set(answer_cache_key, response)
+        if save_answer:
+            history_metadata['saved'] = save_answer(response["choices"][0]["messages"])
+            yield format_as_ndjson(response)
     except Exception as e:
         yield format_as_ndjson({"error": str(e)})
 
 
-def conversation_with_data(request_body):
+def stream_with_data_delta(body, headers, endpoint, history_metadata={}, answer_cache_key=None, save_answer=None):
+    s = get_http_session()
+    response_id = None
+    delta_count = 0
+    content_length = 0
+    first_chunk = None
+    tool_message = None
+    content_parts = []
+    try:
+        with s.post(endpoint, json=body, headers=headers, stream=True, timeout=get_http_timeout()) as r:
+            if r.status_code != 200:
+                yield format_as_ndjson({"type": "error", "error": format_upstream_error(r.status_code, r.text)["error"]})
+                return
+            for lineJson in iter_sse_json(r.iter_content(chunk_size=SSE_READ_CHUNK_SIZE)):
+                if 'error' in lineJson:
+                    yield format_as_ndjson({"type": "error", "error": lineJson["error"]})
+                    return
+                if response_id is None:
+                    response_id = lineJson["id"]
+                    first_chunk = lineJson
+                    yield format_delta_start(lineJson, history_metadata)
+
+                delta = lineJson["choices"][0]["messages"][0]["delta"]
+                role = delta.get("role")
+                if role == "tool":
+                    tool_message = delta
+                    yield format_as_ndjson({"type": "tool", "message": delta})
+                elif role != "assistant":
+                    deltaText = delta.get("content")
+                    if deltaText and deltaText != "[DONE]":
+                        delta_count += 1
+                        content_length += len(deltaText)
+                        if answer_cache_key or save_answer:
+                            content_parts.append(deltaText)
+                        yield format_as_ndjson({"type": "delta", "content": deltaText})
+        if answer_cache_key and first_chunk:
+            answer_cache.set(answer_cache_key, new_cached_response(first_chunk, tool_message, "".join(content_parts)))
+        saved = None
+        if save_answer:
+            saved = save_answer(([tool_message] if tool_message else []) + [{"role": "assistant", "content": "".join(content_parts)}])
+        yield format_delta_end(response_id, delta_count, content_length, saved)
+    except Exception as e:
+        yield format_as_ndjson({"type": "error", "error": str(e)})
+
+
+def conversation_with_data(request_body, title_job=None, save_answer=None):
     body, headers = prepare_body_headers_with_data(request)
-    base_url = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-    endpoint = f"{base_url}openai/deployments/{AZURE_OPENAI_MODEL}/extensions/chat/completions?api-version={AZURE_OPENAI_PREVIEW_API_VERSION}"
+    endpoint = get_with_data_endpoint()
     history_metadata = request_body.get("history_metadata", {})
 
+    answer_cache_key = answer_cache.make_key(endpoint, body) if answer_cache else None
+    cached = answer_cache.get(answer_cache_key) if answer_cache_key else None
+    if cached:
+        if save_answer:
+            history_metadata['saved'] = save_answer(cached["choices"][0]["messages"])
+        if not SHOULD_STREAM:
+            wait_for_title(title_job)
+            return Response(format_as_ndjson(dict(cached, history_metadata=history_metadata)), status=200)
+        elif use_delta_stream(request_body):
+            return stream_response(replay_cached_response_delta(cached, history_metadata), request_body, title_job)
+        else:
+            return stream_response(replay_cached_response(cached, history_metadata), request_body, title_job)
+
     if not SHOULD_STREAM:
-        r = requests.post(endpoint, headers=headers, json=body)
+        r = get_http_session().post(endpoint, headers=headers, json=body, timeout=get_http_timeout())
         status_code = r.status_code
         r = r.json()
+        if answer_cache_key and status_code == 200:
+            answer_cache.set(answer_cache_key, r)
+        if save_answer and status_code == 200:
+            history_metadata['saved'] = save_answer(r["choices"][0]["messages"])
         r['history_metadata'] = history_metadata
 
+        wait_for_title(title_job)
         return Response(format_as_ndjson(r), status=status_code)
+    elif use_delta_stream(request_body):
+        return stream_response(stream_with_data_delta(body, headers, endpoint, history_metadata, answer_cache_key, save_answer), request_body, title_job)
     else:
-        return Response(stream_with_data(body, headers, endpoint, history_metadata), mimetype='text/event-stream')
+        return stream_response(stream_with_data(body, headers, endpoint, history_metadata, answer_cache_key, save_answer), request_body, title_job)
 
 
-def stream_without_data(response, history_metadata={}):
+def stream_without_data(response, history_metadata={}, save_answer=None):
     responseText = ""
+    response_obj = None
     for line in response:
+        if 'error' in line:
+            yield format_as_ndjson(line)
+            return
         deltaText = line["choices"][0]["delta"].get('content')
         if deltaText and deltaText != "[DONE]":
             responseText += deltaText
 
-        response_obj = {
-            "id": line["id"],
-            "model": line["model"],
-            "created": line["created"],
-            "object": line["object"],
-            "choices": [{
-                "messages": [{
-                    "role": "assistant",
-                    "content": responseText
-                }]
-            }],
-            "history_metadata": history_metadata
-        }
+        response_obj = format_stream_without_data_chunk(line, responseText, history_metadata)
         yield format_as_ndjson(response_obj)
+    if save_answer and response_obj:
+        history_metadata['saved'] = save_answer(response_obj["choices"][0]["messages"])
+        yield format_as_ndjson(response_obj)
+
 
+def stream_without_data_delta(response, history_metadata={}, save_answer=None):
+    response_id = None
+    delta_count = 0
+    content_length = 0
+    content_parts = []
+    try:
+        for line in response:
+            if 'error' in line:
+                yield format_as_ndjson({"type": "error", "error": line["error"]})
+                return
+            if response_id is None:
+                response_id = line["id"]
+                yield format_delta_start(line, history_metadata)
+
+            deltaText = line["choices"][0]["delta"].get('content')
+            if deltaText and deltaText != "[DONE]":
+                delta_count += 1
+                content_length += len(deltaText)
+                if save_answer:
+                    content_parts.append(deltaText)
+                yield format_as_ndjson({"type": "delta", "content": deltaText})
+        saved = save_answer([{"role": "assistant", "content": "".join(content_parts)}]) if save_answer else None
+        yield format_delta_end(response_id, delta_count, content_length, saved)
+    except Exception as e:
+        yield format_as_ndjson({"type": "error", "error": str(e)})
 
-def conversation_without_data(request_body):
+
+def configure_openai():
     openai.api_type = "azure"
-    openai.api_base = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-    openai.api_version = "2023-03-15-preview"
+    openai.api_base = get_aoai_base_url()
+    openai.api_version = AZURE_OPENAI_API_VERSION
     openai.api_key = AZURE_OPENAI_KEY
+    openai.requestssession = get_http_session()
+
+
+def iter_response_json(r):
+    with r:
+        yield from iter_sse_json(r.iter_content(chunk_size=SSE_READ_CHUNK_SIZE))
+
 
-    request_messages = request_body["messages"]
-    messages = [
-        {
-            "role": "system",
-            "content": AZURE_OPENAI_SYSTEM_MESSAGE
-        }
-    ]
-
-    for message in request_messages:
-        messages.append({
-            "role": message["role"] ,
-            "content": message["content"]
-        })
-
-    response = openai.ChatCompletion.create(
-        engine=AZURE_OPENAI_MODEL,
-        messages = messages,
-        temperature=float(AZURE_OPENAI_TEMPERATURE),
-        max_tokens=int(AZURE_OPENAI_MAX_TOKENS),
-        top_p=float(AZURE_OPENAI_TOP_P),
-        stop=AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
-        stream=SHOULD_STREAM
-    )
+def conversation_without_data(request_body, title_job=None, save_answer=None):
+    body, headers = build_body_headers_without_data(request_body["messages"])
+    endpoint = get_without_data_endpoint()
+    r = get_http_session().post(endpoint, json=body, headers=headers, stream=SHOULD_STREAM, timeout=get_http_timeout())
+    if r.status_code != 200:
+        error = format_upstream_error(r.status_code, r.text)
+        r.close()
+        raise Exception(error["error"])
 
     history_metadata = request_body.get("history_metadata", {})
 
     if not SHOULD_STREAM:
-        response_obj = {
-            "id": response,
-            "model": response.model,
-            "created": response.created,
-            "object": response.object,
-            "choices": [{
-                "messages": [{
-                    "role": "assistant",
-                    "content": response.choices[0].message.content
-                }]
-            }],
-            "history_metadata": history_metadata
-        }
+        response_obj = format_non_streaming_without_data(r.json(), history_metadata)
+        if save_answer:
+            history_metadata['saved'] = save_answer(response_obj["choices"][0]["messages"])
 
+        wait_for_title(title_job)
         return jsonify(response_obj), 200
+    elif use_delta_stream(request_body):
+        return stream_response(stream_without_data_delta(iter_response_json(r), history_metadata, save_answer), request_body, title_job)
     else:
-        return Response(stream_without_data(response, history_metadata), mimetype='text/event-stream')
+        return stream_response(stream_without_data(iter_response_json(r), history_metadata, save_answer), request_body, title_job)
+
+
+def stream_with_title(stream, title_job, history_metadata, delta=False):
+    # The answer doesn't wait for the conversation title, it follows once it's generated
+    if delta:
+        yield format_history_metadata_event(history_metadata)
+    title_sent = False
+    last_line = None
+    for line in stream:
+        if delta and not title_sent and title_job.done():
+            title_sent = True
+            yield format_title_event(history_metadata)
+        yield line
+        last_line = line
+
+    if title_sent or not wait_for_title(title_job):
+        return
+    if delta:
+        yield format_title_event(history_metadata)
+    elif last_line:
+        # clients of the accumulated format read the title from the last line
+        line = with_title(last_line, history_metadata['title'])
+        if line:
+            yield line
+
+
+def wait_for_title(title_job):
+    if not title_job:
+        return False
+    try:
+        title_job.result(timeout=TITLE_WAIT_TIMEOUT)
+        return True
+    except Exception as e:
+        logging.warning("Conversation title not ready in time")
+        return False
+
+
+def stream_response(stream, request_body, title_job=None):
+    if title_job:
+        stream = stream_with_title(stream, title_job, request_body.get("history_metadata", {}), use_delta_stream(request_body))
+    return Response(stream, mimetype='text/event-stream')
 
 
 @app.route("/conversation", methods=["GET", "POST"])
@@ -348,245 +424,218 @@ def conversation():
     request_body = request.json
     return conversation_internal(request_body)
 
-def conversation_internal(request_body):
+def conversation_internal(request_body, title_job=None, save_answer=None):
     try:
         use_data = should_use_data()
         if use_data:
-            return conversation_with_data(request_body)
+            return conversation_with_data(request_body, title_job, save_answer)
         else:
-            return conversation_without_data(request_body)
+            return conversation_without_data(request_body, title_job, save_answer)
     except Exception as e:
         logging.exception("Exception in /conversation")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    stats = {"groups": group_membership_cache.stats()}
+    if answer_cache:
+        stats["answers"] = answer_cache.stats()
+    if HISTORY_CACHE_ENABLED and cosmos_conversation_client:
+        stats["history"] = cosmos_conversation_client.cache.stats()
+    return jsonify(stats), 200
+
 ## Conversation History API ## 
 @app.route("/history/generate", methods=["POST"])
 def add_conversation():
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
-
-    ## check request for conversation_id
-    conversation_id = request.json.get("conversation_id", None)
+    user_id = get_user_id(request.headers)
 
     try:
-        # make sure cosmos is configured
-        if not cosmos_conversation_client:
-            raise Exception("CosmosDB is not configured")
+        require_store(cosmos_conversation_client)
+        conversation_id, user_message = parse_generate_request(request.json)
+        messages = request.json["messages"]
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
-        history_metadata = {}
+        conversation_dict = None
         if not conversation_id:
-            title = generate_title(request.json["messages"])
-            conversation_dict = cosmos_conversation_client.create_conversation(user_id=user_id, title=title)
+            title = new_conversation_title(messages)
+            if history_writer:
+                # written in the background, together with the first message
+                conversation_dict = new_conversation(user_id, title)
+            else:
+                conversation_dict = cosmos_conversation_client.create_conversation(user_id=user_id, title=title)
             conversation_id = conversation_dict['id']
-            history_metadata['title'] = title
-            history_metadata['date'] = conversation_dict['createdAt']
-            
-        ## Format the incoming message object in the "chat/completions" messages format
-        ## then write it to the conversation history in cosmos
-        messages = request.json["messages"]
-        if len(messages) > 0 and messages[-1]['role'] == "user":
+
+        ## write the incoming message to the conversation history in cosmos
+        if history_writer:
+            history_writer.create_messages(conversation_id, user_id, [user_message], conversation=conversation_dict)
+        else:
             cosmos_conversation_client.create_message(
                 conversation_id=conversation_id,
                 user_id=user_id,
-                input_message=messages[-1]
+                input_message=user_message
             )
-        else:
-            raise Exception("No user message found")
-        
+
         # Submit request to Chat Completions for response
         request_body = request.json
-        history_metadata['conversation_id'] = conversation_id
+        history_metadata = new_history_metadata(conversation_id, conversation_dict)
         request_body['history_metadata'] = history_metadata
-        return conversation_internal(request_body)
+        title_job = None
+        if generates_title(conversation_dict):
+            title_job = title_executor.submit(generate_and_save_title, user_id, conversation_id, messages, history_metadata)
+        save = functools.partial(save_answer, user_id, conversation_id) if request_body.get("save_answer") else None
+        return conversation_internal(request_body, title_job, save)
        
     except Exception as e:
-        logging.exception("Exception in /history/generate")
-        return jsonify({"error": str(e)}), 500
+        return history_error(e, "/history/generate")
 
 
 @app.route("/history/update", methods=["POST"])
 def update_conversation():
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
-
-    ## check request for conversation_id
-    conversation_id = request.json.get("conversation_id", None)
+    user_id = get_user_id(request.headers)
 
     try:
-        # make sure cosmos is configured
-        if not cosmos_conversation_client:
-            raise Exception("CosmosDB is not configured")
-
-        # check for the conversation_id, if the conversation is not set, we will create a new one
-        if not conversation_id:
-            raise Exception("No conversation_id found")
-            
-        ## Format the incoming message object in the "chat/completions" messages format
-        ## then write it to the conversation history in cosmos
-        messages = request.json["messages"]
-        if len(messages) > 0 and messages[-1]['role'] == "assistant":
-            if len(messages) > 1 and messages[-2]['role'] == "tool":
-                # write the tool message first
-                cosmos_conversation_client.create_message(
-                    conversation_id=conversation_id,
-                    user_id=user_id,
-                    input_message=messages[-2]
-                )
-            # write the assistant message
-            cosmos_conversation_client.create_message(
-                conversation_id=conversation_id,
-                user_id=user_id,
-                input_message=messages[-1]
-            )
-        else:
-            raise Exception("No bot messages found")
-        
-        # Submit request to Chat Completions for response
-        response = {'success': True}
-        return jsonify(response), 200
+        require_store(cosmos_conversation_client)
+        conversation_id, new_messages = parse_update_request(request.json)
+
+        ## write the answer to the conversation history in cosmos, in one batch
+        if history_writer:
+            history_writer.create_messages(conversation_id, user_id, new_messages)
+            return update_response(), 200
+        request_charge = RequestCharge()
+        cosmos_conversation_client.create_messages(
+            conversation_id=conversation_id,
+            user_id=user_id,
+            input_messages=new_messages,
+            request_charge=request_charge
+        )
+        return update_response(request_charge), 200
        
     except Exception as e:
-        logging.exception("Exception in /history/update")
-        return jsonify({"error": str(e)}), 500
+        return history_error(e, "/history/update")
 
 @app.route("/history/delete", methods=["DELETE"])
 def delete_conversation():
-    ## get the user id from the request headers
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
-    
-    ## check request for conversation_id
-    conversation_id = request.json.get("conversation_id", None)
-    try: 
-        if not conversation_id:
-            return jsonify({"error": "conversation_id is required"}), 400
-        
-        ## delete the conversation messages from cosmos first
-        deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id)
+    user_id = get_user_id(request.headers)
 
-        ## Now delete the conversation 
-        deleted_conversation = cosmos_conversation_client.delete_conversation(user_id, conversation_id)
+    try: 
+        conversation_id = require_conversation_id(request.json)
 
-        return jsonify({"message": "Successfully deleted conversation and messages", "conversation_id": conversation_id}), 200
+        ## hide the conversation right away, a background job purges it with its messages
+        wait_for_history_writes(user_id, conversation_id)
+        conversation_ids = cosmos_conversation_client.mark_conversations_deleted(user_id, [conversation_id])
+        job = start_deletion_job(user_id, conversation_ids)
+        return conversation_deleted_response(conversation_id, job), 202
     except Exception as e:
-        logging.exception("Exception in /history/delete")
-        return jsonify({"error": str(e)}), 500
+        return history_error(e, "/history/delete")
 
 @app.route("/history/list", methods=["GET"])
 def list_conversations():
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
+    user_id = get_user_id(request.headers)
 
-    ## get the conversations from cosmos
-    conversations = cosmos_conversation_client.get_conversations(user_id)
-    if not isinstance(conversations, list):
-        return jsonify({"error": f"No conversations for {user_id} were found"}), 404
+    try:
+        wait_for_history_writes(user_id)
+        etag = cosmos_conversation_client.conversations_etag(user_id)
+        if client_has_current(request, etag):
+            return with_etag(Response(status=304), etag)
 
-    ## return the conversation ids
+        ## page through the conversations when the client asks for it
+        page = parse_page_request(request.args)
+        if page:
+            conversations, continuation_token = cosmos_conversation_client.get_conversations_page(user_id, *page)
+            return with_etag(jsonify(conversations_page_response(conversations, continuation_token)), etag), 200
 
-    return jsonify(conversations), 200
+        conversations = cosmos_conversation_client.get_conversations(user_id)
+        return with_etag(jsonify(conversations_response(user_id, conversations)), etag), 200
+    except Exception as e:
+        return history_error(e, "/history/list")
 
 @app.route("/history/read", methods=["POST"])
 def get_conversation():
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
-
-    ## check request for conversation_id
-    conversation_id = request.json.get("conversation_id", None)
-    
-    if not conversation_id:
-        return jsonify({"error": "conversation_id is required"}), 400
-
-    ## get the conversation object and the related messages from cosmos
-    conversation = cosmos_conversation_client.get_conversation(user_id, conversation_id)
-    ## return the conversation id and the messages in the bot frontend format
-    if not conversation:
-        return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
-    
-    # get the messages for the conversation from cosmos
-    conversation_messages = cosmos_conversation_client.get_messages(user_id, conversation_id)
+    user_id = get_user_id(request.headers)
 
-    ## format the messages in the bot frontend format
-    messages = [{'id': msg['id'], 'role': msg['role'], 'content': msg['content'], 'createdAt': msg['createdAt']} for msg in conversation_messages]
-
-    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
+    try:
+        conversation_id = require_conversation_id(request.json)
+
+        ## get the conversation object and the related messages from cosmos
+        wait_for_history_writes(user_id, conversation_id)
+        etag = cosmos_conversation_client.conversation_etag(user_id, conversation_id)
+        if client_has_current(request, etag):
+            return with_etag(Response(status=304), etag)
+        if not cosmos_conversation_client.get_conversation(user_id, conversation_id):
+            raise conversation_not_found(conversation_id)
+        conversation_messages = cosmos_conversation_client.get_messages(user_id, conversation_id)
+        return with_etag(jsonify(conversation_response(conversation_id, conversation_messages)), etag), 200
+    except Exception as e:
+        return history_error(e, "/history/read")
 
 @app.route("/history/rename", methods=["POST"])
 def rename_conversation():
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
-
-    ## check request for conversation_id
-    conversation_id = request.json.get("conversation_id", None)
-    
-    if not conversation_id:
-        return jsonify({"error": "conversation_id is required"}), 400
-    
-    ## get the conversation from cosmos
-    conversation = cosmos_conversation_client.get_conversation(user_id, conversation_id)
-    if not conversation:
-        return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
+    user_id = get_user_id(request.headers)
 
-    ## update the title
-    title = request.json.get("title", None)
-    if not title:
-        return jsonify({"error": "title is required"}), 400
-    conversation['title'] = title
-    updated_conversation = cosmos_conversation_client.upsert_conversation(conversation)
-
-    return jsonify(updated_conversation), 200
+    try:
+        conversation_id, title = parse_rename_request(request.json)
+
+        ## update the title, retried if the conversation changes concurrently
+        wait_for_history_writes(user_id, conversation_id)
+        updated_conversation = cosmos_conversation_client.rename_conversation(user_id, conversation_id, title)
+        if not updated_conversation:
+            raise conversation_not_found(conversation_id)
+        return updated_conversation, 200
+    except Exception as e:
+        return history_error(e, "/history/rename")
 
 @app.route("/history/delete_all", methods=["DELETE"])
 def delete_all_conversations():
-    ## get the user id from the request headers
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
+    user_id = get_user_id(request.headers)
 
-    # get conversations for user
+    # hide all conversations of the user right away, a background job purges them with their messages
     try:
-        conversations = cosmos_conversation_client.get_conversations(user_id)
-        if not conversations:
-            return jsonify({"error": f"No conversations for {user_id} were found"}), 404
-        
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = cosmos_conversation_client.delete_messages(conversation['id'], user_id)
-
-            ## Now delete the conversation 
-            deleted_conversation = cosmos_conversation_client.delete_conversation(user_id, conversation['id'])
-
-        return jsonify({"message": f"Successfully deleted conversation and messages for user {user_id}"}), 200
-    
+        wait_for_history_writes(user_id)
+        conversation_ids = cosmos_conversation_client.mark_conversations_deleted(user_id)
+        if not conversation_ids:
+            raise no_conversations_found(user_id)
+
+        job = start_deletion_job(user_id, conversation_ids)
+        return conversations_deleted_response(user_id, job), 202
     except Exception as e:
-        logging.exception("Exception in /history/delete_all")
-        return jsonify({"error": str(e)}), 500
+        return history_error(e, "/history/delete_all")
     
 
+@app.route("/history/delete_status/<job_id>", methods=["GET"])
+def get_deletion_job_status(job_id):
+    user_id = get_user_id(request.headers)
+
+    try:
+        job = cosmos_conversation_client.get_deletion_job(user_id, job_id)
+        return deletion_job_response(job_id, job), 200
+    except Exception as e:
+        return history_error(e, "/history/delete_status")
+
+
 @app.route("/history/clear", methods=["POST"])
 def clear_messages():
-    ## get the user id from the request headers
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
-    
-    ## check request for conversation_id
-    conversation_id = request.json.get("conversation_id", None)
+    user_id = get_user_id(request.headers)
+
     try: 
-        if not conversation_id:
-            return jsonify({"error": "conversation_id is required"}), 400
-        
-        ## delete the conversation messages from cosmos
-        deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id)
+        conversation_id = require_conversation_id(request.json)
 
-        return jsonify({"message": "Successfully deleted messages in conversation", "conversation_id": conversation_id}), 200
+        ## delete the conversation messages from cosmos
+        wait_for_history_writes(user_id, conversation_id)
+        request_charge = RequestCharge()
+        deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id, request_charge)
+        return messages_cleared_response(conversation_id, deleted_messages, request_charge), 200
     except Exception as e:
-        logging.exception("Exception in /history/clear_messages")
-        return jsonify({"error": str(e)}), 500
+        return history_error(e, "/history/clear_messages")
+
+@app.route("/history/write_queue/stats", methods=["GET"])
+def history_write_queue_stats():
+    if not history_writer:
+        return jsonify({"error": "Background history writes are not enabled"}), 404
+    return jsonify(history_writer.stats()), 200
 
 @app.route("/history/ensure", methods=["GET"])
 def ensure_cosmos():
-    if not AZURE_COSMOSDB_ACCOUNT:
+    if not AZURE_COSMOSDB_ACCOUNT and CONVERSATION_STORE == "cosmos":
         return jsonify({"error": "CosmosDB is not configured"}), 404
     
     if not cosmos_conversation_client or not cosmos_conversation_client.ensure():
@@ -595,28 +644,100 @@ def ensure_cosmos():
     return jsonify({"message": "CosmosDB is configured and working"}), 200
 
 
-def generate_title(conversation_messages):
-    ## make sure the messages are sorted by _ts descending
-    title_prompt = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
+def wait_for_history_writes(user_id, conversation_id=None):
+    # Reads and changes of the history see the messages the user's earlier requests queued
+    if history_writer and not history_writer.wait(user_id, conversation_id, HISTORY_WRITE_WAIT_TIMEOUT):
+        logging.warning("Timed out waiting for queued chat history writes of conversation %s", conversation_id)
+
+
+# Deletion jobs left unfinished by stopped processes are resumed once per worker, on its first request
+deletion_jobs_resumed = False
+deletion_jobs_resume_lock = threading.Lock()
+
+@app.before_request
+def start_resuming_deletion_jobs():
+    global deletion_jobs_resumed
+    if deletion_jobs_resumed or not cosmos_conversation_client:
+        return
+    with deletion_jobs_resume_lock:
+        if not deletion_jobs_resumed:
+            deletion_jobs_resumed = True
+            purge_executor.submit(resume_deletion_jobs)
+
+
+def resume_deletion_jobs():
+    try:
+        jobs = cosmos_conversation_client.get_unfinished_deletion_jobs()
+    except Exception as e:
+        logging.exception("Exception while reading unfinished deletion jobs")
+        return
+    for job in jobs:
+        # running jobs are taken over once their worker stopped updating them
+        timer = threading.Timer(deletion_job_wait(job), purge_executor.submit, (run_deletion_job, job['userId'], job['id']))
+        timer.daemon = True
+        timer.start()
+
+
+def start_deletion_job(user_id, conversation_ids):
+    # The job document lets any worker report the progress, see /history/delete_status
+    job = cosmos_conversation_client.create_deletion_job(user_id, conversation_ids)
+    purge_executor.submit(run_deletion_job, user_id, job['id'])
+    return job
+
+
+def run_deletion_job(user_id, job_id):
+    try:
+        cosmos_conversation_client.run_deletion_job(user_id, job_id)
+    except Exception as e:
+        logging.exception("Exception in deletion job %s", job_id)
+
+
+def save_answer(user_id, conversation_id, answer_messages):
+    # Stores the answer /history/generate has streamed, see "save_answer" in backend/utils.py
+    new_messages = answer_messages_to_save(answer_messages)
+    if not new_messages:
+        return False
+    try:
+        if history_writer:
+            history_writer.create_messages(conversation_id, user_id, new_messages)
+        else:
+            cosmos_conversation_client.create_messages(conversation_id, user_id, new_messages)
+        return True
+    except Exception as e:
+        logging.exception("Exception while saving the answer")
+        return False
+
 
-    messages = [{'role': msg['role'], 'content': msg['content']} for msg in conversation_messages]
-    messages.append({'role': 'user', 'content': title_prompt})
+def generate_and_save_title(user_id, conversation_id, conversation_messages, history_metadata):
+    # Runs alongside the answer, see stream_with_title
+    placeholder = history_metadata['title']
+    title = generate_title(conversation_messages)
+    history_metadata['title'] = title
+    if title == placeholder:
+        return title
+
+    try:
+        wait_for_history_writes(user_id, conversation_id)
+        cosmos_conversation_client.update_conversation(user_id, conversation_id, title_setter(placeholder, title))
+    except Exception as e:
+        logging.exception("Exception while saving the conversation title")
+    return title
+
+
+def generate_title(conversation_messages):
+    messages = prepare_title_messages(conversation_messages)
 
     try:
         ## Submit prompt to Chat Completions for response
-        base_url = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-        openai.api_type = "azure"
-        openai.api_base = base_url
-        openai.api_version = "2023-03-15-preview"
-        openai.api_key = AZURE_OPENAI_KEY
+        configure_openai()
         completion = openai.ChatCompletion.create(    
             engine=AZURE_OPENAI_MODEL,
             messages=messages,
             temperature=1,
-            max_tokens=64 
+            max_tokens=64,
+            request_timeout=get_http_timeout()
         )
-        title = json.loads(completion['choices'][0]['message']['content'])['title']
-        return title
+        return parse_title(completion)
     except Exception as e:
         return messages[-2]['content']
 
@@ -0,0 +1,760 @@
+import asyncio
+import functools
+import logging
+import openai
+from azure.identity.aio import DefaultAzureCredential
+from quart import Quart, Response, request, jsonify, send_from_directory
+
+from backend.answer_cache import AnswerCache, new_cached_response, replay_cached_response, replay_cached_response_delta
+from backend.auth.groups import GroupMembershipCache, get_groups_endpoint
+from backend.history.cached_store import AsyncCachedConversationStore
+from backend.history.cosmosdbservice_async import CosmosConversationClient
+from backend.history.handlers import (
+    history_error,
+    conversation_not_found,
+    no_conversations_found,
+    get_user_id,
+    require_store,
+    require_conversation_id,
+    parse_generate_request,
+    new_conversation_title,
+    generates_title,
+    new_history_metadata,
+    parse_update_request,
+    update_response,
+    parse_page_request,
+    conversations_page_response,
+    conversations_response,
+    conversation_response,
+    parse_rename_request,
+    conversation_deleted_response,
+    conversations_deleted_response,
+    deletion_job_response,
+    messages_cleared_response,
+    client_has_current,
+    with_etag,
+    answer_messages_to_save,
+    title_setter,
+)
+from backend.history.localstore import create_local_store
+from backend.history.utils import RequestCharge, deletion_job_wait, new_conversation
+from backend.history.write_behind import AsyncWriteBehindQueue
+from backend.http_client import create_aiohttp_session
+from backend.sse import aiter_sse_json
+from backend.settings import (
+    AZURE_SEARCH_PERMITTED_GROUPS_COLUMN,
+    AZURE_OPENAI_MODEL,
+    AZURE_OPENAI_KEY,
+    SHOULD_STREAM,
+    ANSWER_CACHE_ENABLED,
+    AZURE_COSMOSDB_DATABASE,
+    AZURE_COSMOSDB_ACCOUNT,
+    AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
+    AZURE_COSMOSDB_ACCOUNT_KEY,
+    CONVERSATION_STORE,
+    HISTORY_WRITE_BEHIND,
+    HISTORY_CACHE_ENABLED,
+    HISTORY_WRITE_WAIT_TIMEOUT,
+)
+from backend.utils import (
+    should_use_data,
+    format_as_ndjson,
+    use_delta_stream,
+    format_delta_start,
+    format_delta_end,
+    format_history_metadata_event,
+    format_title_event,
+    with_title,
+    get_aoai_base_url,
+    get_with_data_endpoint,
+    get_without_data_endpoint,
+    AZURE_OPENAI_API_VERSION,
+    get_fallback_filter_string,
+    build_body_headers_with_data,
+    new_with_data_response,
+    update_with_data_response,
+    format_stream_without_data_chunk,
+    build_body_headers_without_data,
+    format_non_streaming_without_data,
+    format_upstream_error,
+    TITLE_WAIT_TIMEOUT,
+    prepare_title_messages,
+    parse_title,
+)
+
+# ASGI entry point, serves the same API as app.py without pinning a worker thread per
+# in-flight answer. Run it with an ASGI server, e.g. `hypercorn app_async:app`.
+app = Quart(__name__, static_folder="static")
+# Streamed answers regularly take longer than Quart's 60 second default
+app.config["RESPONSE_TIMEOUT"] = None
+
+# Static Files
+@app.route("/")
+async def index():
+    return await app.send_static_file("index.html")
+
+@app.route("/favicon.ico")
+async def favicon():
+    return await app.send_static_file('favicon.ico')
+
+@app.route("/assets/<path:path>")
+async def assets(path):
+    return await send_from_directory("static/assets", path)
+
+
+# Group membership of the signed in users, keyed by user principal id
+group_membership_cache = GroupMembershipCache()
+
+# Opt-in cache of complete "on your data" answers, see backend/answer_cache.py
+answer_cache = AnswerCache() if ANSWER_CACHE_ENABLED else None
+
+# Initialize a CosmosDB client with AAD auth and containers, or the local stand-in selected by CONVERSATION_STORE
+cosmos_conversation_client = create_local_store(asynchronous=True)
+if not cosmos_conversation_client and AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER:
+    try :
+        cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
+
+        if not AZURE_COSMOSDB_ACCOUNT_KEY:
+            credential = DefaultAzureCredential()
+        else:
+            credential = AZURE_COSMOSDB_ACCOUNT_KEY
+
+        cosmos_conversation_client = CosmosConversationClient(
+            cosmosdb_endpoint=cosmos_endpoint,
+            credential=credential,
+            database_name=AZURE_COSMOSDB_DATABASE,
+            container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
+        )
+    except Exception as e:
+        logging.exception("Exception in CosmosDB initialization", e)
+        cosmos_conversation_client = None
+
+# Opt-in read-through cache of the chat history, see backend/history/cached_store.py
+if HISTORY_CACHE_ENABLED and cosmos_conversation_client:
+    cosmos_conversation_client = AsyncCachedConversationStore(cosmos_conversation_client)
+
+# Opt-in background writes of the chat history, see backend/history/write_behind.py
+history_writer = None
+if HISTORY_WRITE_BEHIND and cosmos_conversation_client:
+    history_writer = AsyncWriteBehindQueue(cosmos_conversation_client)
+
+# Shared HTTP session for Azure OpenAI and Microsoft Graph calls, bound to the serving event loop
+http_session = None
+
+@app.before_serving
+async def open_http_session():
+    global http_session
+    http_session = create_aiohttp_session()
+
+@app.after_serving
+async def close_http_session():
+    if http_session:
+        await http_session.close()
+
+@app.before_serving
+async def start_cosmos_client():
+    # One CosmosDB client for the lifetime of the app, bound to the serving event loop
+    if cosmos_conversation_client:
+        try:
+            await cosmos_conversation_client.start()
+        except Exception as e:
+            # retried on first use, see CosmosConversationClient.get_container
+            logging.exception("Exception while starting the CosmosDB client")
+    if history_writer:
+        await history_writer.start()
+    if cosmos_conversation_client:
+        app.add_background_task(resume_deletion_jobs)
+
+@app.after_serving
+async def close_cosmos_client():
+    # store the queued history writes while the client is still open
+    if history_writer:
+        await history_writer.close()
+    if cosmos_conversation_client:
+        await cosmos_conversation_client.close()
+
+@app.before_request
+async def use_http_session_for_openai():
+    # openai keeps its session in a context variable, so it has to be set per request
+    openai.aiosession.set(http_session)
+
+
+def configure_openai():
+    openai.api_type = "azure"
+    openai.api_base = get_aoai_base_url()
+    openai.api_version = AZURE_OPENAI_API_VERSION
+    openai.api_key = AZURE_OPENAI_KEY
+
+
+async def fetch_user_groups(userToken):
+    # Follow the nextLink pages of the group membership, None if the lookup failed
+    endpoint = get_groups_endpoint()
+    headers = {
+        'Authorization': "bearer " + userToken
+    }
+    groups = []
+    try:
+        while endpoint:
+            async with http_session.get(endpoint, headers=headers) as r:
+                if r.status != 200:
+                    return None
+                payload = await r.json()
+            groups.extend(payload['value'])
+            endpoint = payload.get("@odata.nextLink")
+        return groups
+    except Exception as e:
+        return None
+
+
+async def generate_filter_string(userToken, user_id):
+    # Filter string built from the list of groups user is a member of, both cached per user
+    return await group_membership_cache.aget_filter_string(user_id, lambda: fetch_user_groups(userToken))
+
+
+async def prepare_body_headers_with_data(request_body, request_headers):
+    request_messages = request_body["messages"]
+
+    # Set filter
+    filter = None
+    userToken = None
+    if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
+        userToken = request_headers.get('X-MS-TOKEN-AAD-ACCESS-TOKEN', "")
+        user_id = get_user_id(request_headers)
+        filter = await generate_filter_string(userToken, user_id)
+        if not filter:
+            filter = get_fallback_filter_string()
+
+    return build_body_headers_with_data(request_messages, filter)
+
+
+async def stream_with_data(body, headers, endpoint, history_metadata={}, answer_cache_key=None, save_answer=None):
+    response = new_with_data_response(history_metadata)
+    try:
+        async with http_session.post(endpoint, json=body, headers=headers) as r:
+            if r.status != 200:
+                yield format_as_ndjson(format_upstream_error(r.status, await r.text()))
+                return
+            async for lineJson in aiter_sse_json(r.content.iter_any()):
+                if 'error' in lineJson:
+                    yield format_as_ndjson(lineJson)
+                    return
+                update_with_data_response(response, lineJson)
+                yield format_as_ndjson(response)
+        if answer_cache_key:
+            await answer_cache.aset(answer_cache_key, response)
+        if save_answer:
+            history_metadata['saved'] = await save_answer(response["choices"][0]["messages"])
+            yield format_as_ndjson(response)
+    except Exception as e:
+        yield format_as_ndjson({"error": str(e)})
+
+
+async def stream_with_data_delta(body, headers, endpoint, history_metadata={}, answer_cache_key=None, save_answer=None):
+    response_id = None
+    delta_count = 0
+    content_length = 0
+    first_chunk = None
+    tool_message = None
+    content_parts = []
+    try:
+        async with http_session.post(endpoint, json=body, headers=headers) as r:
+            if r.status != 200:
+                yield format_as_ndjson({"type": "error", "error": format_upstream_error(r.status, await r.text())["error"]})
+                return
+            async for lineJson in aiter_sse_json(r.content.iter_any()):
+                if 'error' in lineJson:
+                    yield format_as_ndjson({"type": "error", "error": lineJson["error"]})
+                    return
+                if response_id is None:
+                    response_id = lineJson["id"]
+                    first_chunk = lineJson
+                    yield format_delta_start(lineJson, history_metadata)
+
+                delta = lineJson["choices"][0]["messages"][0]["delta"]
+                role = delta.get("role")
+                if role == "tool":
+                    tool_message = delta
+                    yield format_as_ndjson({"type": "tool", "message": delta})
+                elif role != "assistant":
+                    deltaText = delta.get("content")
+                    if deltaText and deltaText != "[DONE]":
+                        delta_count += 1
+                        content_length += len(deltaText)
+                        if answer_cache_key or save_answer:
+                            content_parts.append(deltaText)
+                        yield format_as_ndjson({"type": "delta", "content": deltaText})
+        if answer_cache_key and first_chunk:
+            await answer_cache.aset(answer_cache_key, new_cached_response(first_chunk, tool_message, "".join(content_parts)))
+        saved = None
+        if save_answer:
+            saved = await save_answer(([tool_message] if tool_message else []) + [{"role": "assistant", "content": "".join(content_parts)}])
+        yield format_delta_end(response_id, delta_count, content_length, saved)
+    except Exception as e:
+        yield format_as_ndjson({"type": "error", "error": str(e)})
+
+
+async def conversation_with_data(request_body, request_headers, title_job=None, save_answer=None):
+    body, headers = await prepare_body_headers_with_data(request_body, request_headers)
+    endpoint = get_with_data_endpoint()
+    history_metadata = request_body.get("history_metadata", {})
+
+    answer_cache_key = answer_cache.make_key(endpoint, body) if answer_cache else None
+    cached = await answer_cache.aget(answer_cache_key) if answer_cache_key else None
+    if cached:
+        if save_answer:
+            history_metadata['saved'] = await save_answer(cached["choices"][0]["messages"])
+        if not SHOULD_STREAM:
+            await wait_for_title(title_job)
+            return Response(format_as_ndjson(dict(cached, history_metadata=history_metadata)), status=200)
+        elif use_delta_stream(request_body):
+            return stream_response(replay_cached_response_delta(cached, history_metadata), request_body, title_job)
+        else:
+            return stream_response(replay_cached_response(cached, history_metadata), request_body, title_job)
+
+    if not SHOULD_STREAM:
+        async with http_session.post(endpoint, headers=headers, json=body) as r:
+            status_code = r.status
+            r = await r.json(content_type=None)
+        if answer_cache_key and status_code == 200:
+            await answer_cache.aset(answer_cache_key, r)
+        if save_answer and status_code == 200:
+            history_metadata['saved'] = await save_answer(r["choices"][0]["messages"])
+        r['history_metadata'] = history_metadata
+
+        await wait_for_title(title_job)
+        return Response(format_as_ndjson(r), status=status_code)
+    elif use_delta_stream(request_body):
+        return stream_response(stream_with_data_delta(body, headers, endpoint, history_metadata, answer_cache_key, save_answer), request_body, title_job)
+    else:
+        return stream_response(stream_with_data(body, headers, endpoint, history_metadata, answer_cache_key, save_answer), request_body, title_job)
+
+
+async def stream_without_data(response, history_metadata={}, save_answer=None):
+    responseText = ""
+    response_obj = None
+    async for line in response:
+        if 'error' in line:
+            yield format_as_ndjson(line)
+            return
+        deltaText = line["choices"][0]["delta"].get('content')
+        if deltaText and deltaText != "[DONE]":
+            responseText += deltaText
+
+        response_obj = format_stream_without_data_chunk(line, responseText, history_metadata)
+        yield format_as_ndjson(response_obj)
+    if save_answer and response_obj:
+        history_metadata['saved'] = await save_answer(response_obj["choices"][0]["messages"])
+        yield format_as_ndjson(response_obj)
+
+
+async def stream_without_data_delta(response, history_metadata={}, save_answer=None):
+    response_id = None
+    delta_count = 0
+    content_length = 0
+    content_parts = []
+    try:
+        async for line in response:
+            if 'error' in line:
+                yield format_as_ndjson({"type": "error", "error": line["error"]})
+                return
+            if response_id is None:
+                response_id = line["id"]
+                yield format_delta_start(line, history_metadata)
+
+            deltaText = line["choices"][0]["delta"].get('content')
+            if deltaText and deltaText != "[DONE]":
+                delta_count += 1
+                content_length += len(deltaText)
+                if save_answer:
+                    content_parts.append(deltaText)
+                yield format_as_ndjson({"type": "delta", "content": deltaText})
+        saved = await save_answer([{"role": "assistant", "content": "".join(content_parts)}]) if save_answer else None
+        yield format_delta_end(response_id, delta_count, content_length, saved)
+    except Exception as e:
+        yield format_as_ndjson({"type": "error", "error": str(e)})
+
+
+async def iter_response_json(r):
+    async with r:
+        async for chunk in aiter_sse_json(r.content.iter_any()):
+            yield chunk
+
+
+async def conversation_without_data(request_body, title_job=None, save_answer=None):
+    body, headers = build_body_headers_without_data(request_body["messages"])
+    endpoint = get_without_data_endpoint()
+    r = await http_session.post(endpoint, json=body, headers=headers)
+    if r.status != 200:
+        error = format_upstream_error(r.status, await r.text())
+        r.release()
+        raise Exception(error["error"])
+
+    history_metadata = request_body.get("history_metadata", {})
+
+    if not SHOULD_STREAM:
+        async with r:
+            response_obj = format_non_streaming_without_data(await r.json(content_type=None), history_metadata)
+        if save_answer:
+            history_metadata['saved'] = await save_answer(response_obj["choices"][0]["messages"])
+
+        await wait_for_title(title_job)
+        return jsonify(response_obj), 200
+    elif use_delta_stream(request_body):
+        return stream_response(stream_without_data_delta(iter_response_json(r), history_metadata, save_answer), request_body, title_job)
+    else:
+        return stream_response(stream_without_data(iter_response_json(r), history_metadata, save_answer), request_body, title_job)
+
+
+async def stream_with_title(stream, title_job, history_metadata, delta=False):
+    # The answer doesn't wait for the conversation title, it follows once it's generated
+    if delta:
+        yield format_history_metadata_event(history_metadata)
+    title_sent = False
+    last_line = None
+    async for line in stream:
+        if delta and not title_sent and title_job.done():
+            title_sent = True
+            yield format_title_event(history_metadata)
+        yield line
+        last_line = line
+
+    if title_sent or not await wait_for_title(title_job):
+        return
+    if delta:
+        yield format_title_event(history_metadata)
+    elif last_line:
+        # clients of the accumulated format read the title from the last line
+        line = with_title(last_line, history_metadata['title'])
+        if line:
+            yield line
+
+
+async def wait_for_title(title_job):
+    if not title_job:
+        return False
+    try:
+        await asyncio.wait_for(asyncio.shield(title_job), TITLE_WAIT_TIMEOUT)
+        return True
+    except Exception as e:
+        logging.warning("Conversation title not ready in time")
+        return False
+
+
+def stream_response(stream, request_body, title_job=None):
+    if title_job:
+        stream = stream_with_title(stream, title_job, request_body.get("history_metadata", {}), use_delta_stream(request_body))
+    return Response(stream, mimetype='text/event-stream')
+
+
+@app.route("/conversation", methods=["GET", "POST"])
+async def conversation():
+    request_body = await request.get_json()
+    return await conversation_internal(request_body, request.headers)
+
+async def conversation_internal(request_body, request_headers, title_job=None, save_answer=None):
+    try:
+        use_data = should_use_data()
+        if use_data:
+            return await conversation_with_data(request_body, request_headers, title_job, save_answer)
+        else:
+            return await conversation_without_data(request_body, title_job, save_answer)
+    except Exception as e:
+        logging.exception("Exception in /conversation")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/cache/stats", methods=["GET"])
+async def cache_stats():
+    stats = {"groups": group_membership_cache.stats()}
+    if answer_cache:
+        stats["answers"] = answer_cache.stats()
+    if HISTORY_CACHE_ENABLED and cosmos_conversation_client:
+        stats["history"] = cosmos_conversation_client.cache.stats()
+    return jsonify(stats), 200
+
+## Conversation History API ##
+@app.route("/history/generate", methods=["POST"])
+async def add_conversation():
+    user_id = get_user_id(request.headers)
+
+    try:
+        require_store(cosmos_conversation_client)
+        request_json = await request.get_json()
+        conversation_id, user_message = parse_generate_request(request_json)
+        messages = request_json["messages"]
+
+        # check for the conversation_id, if the conversation is not set, we will create a new one
+        conversation_dict = None
+        if not conversation_id:
+            title = new_conversation_title(messages)
+            if history_writer:
+                # written in the background, together with the first message
+                conversation_dict = new_conversation(user_id, title)
+            else:
+                conversation_dict = await cosmos_conversation_client.create_conversation(user_id=user_id, title=title)
+            conversation_id = conversation_dict['id']
+
+        ## write the incoming message to the conversation history in cosmos
+        if history_writer:
+            await history_writer.create_messages(conversation_id, user_id, [user_message], conversation=conversation_dict)
+        else:
+            await cosmos_conversation_client.create_message(
+                conversation_id=conversation_id,
+                user_id=user_id,
+                input_message=user_message
+            )
+
+        # Submit request to Chat Completions for response
+        history_metadata = new_history_metadata(conversation_id, conversation_dict)
+        request_json['history_metadata'] = history_metadata
+        title_job = None
+        if generates_title(conversation_dict):
+            title_job = asyncio.create_task(generate_and_save_title(user_id, conversation_id, messages, history_metadata))
+        save = functools.partial(save_answer, user_id, conversation_id) if request_json.get("save_answer") else None
+        return await conversation_internal(request_json, request.headers, title_job, save)
+
+    except Exception as e:
+        return history_error(e, "/history/generate")
+
+
+@app.route("/history/update", methods=["POST"])
+async def update_conversation():
+    user_id = get_user_id(request.headers)
+
+    try:
+        require_store(cosmos_conversation_client)
+        conversation_id, new_messages = parse_update_request(await request.get_json())
+
+        ## write the answer to the conversation history in cosmos, in one batch
+        if history_writer:
+            await history_writer.create_messages(conversation_id, user_id, new_messages)
+            return update_response(), 200
+        request_charge = RequestCharge()
+        await cosmos_conversation_client.create_messages(
+            conversation_id=conversation_id,
+            user_id=user_id,
+            input_messages=new_messages,
+            request_charge=request_charge
+        )
+        return update_response(request_charge), 200
+
+    except Exception as e:
+        return history_error(e, "/history/update")
+
+@app.route("/history/delete", methods=["DELETE"])
+async def delete_conversation():
+    user_id = get_user_id(request.headers)
+
+    try:
+        conversation_id = require_conversation_id(await request.get_json())
+
+        ## hide the conversation right away, a background job purges it with its messages
+        await wait_for_history_writes(user_id, conversation_id)
+        conversation_ids = await cosmos_conversation_client.mark_conversations_deleted(user_id, [conversation_id])
+        job = await start_deletion_job(user_id, conversation_ids)
+        return conversation_deleted_response(conversation_id, job), 202
+    except Exception as e:
+        return history_error(e, "/history/delete")
+
+@app.route("/history/list", methods=["GET"])
+async def list_conversations():
+    user_id = get_user_id(request.headers)
+
+    try:
+        await wait_for_history_writes(user_id)
+        etag = await cosmos_conversation_client.conversations_etag(user_id)
+        if client_has_current(request, etag):
+            return with_etag(Response(status=304), etag)
+
+        ## page through the conversations when the client asks for it
+        page = parse_page_request(request.args)
+        if page:
+            conversations, continuation_token = await cosmos_conversation_client.get_conversations_page(user_id, *page)
+            return with_etag(jsonify(conversations_page_response(conversations, continuation_token)), etag), 200
+
+        conversations = await cosmos_conversation_client.get_conversations(user_id)
+        return with_etag(jsonify(conversations_response(user_id, conversations)), etag), 200
+    except Exception as e:
+        return history_error(e, "/history/list")
+
+@app.route("/history/read", methods=["POST"])
+async def get_conversation():
+    user_id = get_user_id(request.headers)
+
+    try:
+        conversation_id = require_conversation_id(await request.get_json())
+
+        ## get the conversation object and the related messages from cosmos
+        await wait_for_history_writes(user_id, conversation_id)
+        etag = await cosmos_conversation_client.conversation_etag(user_id, conversation_id)
+        if client_has_current(request, etag):
+            return with_etag(Response(status=304), etag)
+        if not await cosmos_conversation_client.get_conversation(user_id, conversation_id):
+            raise conversation_not_found(conversation_id)
+        conversation_messages = await cosmos_conversation_client.get_messages(user_id, conversation_id)
+        return with_etag(jsonify(conversation_response(conversation_id, conversation_messages)), etag), 200
+    except Exception as e:
+        return history_error(e, "/history/read")
+
+@app.route("/history/rename", methods=["POST"])
+async def rename_conversation():
+    user_id = get_user_id(request.headers)
+
+    try:
+        conversation_id, title = parse_rename_request(await request.get_json())
+
+        ## update the title, retried if the conversation changes concurrently
+        await wait_for_history_writes(user_id, conversation_id)
+        updated_conversation = await cosmos_conversation_client.rename_conversation(user_id, conversation_id, title)
+        if not updated_conversation:
+            raise conversation_not_found(conversation_id)
+        return updated_conversation, 200
+    except Exception as e:
+        return history_error(e, "/history/rename")
+
+@app.route("/history/delete_all", methods=["DELETE"])
+async def delete_all_conversations():
+    user_id = get_user_id(request.headers)
+
+    # hide all conversations of the user right away, a background job purges them with their messages
+    try:
+        await wait_for_history_writes(user_id)
+        conversation_ids = await cosmos_conversation_client.mark_conversations_deleted(user_id)
+        if not conversation_ids:
+            raise no_conversations_found(user_id)
+
+        job = await start_deletion_job(user_id, conversation_ids)
+        return conversations_deleted_response(user_id, job), 202
+    except Exception as e:
+        return history_error(e, "/history/delete_all")
+
+
+@app.route("/history/delete_status/<job_id>", methods=["GET"])
+async def get_deletion_job_status(job_id):
+    user_id = get_user_id(request.headers)
+
+    try:
+        job = await cosmos_conversation_client.get_deletion_job(user_id, job_id)
+        return deletion_job_response(job_id, job), 200
+    except Exception as e:
+        return history_error(e, "/history/delete_status")
+
+
+@app.route("/history/clear", methods=["POST"])
+async def clear_messages():
+    user_id = get_user_id(request.headers)
+
+    try:
+        conversation_id = require_conversation_id(await request.get_json())
+
+        ## delete the conversation messages from cosmos
+        await wait_for_history_writes(user_id, conversation_id)
+        request_charge = RequestCharge()
+        deleted_messages = await cosmos_conversation_client.delete_messages(conversation_id, user_id, request_charge)
+        return messages_cleared_response(conversation_id, deleted_messages, request_charge), 200
+    except Exception as e:
+        return history_error(e, "/history/clear_messages")
+
+@app.route("/history/write_queue/stats", methods=["GET"])
+async def history_write_queue_stats():
+    if not history_writer:
+        return jsonify({"error": "Background history writes are not enabled"}), 404
+    return jsonify(history_writer.stats()), 200
+
+@app.route("/history/ensure", methods=["GET"])
+async def ensure_cosmos():
+    if not AZURE_COSMOSDB_ACCOUNT and CONVERSATION_STORE == "cosmos":
+        return jsonify({"error": "CosmosDB is not configured"}), 404
+
+    if not cosmos_conversation_client or not await cosmos_conversation_client.ensure():
+        return jsonify({"error": "CosmosDB is not working"}), 500
+
+    return jsonify({"message": "CosmosDB is configured and working"}), 200
+
+
+async def wait_for_history_writes(user_id, conversation_id=None):
+    # Reads and changes of the history see the messages the user's earlier requests queued
+    if history_writer and not await history_writer.wait(user_id, conversation_id, HISTORY_WRITE_WAIT_TIMEOUT):
+        logging.warning("Timed out waiting for queued chat history writes of conversation %s", conversation_id)
+
+
+async def start_deletion_job(user_id, conversation_ids):
+    # The job document lets any worker report the progress, see /history/delete_status
+    job = await cosmos_conversation_client.create_deletion_job(user_id, conversation_ids)
+    app.add_background_task(run_deletion_job, user_id, job['id'])
+    return job
+
+
+async def resume_deletion_jobs():
+    # Deletion jobs left unfinished by stopped processes
+    try:
+        jobs = await cosmos_conversation_client.get_unfinished_deletion_jobs()
+    except Exception as e:
+        logging.exception("Exception while reading unfinished deletion jobs")
+        return
+    for job in jobs:
+        app.add_background_task(resume_deletion_job, job['userId'], job['id'], deletion_job_wait(job))
+
+
+async def resume_deletion_job(user_id, job_id, wait):
+    # running jobs are taken over once their worker stopped updating them
+    await asyncio.sleep(wait)
+    await run_deletion_job(user_id, job_id)
+
+
+async def run_deletion_job(user_id, job_id):
+    try:
+        await cosmos_conversation_client.run_deletion_job(user_id, job_id)
+    except Exception as e:
+        logging.exception("Exception in deletion job %s", job_id)
+
+
+async def save_answer(user_id, conversation_id, answer_messages):
+    # Stores the answer /history/generate has streamed, see "save_answer" in backend/utils.py
+    new_messages = answer_messages_to_save(answer_messages)
+    if not new_messages:
+        return False
+    try:
+        if history_writer:
+            await history_writer.create_messages(conversation_id, user_id, new_messages)
+        else:
+            await cosmos_conversation_client.create_messages(conversation_id, user_id, new_messages)
+        return True
+    except Exception as e:
+        logging.exception("Exception while saving the answer")
+        return False
+
+
+async def generate_and_save_title(user_id, conversation_id, conversation_messages, history_metadata):
+    # Runs alongside the answer, see stream_with_title
+    placeholder = history_metadata['title']
+    title = await generate_title(conversation_messages)
+    history_metadata['title'] = title
+    if title == placeholder:
+        return title
+
+    try:
+        await wait_for_history_writes(user_id, conversation_id)
+        await cosmos_conversation_client.update_conversation(user_id, conversation_id, title_setter(placeholder, title))
+    except Exception as e:
+        logging.exception("Exception while saving the conversation title")
+    return title
+
+
+async def generate_title(conversation_messages):
+    messages = prepare_title_messages(conversation_messages)
+
+    try:
+        ## Submit prompt to Chat Completions for response
+        configure_openai()
+        completion = await openai.ChatCompletion.acreate(
+            engine=AZURE_OPENAI_MODEL,
+            messages=messages,
+            temperature=1,
+            max_tokens=64
+        )
+        return parse_title(completion)
+    except Exception as e:
+        return messages[-2]['content']
+
+if __name__ == "__main__":
+    app.run(host="127.0.0.1", port=8000)
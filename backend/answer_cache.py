@@ -0,0 +1,88 @@
+import hashlib
+import json
+
+from backend.cache import create_cache_backend
+from backend.settings import ANSWER_CACHE_TTL, ANSWER_CACHE_MAXSIZE
+from backend.utils import format_as_ndjson, format_delta_start, format_delta_end
+
+
+def normalize_messages(messages):
+    # Only role and content decide the answer, the frontend also sends ids and dates
+    return [{"role": m["role"], "content": " ".join((m.get("content") or "").split())} for m in messages]
+
+
+class AnswerCache():
+    """Exact-match cache for "on your data" answers.
+
+    The key covers the endpoint (and with it the deployment), the normalized messages and
+    everything else in the request body: generation parameters, search settings and the
+    user's security filter. Answers are therefore only served to users with the same filter
+    and never leak citations across permission groups.
+    """
+
+    def __init__(self, ttl=ANSWER_CACHE_TTL, maxsize=ANSWER_CACHE_MAXSIZE, backend=None):
+        self.backend = backend or create_cache_backend("answers", maxsize=maxsize, ttl=ttl)
+
+    def make_key(self, endpoint, body):
+        normalized = dict(body, messages=normalize_messages(body["messages"]))
+        normalized.pop("stream", None)
+        return hashlib.sha256(json.dumps({"endpoint": endpoint, "body": normalized}, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    async def aget(self, key):
+        return await self.backend.aget(key)
+
+    def _cacheable(self, response):
+        # Only complete answers are worth replaying
+        messages = response["choices"][0]["messages"]
+        if not messages or messages[-1]["role"] != "assistant" or not messages[-1]["content"]:
+            return None
+        return {k: v for k, v in response.items() if k != "history_metadata"}
+
+    def set(self, key, response):
+        value = self._cacheable(response)
+        if value is not None:
+            self.backend.set(key, value)
+
+    async def aset(self, key, response):
+        value = self._cacheable(response)
+        if value is not None:
+            await self.backend.aset(key, value)
+
+    def stats(self):
+        return self.backend.stats()
+
+
+def new_cached_response(chunk, tool_message, content):
+    # Rebuild the accumulated response from the first upstream chunk and the streamed parts
+    messages = [tool_message] if tool_message else []
+    messages.append({"role": "assistant", "content": content})
+    return {
+        "id": chunk["id"],
+        "model": chunk["model"],
+        "created": chunk["created"],
+        "object": chunk["object"],
+        "choices": [{
+            "messages": messages
+        }]
+    }
+
+
+def replay_cached_response(cached, history_metadata={}):
+    # Same accumulated NDJSON lines as stream_with_data: citations first, then the answer
+    messages = cached["choices"][0]["messages"]
+    if len(messages) > 1:
+        yield format_as_ndjson(dict(cached, choices=[{"messages": messages[:-1]}], history_metadata=history_metadata))
+    yield format_as_ndjson(dict(cached, history_metadata=history_metadata))
+
+
+def replay_cached_response_delta(cached, history_metadata={}):
+    messages = cached["choices"][0]["messages"]
+    content = messages[-1]["content"]
+    yield format_delta_start(cached, history_metadata)
+    for message in messages[:-1]:
+        yield format_as_ndjson({"type": "tool", "message": message})
+    yield format_as_ndjson({"type": "delta", "content": content})
+    yield format_delta_end(cached["id"], 1, len(content), history_metadata.get("saved"))
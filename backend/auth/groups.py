@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+from backend.cache import AsyncSingleFlight, SingleFlight, create_cache_backend
+from backend.settings import (
+    AZURE_GRAPH_GROUPS_PAGE_SIZE,
+    GROUPS_CACHE_TTL,
+    GROUPS_CACHE_NEGATIVE_TTL,
+    GROUPS_CACHE_MAXSIZE,
+)
+from backend.utils import GRAPH_TRANSITIVE_MEMBER_OF_URL, build_filter_string
+
+# How long a worker waits for another worker that is already fetching the same user
+GROUPS_LEASE_TIMEOUT = 10
+GROUPS_LEASE_POLL_INTERVAL = 0.05
+
+
+def get_groups_endpoint():
+    # First page of the group membership; larger pages mean fewer serial round trips
+    if AZURE_GRAPH_GROUPS_PAGE_SIZE:
+        return f"{GRAPH_TRANSITIVE_MEMBER_OF_URL}&$top={int(AZURE_GRAPH_GROUPS_PAGE_SIZE)}"
+    return GRAPH_TRANSITIVE_MEMBER_OF_URL
+
+
+class GroupMembershipCache():
+    """Caches the groups of each user principal together with the search filter built from them.
+
+    Loaders return the list of groups, or None when the lookup failed. Failures are cached
+    for a shorter time so that a Graph outage is not retried on every message. Concurrent
+    lookups for the same user share a single fetch: within a worker through single-flight,
+    across workers through a lease in the cache backend when it is shared (CACHE_BACKEND=sqlite).
+    """
+
+    def __init__(self, ttl=GROUPS_CACHE_TTL, negative_ttl=GROUPS_CACHE_NEGATIVE_TTL, maxsize=GROUPS_CACHE_MAXSIZE, backend=None):
+        self.ttl = ttl
+        self.negative_ttl = min(negative_ttl, ttl)
+        self.backend = backend or create_cache_backend("groups", maxsize=maxsize, ttl=ttl)
+        self.single_flight = SingleFlight()
+        self.async_single_flight = AsyncSingleFlight()
+
+    def _entry(self, groups):
+        return {"groups": groups, "filter": build_filter_string(groups)}, self.ttl if groups is not None else self.negative_ttl
+
+    def _store(self, user_id, groups):
+        entry, ttl = self._entry(groups)
+        self.backend.set(user_id, entry, ttl=ttl)
+        return entry
+
+    def get_entry(self, user_id, loader):
+        entry = self.backend.get(user_id)
+        if entry is not None:
+            return entry
+
+        def load():
+            # another thread may have filled the cache while we waited
+            entry = self.backend.peek(user_id)
+            if entry is not None:
+                return entry
+            # after the wait times out the user is fetched anyway, without the lease
+            leased = self.backend.acquire_lease(user_id, GROUPS_LEASE_TIMEOUT)
+            if not leased:
+                deadline = time.monotonic() + GROUPS_LEASE_TIMEOUT
+                while time.monotonic() < deadline:
+                    time.sleep(GROUPS_LEASE_POLL_INTERVAL)
+                    entry = self.backend.peek(user_id)
+                    if entry is not None:
+                        return entry
+            try:
+                return self._store(user_id, loader())
+            finally:
+                if leased:
+                    self.backend.release_lease(user_id)
+
+        return self.single_flight.do(user_id, load)
+
+    async def aget_entry(self, user_id, loader):
+        entry = await self.backend.aget(user_id)
+        if entry is not None:
+            return entry
+
+        async def load():
+            leased = await self.backend.aacquire_lease(user_id, GROUPS_LEASE_TIMEOUT)
+            if not leased:
+                deadline = time.monotonic() + GROUPS_LEASE_TIMEOUT
+                while time.monotonic() < deadline:
+                    await asyncio.sleep(GROUPS_LEASE_POLL_INTERVAL)
+                    entry = await self.backend.apeek(user_id)
+                    if entry is not None:
+                        return entry
+            try:
+                entry, ttl = self._entry(await loader())
+                await self.backend.aset(user_id, entry, ttl=ttl)
+                return entry
+            finally:
+                if leased:
+                    await self.backend.arelease_lease(user_id)
+
+        return await self.async_single_flight.do(user_id, load)
+
+    def get_groups(self, user_id, loader):
+        return self.get_entry(user_id, loader)["groups"] or []
+
+    async def aget_groups(self, user_id, loader):
+        return (await self.aget_entry(user_id, loader))["groups"] or []
+
+    def get_filter_string(self, user_id, loader):
+        return self.get_entry(user_id, loader)["filter"]
+
+    async def aget_filter_string(self, user_id, loader):
+        return (await self.aget_entry(user_id, loader))["filter"]
+
+    def invalidate(self, user_id):
+        self.backend.delete(user_id)
+
+    def stats(self):
+        return self.backend.stats()
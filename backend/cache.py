@@ -0,0 +1,378 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from backend.settings import CACHE_BACKEND, CACHE_SQLITE_PATH
+
+_MISSING = object()
+
+# ttl of entries that are only replaced or evicted, never expire
+NO_EXPIRY = float("inf")
+
+
+class TTLCache():
+    """Thread-safe in-process cache with a per-entry time to live and LRU eviction."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def setdefault(self, key, value, ttl: float = None):
+        ## the live value of the key, value once it is stored if there is none
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[0]
+            if ttl > 0 and self.maxsize > 0:
+                self._set(key, value, ttl)
+            return value
+
+    def _set(self, key, value, ttl):
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CacheBackend():
+    """Store for cached values shared by the users of one namespace.
+
+    Values must be JSON serializable so that every backend can hold them. get() counts
+    hits and misses of this process, see stats().
+    """
+
+    name = None
+
+    def __init__(self, namespace: str, maxsize: int, ttl: float):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self._load(key)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        # like get(), without touching the counters
+        value = self._load(key)
+        return default if value is _MISSING else value
+
+    def set(self, key, value, ttl: float = None):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl: float = None):
+        # Stores the value unless the key has one, atomically; returns the value the key has
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def acquire_lease(self, key, ttl: float) -> bool:
+        # Only one worker holding the lease should compute a missing value
+        return True
+
+    def release_lease(self, key):
+        pass
+
+    # Variants for the event loop, backends that block override them
+    async def aget(self, key, default=None):
+        return self.get(key, default)
+
+    async def apeek(self, key, default=None):
+        return self.peek(key, default)
+
+    async def aset(self, key, value, ttl: float = None):
+        self.set(key, value, ttl)
+
+    async def aadd(self, key, value, ttl: float = None):
+        return self.add(key, value, ttl)
+
+    async def adelete(self, key):
+        self.delete(key)
+
+    async def aacquire_lease(self, key, ttl: float) -> bool:
+        return self.acquire_lease(key, ttl)
+
+    async def arelease_lease(self, key):
+        self.release_lease(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": self.size()
+        }
+
+    def size(self) -> int:
+        raise NotImplementedError
+
+    def _load(self, key):
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Per-process cache, every worker keeps its own copy."""
+
+    name = "memory"
+
+    def __init__(self, namespace: str, maxsize: int, ttl: float):
+        super().__init__(namespace, maxsize, ttl)
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def _load(self, key):
+        return self._cache.get(key, default=_MISSING)
+
+    def set(self, key, value, ttl: float = None):
+        self._cache.set(key, value, ttl=ttl)
+
+    def add(self, key, value, ttl: float = None):
+        return self._cache.setdefault(key, value, ttl=ttl)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def size(self):
+        return len(self._cache)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Cache in a local SQLite file, shared by all worker processes on the host.
+
+    Expired rows are ignored on read and purged together with the least recently written
+    rows once the namespace grows past maxsize.
+    """
+
+    name = "sqlite"
+    EVICT_EVERY = 100
+
+    def __init__(self, namespace: str, maxsize: int, ttl: float, path: str = CACHE_SQLITE_PATH):
+        super().__init__(namespace, maxsize, ttl)
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value TEXT, expires_at REAL, PRIMARY KEY (namespace, key)) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (namespace, expires_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (namespace TEXT, key TEXT, expires_at REAL, PRIMARY KEY (namespace, key)) WITHOUT ROWID")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _load(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (self.namespace, key, time.time())
+        ).fetchone()
+        return _MISSING if row is None else json.loads(row[0])
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (self.namespace, key, json.dumps(value), time.time() + ttl)
+        )
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def add(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return value
+        now = time.time()
+        conn = self._connection()
+        # an expired row counts as absent
+        conn.execute(
+            "INSERT INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+            "WHERE cache.expires_at <= ?",
+            (self.namespace, key, json.dumps(value), now + ttl, now)
+        )
+        row = conn.execute("SELECT value FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)).fetchone()
+        return value if row is None else json.loads(row[0])
+
+    def evict(self):
+        conn = self._connection()
+        conn.execute("DELETE FROM cache WHERE namespace = ? AND expires_at <= ?", (self.namespace, time.time()))
+        conn.execute(
+            "DELETE FROM cache WHERE namespace = ? AND key IN "
+            "(SELECT key FROM cache WHERE namespace = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.namespace, self.maxsize)
+        )
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+    def acquire_lease(self, key, ttl: float) -> bool:
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO leases (namespace, key, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET expires_at = excluded.expires_at WHERE leases.expires_at <= ?",
+            (self.namespace, key, now + ttl, now)
+        )
+        return cursor.rowcount == 1
+
+    def release_lease(self, key):
+        self._connection().execute("DELETE FROM leases WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+    # queries may wait up to the busy timeout for other workers, off the event loop
+    async def aget(self, key, default=None):
+        return await asyncio.to_thread(self.get, key, default)
+
+    async def apeek(self, key, default=None):
+        return await asyncio.to_thread(self.peek, key, default)
+
+    async def aset(self, key, value, ttl: float = None):
+        await asyncio.to_thread(self.set, key, value, ttl)
+
+    async def aadd(self, key, value, ttl: float = None):
+        return await asyncio.to_thread(self.add, key, value, ttl)
+
+    async def adelete(self, key):
+        await asyncio.to_thread(self.delete, key)
+
+    async def aacquire_lease(self, key, ttl: float) -> bool:
+        return await asyncio.to_thread(self.acquire_lease, key, ttl)
+
+    async def arelease_lease(self, key):
+        await asyncio.to_thread(self.release_lease, key)
+
+    def size(self):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM cache WHERE namespace = ? AND expires_at > ?", (self.namespace, time.time())
+        ).fetchone()[0]
+
+
+CACHE_BACKENDS = {
+    MemoryCacheBackend.name: MemoryCacheBackend,
+    SQLiteCacheBackend.name: SQLiteCacheBackend,
+}
+
+
+def create_cache_backend(namespace: str, maxsize: int, ttl: float, backend: str = CACHE_BACKEND) -> CacheBackend:
+    if backend not in CACHE_BACKENDS:
+        raise ValueError(f"Unknown CACHE_BACKEND '{backend}', expected one of {', '.join(CACHE_BACKENDS)}")
+    return CACHE_BACKENDS[backend](namespace, maxsize, ttl)
+
+
+class SingleFlight():
+    """Collapses concurrent calls for the same key into one call, for worker threads."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event()}
+
+        if not leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+
+class AsyncSingleFlight():
+    """Collapses concurrent calls for the same key into one call, within one event loop."""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # mark the exception as retrieved, there may be no followers to await it
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
+            if not future.done():
+                future.cancel()
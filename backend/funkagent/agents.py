@@ -6,9 +6,11 @@ import inspect
 import openai
 import logging
 
-from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential
 
-from history.cosmosdbservice import CosmosConversationClient
+from history.cosmosdbservice_async import CosmosConversationClient
+from history.localstore import create_local_store
+from history.store import AsyncConversationStore
 
 
 sys_msg = """Assistant is a large language model trained by OpenAI.
@@ -20,6 +22,39 @@ Assistant is constantly learning and improving, and its capabilities are constan
 Overall, Assistant is a powerful system that can help with a wide range of tasks and provide valuable insights and information on a wide range of topics. Whether you need help with a specific question or just want to have a conversation about a particular topic, Assistant is here to assist.
 """
 
+_cosmos_conversation_client = None
+
+def get_cosmos_conversation_client() -> Optional[AsyncConversationStore]:
+    # Initialize a CosmosDB client with AAD auth and containers once, its connections are reused across sessions.
+    # CONVERSATION_STORE selects a local stand-in instead.
+    global _cosmos_conversation_client
+    if _cosmos_conversation_client is None:
+        _cosmos_conversation_client = create_local_store(asynchronous=True)
+    if _cosmos_conversation_client is None:
+        AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
+        AZURE_COSMOSDB_ACCOUNT = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
+        AZURE_COSMOSDB_CONVERSATIONS_CONTAINER = os.environ.get("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER")
+        AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
+        if AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER:
+            try :
+                cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
+
+                if not AZURE_COSMOSDB_ACCOUNT_KEY:
+                    credential = DefaultAzureCredential()
+                else:
+                    credential = AZURE_COSMOSDB_ACCOUNT_KEY
+
+                _cosmos_conversation_client = CosmosConversationClient(
+                    cosmosdb_endpoint=cosmos_endpoint, 
+                    credential=credential, 
+                    database_name=AZURE_COSMOSDB_DATABASE,
+                    container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
+                )
+            except Exception as e:
+                logging.exception("Exception in CosmosDB initialization", e)
+                return None
+    return _cosmos_conversation_client
+
 class aobject(object):
     """ Inheriting this class allows to define async __init__"""
     async def __new__(cls, *args, **kwargs):
@@ -40,6 +75,7 @@ class Agent(aobject):
         deployment_name: Optional[str] = os.environ.get('AZURE_OPENAI_MODEL_NAME'),
         functions: Optional[list] = None,
         conversation_id: Optional[int] = None,
+        cosmos_conversation_client: Optional[AsyncConversationStore] = None,
     ):
         # Check user_id
         if user_id is None:
@@ -59,14 +95,8 @@ class Agent(aobject):
         self.functions = self._parse_functions(functions)
         self.func_mapping = self._create_func_mapping(functions)
         
-        # CosmosDB Integration Settings
-        self.AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
-        self.AZURE_COSMOSDB_ACCOUNT = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
-        self.AZURE_COSMOSDB_CONVERSATIONS_CONTAINER = os.environ.get("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER")
-        self.AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
-
-        # Initialize CosmosDB client
-        self.cosmos_conversation_client = self.get_cosmos_conversation_client()
+        # CosmosDB client, shared by all agents of the process unless one is passed in
+        self.cosmos_conversation_client = cosmos_conversation_client or get_cosmos_conversation_client()
         self.conversation_id = conversation_id
         await self.initialize_chat_history()
 
@@ -99,27 +129,6 @@ class Agent(aobject):
                     input_message=message
                 )
 
-    def get_cosmos_conversation_client(self) -> CosmosConversationClient:
-        # Initialize a CosmosDB client with AAD auth and containers
-        if self.AZURE_COSMOSDB_DATABASE and self.AZURE_COSMOSDB_ACCOUNT and self.AZURE_COSMOSDB_CONVERSATIONS_CONTAINER:
-            try :
-                cosmos_endpoint = f'https://{self.AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
-
-                if not self.AZURE_COSMOSDB_ACCOUNT_KEY:
-                    credential = DefaultAzureCredential()
-                else:
-                    credential = self.AZURE_COSMOSDB_ACCOUNT_KEY
-
-                return CosmosConversationClient(
-                    cosmosdb_endpoint=cosmos_endpoint, 
-                    credential=credential, 
-                    database_name=self.AZURE_COSMOSDB_DATABASE,
-                    container_name=self.AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
-                )
-            except Exception as e:
-                logging.exception("Exception in CosmosDB initialization", e)
-                return None
-
     def _parse_functions(self, functions: Optional[list]) -> Optional[list]:
         if functions is None:
             return None
@@ -247,10 +256,12 @@ class Agent(aobject):
         conversation_id = self.conversation_id if conversation_id is None else conversation_id
         if conversation_id != self.conversation_id:
             # Delete conversation with given id
+            await self.cosmos_conversation_client.delete_messages(conversation_id, self.user_id)
             return await self.cosmos_conversation_client.delete_conversation(self.user_id, conversation_id)
         else:
             # Delete current conversation and chat history
             self.chat_history = []
+            await self.cosmos_conversation_client.delete_messages(conversation_id, self.user_id)
             res = await self.cosmos_conversation_client.delete_conversation(self.user_id, conversation_id)
 
             # Create new conversation
@@ -0,0 +1,336 @@
+import uuid
+
+from backend.cache import NO_EXPIRY, create_cache_backend
+from backend.history.store import AsyncConversationStore, ConversationStore
+from backend.history.utils import RequestCharge
+from backend.settings import HISTORY_CACHE_TTL, HISTORY_CACHE_MAXSIZE
+
+
+class HistoryCache():
+    """Conversation lists, conversations and messages of each user, keyed by version tokens.
+
+    Every user has a version for their conversation lists and one per conversation; writes
+    replace the versions they affect, which orphans the entries cached under the old ones.
+    Versions double as ETags. They are kept apart from the cached values and don't expire, so
+    an ETag only changes with a write (or when its version is evicted). Changes made by other
+    workers are only seen when the cache backend is shared (CACHE_BACKEND=sqlite). The a*
+    methods are the variants for the event loop.
+    """
+
+    def __init__(self, ttl=HISTORY_CACHE_TTL, maxsize=HISTORY_CACHE_MAXSIZE, backend=None, versions=None):
+        self.backend = backend or create_cache_backend("history", maxsize=maxsize, ttl=ttl)
+        self.versions = versions or create_cache_backend("history-versions", maxsize=maxsize, ttl=NO_EXPIRY)
+
+    @staticmethod
+    def _new_version():
+        return uuid.uuid4().hex[:16]
+
+    def _version(self, key):
+        # workers that miss the same version at the same time agree on the one stored first
+        return self.versions.add(key, self._new_version(), ttl=NO_EXPIRY)
+
+    async def _aversion(self, key):
+        return await self.versions.aadd(key, self._new_version(), ttl=NO_EXPIRY)
+
+    @staticmethod
+    def _version_keys(user_id, conversation_id):
+        # the user's epoch changes when it isn't known which conversations a write touched
+        return f"e:{user_id}", f"v:{user_id}:{conversation_id}"
+
+    @staticmethod
+    def _invalidated_keys(user_id, conversation_ids):
+        if conversation_ids is None:
+            return [f"v:{user_id}", f"e:{user_id}"]
+        return [f"v:{user_id}", *(f"v:{user_id}:{conversation_id}" for conversation_id in conversation_ids)]
+
+    def conversations_version(self, user_id):
+        return self._version(f"v:{user_id}")
+
+    async def aconversations_version(self, user_id):
+        return await self._aversion(f"v:{user_id}")
+
+    def conversation_version(self, user_id, conversation_id):
+        return ".".join(self._version(key) for key in self._version_keys(user_id, conversation_id))
+
+    async def aconversation_version(self, user_id, conversation_id):
+        return ".".join([await self._aversion(key) for key in self._version_keys(user_id, conversation_id)])
+
+    def invalidate(self, user_id, conversation_ids=None):
+        for key in self._invalidated_keys(user_id, conversation_ids):
+            self.versions.set(key, self._new_version(), ttl=NO_EXPIRY)
+
+    async def ainvalidate(self, user_id, conversation_ids=None):
+        for key in self._invalidated_keys(user_id, conversation_ids):
+            await self.versions.aset(key, self._new_version(), ttl=NO_EXPIRY)
+
+    @staticmethod
+    def _conversations_key(user_id, version, parts):
+        return ":".join(["conversations", user_id, version, *map(str, parts)])
+
+    def conversations_key(self, user_id, *parts):
+        return self._conversations_key(user_id, self.conversations_version(user_id), parts)
+
+    async def aconversations_key(self, user_id, *parts):
+        return self._conversations_key(user_id, await self.aconversations_version(user_id), parts)
+
+    def conversation_key(self, user_id, conversation_id, kind):
+        return ":".join([kind, user_id, conversation_id, self.conversation_version(user_id, conversation_id)])
+
+    async def aconversation_key(self, user_id, conversation_id, kind):
+        return ":".join([kind, user_id, conversation_id, await self.aconversation_version(user_id, conversation_id)])
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    async def aget(self, key):
+        return await self.backend.aget(key)
+
+    def set(self, key, value):
+        # a missing conversation may be created by another worker, it isn't cached
+        if value is not None:
+            self.backend.set(key, value)
+
+    async def aset(self, key, value):
+        if value is not None:
+            await self.backend.aset(key, value)
+
+    def stats(self):
+        return self.backend.stats()
+
+
+class CachedConversationStore(ConversationStore):
+    """Read-through cache in front of a ConversationStore.
+
+    Reads of conversation lists, conversations and messages are served from a HistoryCache;
+    writes go to the store and invalidate what they change, also when they fail halfway.
+    """
+
+    def __init__(self, store: ConversationStore, cache: HistoryCache = None):
+        self.store = store
+        self.cache = cache or HistoryCache()
+
+    def _cached(self, key, load):
+        value = self.cache.get(key)
+        if value is None:
+            value = load()
+            self.cache.set(key, value)
+        return value
+
+    def conversations_etag(self, user_id):
+        return self.cache.conversations_version(user_id)
+
+    def conversation_etag(self, user_id, conversation_id):
+        return self.cache.conversation_version(user_id, conversation_id)
+
+    def ensure(self):
+        return self.store.ensure()
+
+    def create_conversation(self, user_id, title = ''):
+        try:
+            return self.store.create_conversation(user_id, title)
+        finally:
+            self.cache.invalidate(user_id, [])
+
+    def upsert_conversation(self, conversation):
+        try:
+            return self.store.upsert_conversation(conversation)
+        finally:
+            self.cache.invalidate(conversation['userId'], [conversation['id']])
+
+    def get_conversation(self, user_id, conversation_id):
+        return self._cached(self.cache.conversation_key(user_id, conversation_id, "conversation"),
+                            lambda: self.store.get_conversation(user_id, conversation_id))
+
+    def get_conversations(self, user_id, sort_order = 'DESC'):
+        return self._cached(self.cache.conversations_key(user_id, sort_order),
+                            lambda: self.store.get_conversations(user_id, sort_order))
+
+    def get_conversations_page(self, user_id, page_size, continuation_token=None, sort_order='DESC'):
+        page = self._cached(self.cache.conversations_key(user_id, sort_order, page_size, continuation_token),
+                            lambda: list(self.store.get_conversations_page(user_id, page_size, continuation_token, sort_order)))
+        return tuple(page)
+
+    def delete_conversation(self, user_id, conversation_id, request_charge: RequestCharge = None):
+        try:
+            return self.store.delete_conversation(user_id, conversation_id, request_charge)
+        finally:
+            self.cache.invalidate(user_id, [conversation_id])
+
+    def mark_conversations_deleted(self, user_id, conversation_ids=None, request_charge: RequestCharge = None):
+        try:
+            return self.store.mark_conversations_deleted(user_id, conversation_ids, request_charge)
+        finally:
+            self.cache.invalidate(user_id, conversation_ids)
+
+    def purge_conversations(self, user_id, conversation_ids: list, request_charge: RequestCharge = None):
+        try:
+            return self.store.purge_conversations(user_id, conversation_ids, request_charge)
+        finally:
+            self.cache.invalidate(user_id, conversation_ids)
+
+    def create_messages(self, conversation_id, user_id, input_messages: list, request_charge: RequestCharge = None):
+        try:
+            return self.store.create_messages(conversation_id, user_id, input_messages, request_charge)
+        finally:
+            self.cache.invalidate(user_id, [conversation_id])
+
+    def add_conversation(self, conversation: dict):
+        try:
+            return self.store.add_conversation(conversation)
+        finally:
+            self.cache.invalidate(conversation['userId'], [conversation['id']])
+
+    def save_messages(self, user_id, messages: list, request_charge: RequestCharge = None):
+        try:
+            return self.store.save_messages(user_id, messages, request_charge)
+        finally:
+            self.cache.invalidate(user_id, {message['conversationId'] for message in messages})
+
+    def get_messages(self, user_id, conversation_id):
+        return self._cached(self.cache.conversation_key(user_id, conversation_id, "messages"),
+                            lambda: self.store.get_messages(user_id, conversation_id))
+
+    def delete_messages(self, conversation_id, user_id, request_charge: RequestCharge = None):
+        try:
+            return self.store.delete_messages(conversation_id, user_id, request_charge)
+        finally:
+            self.cache.invalidate(user_id, [conversation_id])
+
+    def create_deletion_job(self, user_id, conversation_ids: list):
+        return self.store.create_deletion_job(user_id, conversation_ids)
+
+    def get_deletion_job(self, user_id, job_id):
+        return self.store.get_deletion_job(user_id, job_id)
+
+    def update_deletion_job(self, job, **fields):
+        return self.store.update_deletion_job(job, **fields)
+
+    def get_unfinished_deletion_jobs(self):
+        return self.store.get_unfinished_deletion_jobs()
+
+    def update_conversation(self, user_id, conversation_id, update):
+        ## reads the conversation from the store, a cached copy may carry an outdated _etag
+        try:
+            return self.store.update_conversation(user_id, conversation_id, update)
+        finally:
+            self.cache.invalidate(user_id, [conversation_id])
+
+
+class AsyncCachedConversationStore(AsyncConversationStore):
+    """Async counterpart of CachedConversationStore, see there."""
+
+    def __init__(self, store: AsyncConversationStore, cache: HistoryCache = None):
+        self.store = store
+        self.cache = cache or HistoryCache()
+
+    async def _cached(self, key, load):
+        value = await self.cache.aget(key)
+        if value is None:
+            value = await load()
+            await self.cache.aset(key, value)
+        return value
+
+    async def start(self):
+        await self.store.start()
+        return self
+
+    async def close(self):
+        await self.store.close()
+
+    async def conversations_etag(self, user_id):
+        return await self.cache.aconversations_version(user_id)
+
+    async def conversation_etag(self, user_id, conversation_id):
+        return await self.cache.aconversation_version(user_id, conversation_id)
+
+    async def ensure(self):
+        return await self.store.ensure()
+
+    async def create_conversation(self, user_id, title = ''):
+        try:
+            return await self.store.create_conversation(user_id, title)
+        finally:
+            await self.cache.ainvalidate(user_id, [])
+
+    async def upsert_conversation(self, conversation):
+        try:
+            return await self.store.upsert_conversation(conversation)
+        finally:
+            await self.cache.ainvalidate(conversation['userId'], [conversation['id']])
+
+    async def get_conversation(self, user_id, conversation_id):
+        return await self._cached(await self.cache.aconversation_key(user_id, conversation_id, "conversation"),
+                                  lambda: self.store.get_conversation(user_id, conversation_id))
+
+    async def get_conversations(self, user_id, sort_order = 'DESC'):
+        return await self._cached(await self.cache.aconversations_key(user_id, sort_order),
+                                  lambda: self.store.get_conversations(user_id, sort_order))
+
+    async def get_conversations_page(self, user_id, page_size, continuation_token=None, sort_order='DESC'):
+        async def load():
+            return list(await self.store.get_conversations_page(user_id, page_size, continuation_token, sort_order))
+        return tuple(await self._cached(await self.cache.aconversations_key(user_id, sort_order, page_size, continuation_token), load))
+
+    async def delete_conversation(self, user_id, conversation_id, request_charge: RequestCharge = None):
+        try:
+            return await self.store.delete_conversation(user_id, conversation_id, request_charge)
+        finally:
+            await self.cache.ainvalidate(user_id, [conversation_id])
+
+    async def mark_conversations_deleted(self, user_id, conversation_ids=None, request_charge: RequestCharge = None):
+        try:
+            return await self.store.mark_conversations_deleted(user_id, conversation_ids, request_charge)
+        finally:
+            await self.cache.ainvalidate(user_id, conversation_ids)
+
+    async def purge_conversations(self, user_id, conversation_ids: list, request_charge: RequestCharge = None):
+        try:
+            return await self.store.purge_conversations(user_id, conversation_ids, request_charge)
+        finally:
+            await self.cache.ainvalidate(user_id, conversation_ids)
+
+    async def create_messages(self, conversation_id, user_id, input_messages: list, request_charge: RequestCharge = None):
+        try:
+            return await self.store.create_messages(conversation_id, user_id, input_messages, request_charge)
+        finally:
+            await self.cache.ainvalidate(user_id, [conversation_id])
+
+    async def add_conversation(self, conversation: dict):
+        try:
+            return await self.store.add_conversation(conversation)
+        finally:
+            await self.cache.ainvalidate(conversation['userId'], [conversation['id']])
+
+    async def save_messages(self, user_id, messages: list, request_charge: RequestCharge = None):
+        try:
+            return await self.store.save_messages(user_id, messages, request_charge)
+        finally:
+            await self.cache.ainvalidate(user_id, {message['conversationId'] for message in messages})
+
+    async def get_messages(self, user_id, conversation_id):
+        return await self._cached(await self.cache.aconversation_key(user_id, conversation_id, "messages"),
+                                  lambda: self.store.get_messages(user_id, conversation_id))
+
+    async def delete_messages(self, conversation_id, user_id, request_charge: RequestCharge = None):
+        try:
+            return await self.store.delete_messages(conversation_id, user_id, request_charge)
+        finally:
+            await self.cache.ainvalidate(user_id, [conversation_id])
+
+    async def create_deletion_job(self, user_id, conversation_ids: list):
+        return await self.store.create_deletion_job(user_id, conversation_ids)
+
+    async def get_deletion_job(self, user_id, job_id):
+        return await self.store.get_deletion_job(user_id, job_id)
+
+    async def update_deletion_job(self, job, **fields):
+        return await self.store.update_deletion_job(job, **fields)
+
+    async def get_unfinished_deletion_jobs(self):
+        return await self.store.get_unfinished_deletion_jobs()
+
+    async def update_conversation(self, user_id, conversation_id, update):
+        try:
+            return await self.store.update_conversation(user_id, conversation_id, update)
+        finally:
+            await self.cache.ainvalidate(user_id, [conversation_id])
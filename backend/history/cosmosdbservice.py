@@ -1,11 +1,31 @@
 import os
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from flask import Flask, request
 from azure.identity import DefaultAzureCredential  
 from azure.cosmos import CosmosClient, PartitionKey  
+from azure.cosmos.exceptions import CosmosBatchOperationError, CosmosResourceExistsError, CosmosResourceNotFoundError
+from backend.history.utils import (
+    CONVERSATION_IDS_PER_QUERY,
+    DELETE_CONCURRENCY,
+    DELETION_JOB_TYPE,
+    RequestCharge,
+    etag_condition,
+    new_conversation,
+    new_message,
+    create_messages_batch,
+    save_messages_batch,
+    conversations_page_query,
+    document_ids_query,
+    transactional_batches,
+    delete_operations,
+    soft_delete_operations,
+    new_deletion_job
+)
+from backend.history.store import ConversationStore
   
-class CosmosConversationClient():
+class CosmosConversationClient(ConversationStore):
     
     def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str):
         self.cosmosdb_endpoint = cosmosdb_endpoint
@@ -30,14 +50,7 @@ class CosmosConversationClient():
             return False
 
     def create_conversation(self, user_id, title = ''):
-        conversation = {
-            'id': str(uuid.uuid4()),  
-            'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
-            'userId': user_id,
-            'title': title
-        }
+        conversation = new_conversation(user_id, title)
         ## TODO: add some error handling based on the output of the upsert_item call
         resp = self.container_client.upsert_item(conversation)  
         if resp:
@@ -46,30 +59,91 @@ class CosmosConversationClient():
             return False
     
     def upsert_conversation(self, conversation):
-        resp = self.container_client.upsert_item(conversation)
+        # conversations read from cosmos carry their _etag, only write them if nobody changed them since
+        resp = self.container_client.upsert_item(conversation, **etag_condition(conversation))
         if resp:
             return resp
         else:
             return False
 
-    def delete_conversation(self, user_id, conversation_id):
-        conversation = self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
-            resp = self.container_client.delete_item(item=conversation_id, partition_key=user_id)
-            return resp
-        else:
+    def delete_conversation(self, user_id, conversation_id, request_charge: RequestCharge = None):
+        try:
+            self.container_client.delete_item(item=conversation_id, partition_key=user_id, response_hook=request_charge)
             return True
+        except CosmosResourceNotFoundError:
+            return True
+
+    def delete_messages(self, conversation_id, user_id, request_charge: RequestCharge = None):
+        ## returns the number of messages deleted
+        message_ids = self.get_document_ids(user_id, conversation_ids=[conversation_id], request_charge=request_charge)
+        return self.execute_batches(user_id, delete_operations(message_ids), request_charge)
 
-        
-    def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
+    def mark_conversations_deleted(self, user_id, conversation_ids=None, request_charge: RequestCharge = None):
+        ## hides the conversations, all of the user's when no ids are given; returns the ids marked
+        if conversation_ids is None:
+            conversation_ids = self.get_document_ids(user_id, types=('conversation',), exclude_deleted=True, request_charge=request_charge)
+        self.execute_batches(user_id, soft_delete_operations(conversation_ids), request_charge)
+        return conversation_ids
+
+    def purge_conversations(self, user_id, conversation_ids: list, request_charge: RequestCharge = None):
+        ## returns the number of conversations and messages deleted; messages go first, so that
+        ## a failure never leaves messages without their conversation
+        deleted_messages = 0
+        for i in range(0, len(conversation_ids), CONVERSATION_IDS_PER_QUERY):
+            message_ids = self.get_document_ids(user_id, conversation_ids=conversation_ids[i:i + CONVERSATION_IDS_PER_QUERY],
+                                                request_charge=request_charge)
+            deleted_messages += self.execute_batches(user_id, delete_operations(message_ids), request_charge)
+        deleted_conversations = self.execute_batches(user_id, delete_operations(conversation_ids), request_charge)
+        return {'conversations': deleted_conversations, 'messages': deleted_messages}
+
+    def create_deletion_job(self, user_id, conversation_ids: list):
+        return self.container_client.create_item(new_deletion_job(user_id, conversation_ids))
+
+    def get_deletion_job(self, user_id, job_id):
+        try:
+            job = self.container_client.read_item(item=job_id, partition_key=user_id)
+        except CosmosResourceNotFoundError:
+            return None
+        if job.get('type') != DELETION_JOB_TYPE:
+            return None
+        return job
+
+    def update_deletion_job(self, job, **fields):
+        job.update(fields, updatedAt=datetime.utcnow().isoformat())
+        return self.container_client.upsert_item(job, **etag_condition(job))
+
+    def get_unfinished_deletion_jobs(self):
+        ## the only query across partitions, run once when a worker starts
+        query = "SELECT * FROM c WHERE c.type = @type AND (c.status = 'pending' OR c.status = 'running')"
+        return list(self.container_client.query_items(query=query, parameters=[{'name': '@type', 'value': DELETION_JOB_TYPE}],
+                                                      enable_cross_partition_query=True))
+
+    def get_document_ids(self, user_id, types=('message',), conversation_ids=None, exclude_deleted=False, request_charge: RequestCharge = None):
+        query, parameters = document_ids_query(user_id, types, conversation_ids, exclude_deleted)
+        return list(self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id,
+                                                      response_hook=request_charge))
+
+    def execute_batches(self, user_id, operations: list, request_charge: RequestCharge = None):
+        ## runs operations on documents of the user's partition in transactional batches, a few
+        ## batches at a time; returns the number of operations applied
+        def execute_batch(batch):
+            while batch:
+                try:
+                    self.container_client.execute_item_batch(batch_operations=batch, partition_key=user_id,
+                                                             response_hook=request_charge)
+                    return len(batch)
+                except CosmosBatchOperationError as e:
+                    if e.status_code != 404:
+                        raise
+                    ## a document is already gone and the batch was rolled back, retry without it
+                    batch = batch[:e.error_index] + batch[e.error_index + 1:]
+            return 0
+
+        batches = transactional_batches(operations)
+        if len(batches) <= 1:
+            return sum(map(execute_batch, batches))
+        with ThreadPoolExecutor(max_workers=min(DELETE_CONCURRENCY, len(batches))) as executor:
+            return sum(executor.map(execute_batch, batches))
 
 
     def get_conversations(self, user_id, sort_order = 'DESC'):
@@ -79,58 +153,58 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
-        conversations = list(self.container_client.query_items(query=query, parameters=parameters,
-                                                                               enable_cross_partition_query =True))
+        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' and NOT IS_DEFINED(c.deleted) order by c.updatedAt {sort_order}"
+        conversations = list(self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id))
         ## if no conversations are found, return None
         if len(conversations) == 0:
             return []
         else:
             return conversations
 
+    def get_conversations_page(self, user_id, page_size, continuation_token=None, sort_order='DESC'):
+        ## one page of the user's conversations within their partition, and the token of the next page
+        query, parameters = conversations_page_query(user_id, sort_order)
+        pages = self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id,
+                                                  max_item_count=page_size).by_page(continuation_token)
+        conversations = list(next(pages, []))
+        return conversations, pages.continuation_token
+
     def get_conversation(self, user_id, conversation_id):
-        parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
-            {
-                'name': '@userId',
-                'value': user_id
-            }
-        ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
-        conversation = list(self.container_client.query_items(query=query, parameters=parameters,
-                                                                               enable_cross_partition_query =True))
+        ## point read, id and partition key are known
+        try:
+            conversation = self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except CosmosResourceNotFoundError:
+            return None
         ## if no conversations are found, return None
-        if len(conversation) == 0:
+        if conversation.get('type') != 'conversation' or conversation.get('deleted'):
             return None
         else:
-            return conversation[0]
- 
-    def create_message(self, conversation_id, user_id, input_message: dict):
-        message = {
-            'id': str(uuid.uuid4()),
-            'type': 'message',
-            'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
-            'conversationId' : conversation_id,
-            'role': input_message['role'],
-            'content': input_message['content']
-        }
-        
-        resp = self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = self.get_conversation(user_id, conversation_id)
-            conversation['updatedAt'] = message['createdAt']
-            self.upsert_conversation(conversation)
-            return resp
-        else:
-            return False
-    
+            return conversation
+
+    def create_messages(self, conversation_id, user_id, input_messages: list, request_charge: RequestCharge = None):
+        messages = [new_message(conversation_id, user_id, input_message) for input_message in input_messages]
+
+        ## one round trip: create the messages and update the parent conversation's updatedAt field
+        results = self.container_client.execute_item_batch(
+            batch_operations=create_messages_batch(messages),
+            partition_key=user_id,
+            response_hook=request_charge
+        )
+        return [result.get('resourceBody', message) for result, message in zip(results, messages)]
+
+    def add_conversation(self, conversation: dict):
+        try:
+            return self.container_client.create_item(conversation)
+        except CosmosResourceExistsError:
+            return conversation
 
+    def save_messages(self, user_id, messages: list, request_charge: RequestCharge = None):
+        self.container_client.execute_item_batch(
+            batch_operations=save_messages_batch(messages),
+            partition_key=user_id,
+            response_hook=request_charge
+        )
+        return messages
 
     def get_messages(self, user_id, conversation_id):
         parameters = [
@@ -144,8 +218,7 @@ class CosmosConversationClient():
             }
         ]
         query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
-        messages = list(self.container_client.query_items(query=query, parameters=parameters,
-                                                                     enable_cross_partition_query =True))
+        messages = list(self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id))
         ## if no messages are found, return false
         if len(messages) == 0:
             return []
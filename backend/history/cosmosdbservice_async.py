@@ -5,29 +5,74 @@ from flask import Flask, request
 from azure.identity import DefaultAzureCredential 
 from azure.cosmos.aio import CosmosClient  
 from azure.cosmos import PartitionKey  
+from azure.cosmos.exceptions import CosmosBatchOperationError, CosmosResourceExistsError, CosmosResourceNotFoundError
+from backend.history.utils import (
+    CONVERSATION_IDS_PER_QUERY,
+    DELETE_CONCURRENCY,
+    DELETION_JOB_TYPE,
+    RequestCharge,
+    etag_condition,
+    new_conversation,
+    new_message,
+    create_messages_batch,
+    save_messages_batch,
+    conversations_page_query,
+    document_ids_query,
+    transactional_batches,
+    delete_operations,
+    soft_delete_operations,
+    new_deletion_job
+)
+from backend.history.store import AsyncConversationStore
+from backend.http_client import create_azure_aio_transport
+from backend.settings import AZURE_COSMOSDB_POOL_MAXSIZE
 import asyncio
   
-class CosmosConversationClient():
+class CosmosConversationClient(AsyncConversationStore):
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str,
+                 pool_maxsize: int = AZURE_COSMOSDB_POOL_MAXSIZE):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
-        self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
+        self.pool_maxsize = pool_maxsize
+        self.cosmosdb_client = None
+        self.container_client = None
+        self._start_lock = asyncio.Lock()
 
-    def create_cosmos_client(self):
-        return CosmosClient(self.cosmosdb_endpoint, credential=self.credential)
+    async def start(self):
+        ## one CosmosClient for the process lifetime, so that account metadata, connections and
+        ## tokens are reused by every operation. Binds the client to the running event loop.
+        async with self._start_lock:
+            if self.container_client is None:
+                client = CosmosClient(self.cosmosdb_endpoint, credential=self.credential,
+                                      transport=create_azure_aio_transport(self.pool_maxsize))
+                try:
+                    await client.__aenter__()
+                except Exception:
+                    await client.close()
+                    raise
+                self.cosmosdb_client = client
+                self.container_client = client.get_database_client(self.database_name).get_container_client(self.container_name)
+        return self
+
+    async def close(self):
+        if self.cosmosdb_client is not None:
+            await self.cosmosdb_client.close()
+            self.cosmosdb_client = None
+            self.container_client = None
+
+    async def get_container(self):
+        ## started on first use for callers that don't manage the lifecycle themselves
+        if self.container_client is None:
+            await self.start()
+        return self.container_client
 
     async def ensure(self):
         try:
-            if not self.cosmosdb_client or not self.database_client or not self.container_client:
-                return False
-            
-            async with self.create_cosmos_client() as client:
-                database = client.get_database_client(self.database_name)
-                container = database.get_container_client(self.container_name)
-                container_info = await container.read()
+            container = await self.get_container()
+            container_info = await container.read()
             if not container_info:
                 return False
             
@@ -36,61 +81,111 @@ class CosmosConversationClient():
             return False
 
     async def create_conversation(self, user_id, title = ''):
-        conversation = {
-            'id': str(uuid.uuid4()),  
-            'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
-            'userId': user_id,
-            'title': title
-        }
+        conversation = new_conversation(user_id, title)
         ## TODO: add some error handling based on the output of the upsert_item call
-        async with self.create_cosmos_client() as client:
-            database = client.get_database_client(self.database_name)
-            container = database.get_container_client(self.container_name)
-            resp = await container.upsert_item(conversation)  
+        container = await self.get_container()
+        resp = await container.upsert_item(conversation)  
         if resp:
             return resp
         else:
             return False
     
     async def upsert_conversation(self, conversation):
-        async with self.create_cosmos_client() as client:
-            database = client.get_database_client(self.database_name)
-            container = database.get_container_client(self.container_name)
-            resp = await container.upsert_item(conversation)
+        # conversations read from cosmos carry their _etag, only write them if nobody changed them since
+        container = await self.get_container()
+        resp = await container.upsert_item(conversation, **etag_condition(conversation))
         if resp:
             return resp
         else:
             return False
 
-    async def delete_conversation(self, user_id, conversation_id):
-        async with self.create_cosmos_client() as client:
-            database = client.get_database_client(self.database_name)
-            container = database.get_container_client(self.container_name)
-            conversation = await container.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
-            async with self.create_cosmos_client() as client:
-                database = client.get_database_client(self.database_name)
-                container = database.get_container_client(self.container_name)
-                resp = await container.delete_item(item=conversation_id, partition_key=user_id)
-            return resp
-        else:
+    async def delete_conversation(self, user_id, conversation_id, request_charge: RequestCharge = None):
+        container = await self.get_container()
+        try:
+            await container.delete_item(item=conversation_id, partition_key=user_id, response_hook=request_charge)
+            return True
+        except CosmosResourceNotFoundError:
             return True
 
-        
-    async def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            async with self.create_cosmos_client() as client:
-                database = client.get_database_client(self.database_name)
-                container = database.get_container_client(self.container_name)
-                for message in messages:
-                    resp = await container.delete_item(item=message['id'], partition_key=user_id)
-                    response_list.append(resp)
-            return response_list
+    async def delete_messages(self, conversation_id, user_id, request_charge: RequestCharge = None):
+        ## returns the number of messages deleted
+        container = await self.get_container()
+        message_ids = await self._get_document_ids(container, user_id, conversation_ids=[conversation_id], request_charge=request_charge)
+        return await self._execute_batches(container, user_id, delete_operations(message_ids), request_charge)
+
+    async def mark_conversations_deleted(self, user_id, conversation_ids=None, request_charge: RequestCharge = None):
+        ## hides the conversations, all of the user's when no ids are given; returns the ids marked
+        container = await self.get_container()
+        if conversation_ids is None:
+            conversation_ids = await self._get_document_ids(container, user_id, types=('conversation',), exclude_deleted=True,
+                                                            request_charge=request_charge)
+        await self._execute_batches(container, user_id, soft_delete_operations(conversation_ids), request_charge)
+        return conversation_ids
+
+    async def purge_conversations(self, user_id, conversation_ids: list, request_charge: RequestCharge = None):
+        ## returns the number of conversations and messages deleted; messages go first, so that
+        ## a failure never leaves messages without their conversation
+        container = await self.get_container()
+        deleted_messages = 0
+        for i in range(0, len(conversation_ids), CONVERSATION_IDS_PER_QUERY):
+            message_ids = await self._get_document_ids(container, user_id, conversation_ids=conversation_ids[i:i + CONVERSATION_IDS_PER_QUERY],
+                                                       request_charge=request_charge)
+            deleted_messages += await self._execute_batches(container, user_id, delete_operations(message_ids), request_charge)
+        deleted_conversations = await self._execute_batches(container, user_id, delete_operations(conversation_ids), request_charge)
+        return {'conversations': deleted_conversations, 'messages': deleted_messages}
+
+    async def create_deletion_job(self, user_id, conversation_ids: list):
+        container = await self.get_container()
+        return await container.create_item(new_deletion_job(user_id, conversation_ids))
+
+    async def get_deletion_job(self, user_id, job_id):
+        container = await self.get_container()
+        try:
+            job = await container.read_item(item=job_id, partition_key=user_id)
+        except CosmosResourceNotFoundError:
+            return None
+        if job.get('type') != DELETION_JOB_TYPE:
+            return None
+        return job
+
+    async def update_deletion_job(self, job, **fields):
+        job.update(fields, updatedAt=datetime.utcnow().isoformat())
+        container = await self.get_container()
+        return await container.upsert_item(job, **etag_condition(job))
+
+    async def get_unfinished_deletion_jobs(self):
+        ## the only query across partitions, run once when the app starts
+        query = "SELECT * FROM c WHERE c.type = @type AND (c.status = 'pending' OR c.status = 'running')"
+        container = await self.get_container()
+        results = container.query_items(query=query, parameters=[{'name': '@type', 'value': DELETION_JOB_TYPE}])
+        return [job async for job in results]
+
+    async def _get_document_ids(self, container, user_id, types=('message',), conversation_ids=None, exclude_deleted=False,
+                                request_charge: RequestCharge = None):
+        query, parameters = document_ids_query(user_id, types, conversation_ids, exclude_deleted)
+        results = container.query_items(query=query, parameters=parameters, partition_key=user_id, response_hook=request_charge)
+        return [document_id async for document_id in results]
+
+    async def _execute_batches(self, container, user_id, operations: list, request_charge: RequestCharge = None):
+        ## runs operations on documents of the user's partition in transactional batches, a few
+        ## batches at a time; returns the number of operations applied
+        semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+        async def execute_batch(batch):
+            async with semaphore:
+                while batch:
+                    try:
+                        await container.execute_item_batch(batch_operations=batch, partition_key=user_id,
+                                                           response_hook=request_charge)
+                        return len(batch)
+                    except CosmosBatchOperationError as e:
+                        if e.status_code != 404:
+                            raise
+                        ## a document is already gone and the batch was rolled back, retry without it
+                        batch = batch[:e.error_index] + batch[e.error_index + 1:]
+                return 0
+
+        return sum(await asyncio.gather(*[execute_batch(batch) for batch in transactional_batches(operations)]))
 
 
     async def get_conversations(self, user_id, sort_order = 'DESC'):
@@ -100,15 +195,13 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
-        async with self.create_cosmos_client() as client:
-            database = client.get_database_client(self.database_name)
-            container = database.get_container_client(self.container_name)
-            results =  container.query_items(query=query, parameters=parameters)
+        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' and NOT IS_DEFINED(c.deleted) order by c.updatedAt {sort_order}"
+        container = await self.get_container()
+        results = container.query_items(query=query, parameters=parameters, partition_key=user_id)
 
-            conversations = []
-            async for conversation in results:
-                conversations.append(conversation)
+        conversations = []
+        async for conversation in results:
+            conversations.append(conversation)
 
         ## if no conversations are found, return None
         if len(conversations) == 0:
@@ -116,57 +209,58 @@ class CosmosConversationClient():
         else:
             return conversations
 
+    async def get_conversations_page(self, user_id, page_size, continuation_token=None, sort_order='DESC'):
+        ## one page of the user's conversations within their partition, and the token of the next page
+        query, parameters = conversations_page_query(user_id, sort_order)
+        container = await self.get_container()
+        pages = container.query_items(query=query, parameters=parameters, partition_key=user_id,
+                                      max_item_count=page_size).by_page(continuation_token)
+        try:
+            conversations = [conversation async for conversation in await pages.__anext__()]
+        except StopAsyncIteration:
+            return [], None
+        return conversations, pages.continuation_token
+
     async def get_conversation(self, user_id, conversation_id):
-        parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
-            {
-                'name': '@userId',
-                'value': user_id
-            }
-        ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
-        async with self.create_cosmos_client() as client:
-            database = client.get_database_client(self.database_name)
-            container = database.get_container_client(self.container_name)
-            results = container.query_items(query=query, parameters=parameters)
-            conversations = []
-            async for conversation in results:
-                conversations.append(conversation) 
-            
+        ## point read, id and partition key are known
+        container = await self.get_container()
+        try:
+            conversation = await container.read_item(item=conversation_id, partition_key=user_id)
+        except CosmosResourceNotFoundError:
+            return None
         ## if no conversations are found, return None
-        if len(conversations) == 0:
+        if conversation.get('type') != 'conversation' or conversation.get('deleted'):
             return None
         else:
-            return conversations[0]
- 
-    async def create_message(self, conversation_id, user_id, input_message: dict):
-        message = {
-            'id': str(uuid.uuid4()),
-            'type': 'message',
-            'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
-            'conversationId' : conversation_id,
-            'role': input_message['role'],
-            'content': input_message['content']
-        }
-        async with self.create_cosmos_client() as client:
-            database = client.get_database_client(self.database_name)
-            container = database.get_container_client(self.container_name)
-            resp = await container.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
-            return resp
-        else:
-            return False
-    
+            return conversation
+
+    async def create_messages(self, conversation_id, user_id, input_messages: list, request_charge: RequestCharge = None):
+        messages = [new_message(conversation_id, user_id, input_message) for input_message in input_messages]
+
+        ## one round trip: create the messages and update the parent conversation's updatedAt field
+        container = await self.get_container()
+        results = await container.execute_item_batch(
+            batch_operations=create_messages_batch(messages),
+            partition_key=user_id,
+            response_hook=request_charge
+        )
+        return [result.get('resourceBody', message) for result, message in zip(results, messages)]
+
+    async def add_conversation(self, conversation: dict):
+        container = await self.get_container()
+        try:
+            return await container.create_item(conversation)
+        except CosmosResourceExistsError:
+            return conversation
 
+    async def save_messages(self, user_id, messages: list, request_charge: RequestCharge = None):
+        container = await self.get_container()
+        await container.execute_item_batch(
+            batch_operations=save_messages_batch(messages),
+            partition_key=user_id,
+            response_hook=request_charge
+        )
+        return messages
 
     async def get_messages(self, user_id, conversation_id):
         parameters = [
@@ -180,14 +274,12 @@ class CosmosConversationClient():
             }
         ]
         query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
-        async with self.create_cosmos_client() as client:
-            database = client.get_database_client(self.database_name)
-            container = database.get_container_client(self.container_name)
-            results = container.query_items(query=query, parameters=parameters)
+        container = await self.get_container()
+        results = container.query_items(query=query, parameters=parameters, partition_key=user_id)
         
-            messages = []
-            async for message in results:
-                messages.append(message)
+        messages = []
+        async for message in results:
+            messages.append(message)
            
         ## if no messages are found, return false
         if len(messages) == 0:
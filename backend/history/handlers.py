@@ -0,0 +1,187 @@
+import logging
+
+from backend.auth.auth_utils import get_authenticated_user_details
+from backend.history.utils import CONVERSATIONS_PAGE_SIZE, CONVERSATIONS_MAX_PAGE_SIZE, deletion_job_status
+from backend.settings import TITLE_GENERATOR
+from backend.title_generator import generate_local_title
+from backend.utils import get_placeholder_title
+
+# Request parsing, validation and response shaping of the chat history API. app.py and app_async.py
+# both use these, their routes only differ in how they call the conversation store. Response bodies
+# are dicts or lists, Flask and Quart both send them as JSON.
+
+
+class HistoryRequestError(Exception):
+    """A history request that is answered with the given status instead of a 500."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def history_error(e, route):
+    # Body and status of a failed history request, unexpected errors are logged
+    if not isinstance(e, HistoryRequestError):
+        logging.exception("Exception in %s", route)
+    return {"error": str(e)}, getattr(e, "status", 500)
+
+
+def conversation_not_found(conversation_id):
+    return HistoryRequestError(f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it.", 404)
+
+
+def no_conversations_found(user_id):
+    return HistoryRequestError(f"No conversations for {user_id} were found", 404)
+
+
+def get_user_id(request_headers):
+    return get_authenticated_user_details(request_headers=request_headers)['user_principal_id']
+
+
+def require_store(store):
+    # make sure cosmos is configured
+    if not store:
+        raise Exception("CosmosDB is not configured")
+
+
+def require_conversation_id(request_json):
+    conversation_id = request_json.get("conversation_id", None)
+    if not conversation_id:
+        raise HistoryRequestError("conversation_id is required")
+    return conversation_id
+
+
+def parse_generate_request(request_json):
+    # The conversation to continue, None for a new one, and the user message to store
+    messages = request_json["messages"]
+    if len(messages) == 0 or messages[-1]['role'] != "user":
+        raise Exception("No user message found")
+    return request_json.get("conversation_id", None), messages[-1]
+
+
+def new_conversation_title(messages):
+    # Stored right away, the generated title replaces it unless TITLE_GENERATOR is "local"
+    title = get_placeholder_title(messages)
+    if TITLE_GENERATOR == "local":
+        title = generate_local_title(messages) or title
+    return title
+
+
+def generates_title(conversation):
+    # A generated title is only written for the conversation the request has created
+    return bool(conversation) and TITLE_GENERATOR != "local"
+
+
+def new_history_metadata(conversation_id, conversation=None):
+    # Sent along with the answer, the title and date only for a new conversation
+    history_metadata = {}
+    if conversation:
+        history_metadata['title'] = conversation['title']
+        history_metadata['date'] = conversation['createdAt']
+    history_metadata['conversation_id'] = conversation_id
+    return history_metadata
+
+
+def parse_update_request(request_json):
+    # The conversation and the answer to store: the tool message first, if any, then the assistant message
+    conversation_id = request_json.get("conversation_id", None)
+    if not conversation_id:
+        raise Exception("No conversation_id found")
+
+    messages = request_json["messages"]
+    if len(messages) == 0 or messages[-1]['role'] != "assistant":
+        raise Exception("No bot messages found")
+    new_messages = messages[-2:] if len(messages) > 1 and messages[-2]['role'] == "tool" else messages[-1:]
+    return conversation_id, new_messages
+
+
+def update_response(request_charge=None):
+    # Queued writes have no request charge yet
+    if request_charge is None:
+        return {'success': True, 'queued': True}
+    return {'success': True, 'request_charge': request_charge.total}
+
+
+def parse_page_request(request_args):
+    # Page size and continuation token when the client pages through the conversations, None for all of them
+    page_size = request_args.get("page_size", type=int)
+    continuation_token = request_args.get("continuation_token")
+    if not page_size and not continuation_token:
+        return None
+    return min(max(page_size or CONVERSATIONS_PAGE_SIZE, 1), CONVERSATIONS_MAX_PAGE_SIZE), continuation_token
+
+
+def conversations_page_response(conversations, continuation_token):
+    return {"conversations": conversations, "continuation_token": continuation_token}
+
+
+def conversations_response(user_id, conversations):
+    if not isinstance(conversations, list):
+        raise no_conversations_found(user_id)
+    return conversations
+
+
+def conversation_response(conversation_id, conversation_messages):
+    ## format the messages in the bot frontend format
+    messages = [{'id': msg['id'], 'role': msg['role'], 'content': msg['content'], 'createdAt': msg['createdAt']} for msg in conversation_messages]
+    return {"conversation_id": conversation_id, "messages": messages}
+
+
+def parse_rename_request(request_json):
+    conversation_id = require_conversation_id(request_json)
+    title = request_json.get("title", None)
+    if not title:
+        raise HistoryRequestError("title is required")
+    return conversation_id, title
+
+
+def conversation_deleted_response(conversation_id, job):
+    return {"message": "Successfully deleted conversation and messages", "conversation_id": conversation_id,
+            "job_id": job['id']}
+
+
+def conversations_deleted_response(user_id, job):
+    return {"message": f"Successfully deleted conversation and messages for user {user_id}",
+            "job_id": job['id']}
+
+
+def deletion_job_response(job_id, job):
+    if not job:
+        raise HistoryRequestError(f"Deletion job {job_id} was not found", 404)
+    return deletion_job_status(job)
+
+
+def messages_cleared_response(conversation_id, deleted_messages, request_charge):
+    return {"message": "Successfully deleted messages in conversation", "conversation_id": conversation_id,
+            "deleted_messages": deleted_messages, "request_charge": request_charge.total}
+
+
+def client_has_current(request, etag):
+    # nothing changed since the client last asked, see HISTORY_CACHE_ENABLED
+    return bool(etag) and request.if_none_match.contains(etag)
+
+
+def with_etag(response, etag):
+    # The browser revalidates the history on every use instead of serving it from its cache
+    if etag:
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def answer_messages_to_save(answer_messages):
+    # The tool and assistant messages of a streamed answer, None if there is no answer to store
+    new_messages = [message for message in answer_messages if message['role'] in ("tool", "assistant")]
+    if not new_messages or new_messages[-1]['role'] != "assistant" or not new_messages[-1]['content']:
+        return None
+    return new_messages
+
+
+def title_setter(placeholder, title):
+    # Update of the conversation that writes the generated title
+    def set_title(conversation):
+        # don't overwrite a title the user has changed in the meantime
+        if conversation['title'] != placeholder:
+            return False
+        conversation['title'] = title
+    return set_title
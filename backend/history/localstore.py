@@ -0,0 +1,309 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceNotFoundError
+
+from backend.history.store import AsyncConversationStore, ConversationStore
+from backend.history.utils import (
+    DELETION_JOB_TYPE,
+    RequestCharge,
+    new_conversation,
+    new_message,
+    new_deletion_job
+)
+from backend.settings import CONVERSATION_STORE, CONVERSATION_STORE_SQLITE_PATH
+
+# Fields of the conversations returned by get_conversations_page, as projected by the Cosmos query
+CONVERSATION_PAGE_FIELDS = ('id', 'title', 'createdAt', 'updatedAt')
+
+
+def _expired(document):
+    # documents with a ttl expire like in a container with a default time to live
+    return document.get('ttl', -1) > 0 and document['_ts'] + document['ttl'] <= time.time()
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Local stand-in for CosmosConversationClient, for development, load tests and benchmarks.
+
+    Documents are kept as JSON in one SQLite table keyed by (user id, document id), the
+    partition key and id of the Cosmos container. Queries are scoped to one user, results come
+    in the same order as from Cosmos DB and writes maintain _etag for optimistic concurrency.
+    path=":memory:" keeps the history in memory for the lifetime of the process. No request
+    units are reported.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        # one connection shared by all threads, an in-memory database only exists within it
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents (user_id TEXT NOT NULL, id TEXT NOT NULL, type TEXT, "
+                "conversation_id TEXT, updated_at TEXT, deleted INTEGER NOT NULL DEFAULT 0, body TEXT NOT NULL, "
+                "UNIQUE (user_id, id))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS documents_conversations ON documents (user_id, type, deleted, updated_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS documents_messages ON documents (user_id, conversation_id)")
+
+    def _read(self, user_id, document_id):
+        row = self._conn.execute("SELECT body FROM documents WHERE user_id = ? AND id = ?", (user_id, document_id)).fetchone()
+        document = None if row is None else json.loads(row[0])
+        if document is not None and _expired(document):
+            self._delete(user_id, [document_id])
+            return None
+        return document
+
+    def _write(self, document, etag=None):
+        # like an upsert with an IfNotModified condition when etag is given; callers hold the lock
+        if etag is not None:
+            current = self._read(document['userId'], document['id'])
+            if current is None or current.get('_etag') != etag:
+                raise CosmosAccessConditionFailedError(status_code=412, message="The document was modified concurrently")
+        document = dict(document, _etag=f'"{uuid.uuid4()}"', _ts=int(time.time()))
+        self._conn.execute(
+            "INSERT INTO documents (user_id, id, type, conversation_id, updated_at, deleted, body) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (user_id, id) DO UPDATE SET type = excluded.type, conversation_id = excluded.conversation_id, "
+            "updated_at = excluded.updated_at, deleted = excluded.deleted, body = excluded.body",
+            (document['userId'], document['id'], document.get('type'), document.get('conversationId'),
+             document.get('updatedAt'), int(bool(document.get('deleted'))), json.dumps(document))
+        )
+        return document
+
+    def _delete(self, user_id, document_ids):
+        deleted = 0
+        for document_id in document_ids:
+            deleted += self._conn.execute("DELETE FROM documents WHERE user_id = ? AND id = ?", (user_id, document_id)).rowcount
+        return deleted
+
+    def _conversation_rows(self, user_id, sort_order, limit=-1, offset=0):
+        if sort_order not in ('ASC', 'DESC'):
+            raise ValueError(f"Invalid sort order '{sort_order}', expected ASC or DESC")
+        return self._conn.execute(
+            "SELECT body FROM documents WHERE user_id = ? AND type = 'conversation' AND deleted = 0 "
+            f"ORDER BY updated_at {sort_order} LIMIT ? OFFSET ?",
+            (user_id, limit, offset)
+        ).fetchall()
+
+    def ensure(self):
+        try:
+            with self._lock:
+                self._conn.execute("SELECT 1 FROM documents LIMIT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def create_conversation(self, user_id, title = ''):
+        with self._lock:
+            return self._write(new_conversation(user_id, title))
+
+    def upsert_conversation(self, conversation):
+        with self._lock:
+            return self._write(conversation, etag=conversation.get('_etag'))
+
+    def get_conversation(self, user_id, conversation_id):
+        with self._lock:
+            conversation = self._read(user_id, conversation_id)
+        if not conversation or conversation.get('type') != 'conversation' or conversation.get('deleted'):
+            return None
+        return conversation
+
+    def get_conversations(self, user_id, sort_order = 'DESC'):
+        with self._lock:
+            rows = self._conversation_rows(user_id, sort_order)
+        return [json.loads(body) for body, in rows]
+
+    def get_conversations_page(self, user_id, page_size, continuation_token=None, sort_order='DESC'):
+        ## the continuation token is the offset of the next page
+        offset = int(continuation_token or 0)
+        with self._lock:
+            rows = self._conversation_rows(user_id, sort_order, limit=page_size + 1, offset=offset)
+        conversations = [json.loads(body) for body, in rows[:page_size]]
+        conversations = [{field: conversation.get(field) for field in CONVERSATION_PAGE_FIELDS} for conversation in conversations]
+        return conversations, str(offset + page_size) if len(rows) > page_size else None
+
+    def delete_conversation(self, user_id, conversation_id, request_charge: RequestCharge = None):
+        with self._lock:
+            self._delete(user_id, [conversation_id])
+        return True
+
+    def mark_conversations_deleted(self, user_id, conversation_ids=None, request_charge: RequestCharge = None):
+        with self._lock:
+            if conversation_ids is None:
+                conversation_ids = [row[0] for row in self._conn.execute(
+                    "SELECT id FROM documents WHERE user_id = ? AND type = 'conversation' AND deleted = 0", (user_id,))]
+            self._conn.execute("BEGIN")
+            try:
+                for conversation_id in conversation_ids:
+                    conversation = self._read(user_id, conversation_id)
+                    if conversation is not None:
+                        self._write(dict(conversation, deleted=True))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return conversation_ids
+
+    def purge_conversations(self, user_id, conversation_ids: list, request_charge: RequestCharge = None):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                deleted_messages = 0
+                for conversation_id in conversation_ids:
+                    deleted_messages += self._conn.execute(
+                        "DELETE FROM documents WHERE user_id = ? AND conversation_id = ? AND type = 'message'",
+                        (user_id, conversation_id)
+                    ).rowcount
+                deleted_conversations = self._delete(user_id, conversation_ids)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return {'conversations': deleted_conversations, 'messages': deleted_messages}
+
+    def create_messages(self, conversation_id, user_id, input_messages: list, request_charge: RequestCharge = None):
+        messages = [new_message(conversation_id, user_id, input_message) for input_message in input_messages]
+        return self.save_messages(user_id, messages, request_charge)
+
+    def add_conversation(self, conversation: dict):
+        with self._lock:
+            current = self._read(conversation['userId'], conversation['id'])
+            return current if current is not None else self._write(conversation)
+
+    def save_messages(self, user_id, messages: list, request_charge: RequestCharge = None):
+        ## like the Cosmos transactional batch: all messages and the conversation's updatedAt, or nothing
+        conversation_id = messages[-1]['conversationId']
+        with self._lock:
+            conversation = self._read(user_id, conversation_id)
+            if conversation is None:
+                raise CosmosResourceNotFoundError(status_code=404, message=f"Conversation {conversation_id} was not found")
+            self._conn.execute("BEGIN")
+            try:
+                messages = [self._write(message) for message in messages]
+                self._write(dict(conversation, updatedAt=messages[-1]['createdAt']))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return messages
+
+    def get_messages(self, user_id, conversation_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT body FROM documents WHERE user_id = ? AND conversation_id = ? AND type = 'message' ORDER BY rowid",
+                (user_id, conversation_id)
+            ).fetchall()
+        return [json.loads(body) for body, in rows]
+
+    def delete_messages(self, conversation_id, user_id, request_charge: RequestCharge = None):
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM documents WHERE user_id = ? AND conversation_id = ? AND type = 'message'",
+                (user_id, conversation_id)
+            ).rowcount
+
+    def create_deletion_job(self, user_id, conversation_ids: list):
+        with self._lock:
+            return self._write(new_deletion_job(user_id, conversation_ids))
+
+    def get_deletion_job(self, user_id, job_id):
+        with self._lock:
+            job = self._read(user_id, job_id)
+        if not job or job.get('type') != DELETION_JOB_TYPE:
+            return None
+        return job
+
+    def update_deletion_job(self, job, **fields):
+        job.update(fields, updatedAt=datetime.utcnow().isoformat())
+        with self._lock:
+            return self._write(job, etag=job.get('_etag'))
+
+    def get_unfinished_deletion_jobs(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT body FROM documents WHERE type = ?", (DELETION_JOB_TYPE,)).fetchall()
+            jobs = [json.loads(row[0]) for row in rows]
+            expired = [job for job in jobs if _expired(job)]
+            for job in expired:
+                self._delete(job['userId'], [job['id']])
+        return [job for job in jobs if job['status'] in ('pending', 'running') and job not in expired]
+
+
+class AsyncSQLiteConversationStore(AsyncConversationStore):
+    """Async interface to a SQLiteConversationStore.
+
+    Calls run in the default thread pool: the store serializes them on one connection, and a
+    file that another process writes to may keep a call waiting for the busy timeout.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.store = SQLiteConversationStore(path)
+
+    async def ensure(self):
+        return await asyncio.to_thread(self.store.ensure)
+
+    async def create_conversation(self, user_id, title = ''):
+        return await asyncio.to_thread(self.store.create_conversation, user_id, title)
+
+    async def upsert_conversation(self, conversation):
+        return await asyncio.to_thread(self.store.upsert_conversation, conversation)
+
+    async def get_conversation(self, user_id, conversation_id):
+        return await asyncio.to_thread(self.store.get_conversation, user_id, conversation_id)
+
+    async def get_conversations(self, user_id, sort_order = 'DESC'):
+        return await asyncio.to_thread(self.store.get_conversations, user_id, sort_order)
+
+    async def get_conversations_page(self, user_id, page_size, continuation_token=None, sort_order='DESC'):
+        return await asyncio.to_thread(self.store.get_conversations_page, user_id, page_size, continuation_token, sort_order)
+
+    async def delete_conversation(self, user_id, conversation_id, request_charge: RequestCharge = None):
+        return await asyncio.to_thread(self.store.delete_conversation, user_id, conversation_id, request_charge)
+
+    async def mark_conversations_deleted(self, user_id, conversation_ids=None, request_charge: RequestCharge = None):
+        return await asyncio.to_thread(self.store.mark_conversations_deleted, user_id, conversation_ids, request_charge)
+
+    async def purge_conversations(self, user_id, conversation_ids: list, request_charge: RequestCharge = None):
+        return await asyncio.to_thread(self.store.purge_conversations, user_id, conversation_ids, request_charge)
+
+    async def create_messages(self, conversation_id, user_id, input_messages: list, request_charge: RequestCharge = None):
+        return await asyncio.to_thread(self.store.create_messages, conversation_id, user_id, input_messages, request_charge)
+
+    async def add_conversation(self, conversation: dict):
+        return await asyncio.to_thread(self.store.add_conversation, conversation)
+
+    async def save_messages(self, user_id, messages: list, request_charge: RequestCharge = None):
+        return await asyncio.to_thread(self.store.save_messages, user_id, messages, request_charge)
+
+    async def get_messages(self, user_id, conversation_id):
+        return await asyncio.to_thread(self.store.get_messages, user_id, conversation_id)
+
+    async def delete_messages(self, conversation_id, user_id, request_charge: RequestCharge = None):
+        return await asyncio.to_thread(self.store.delete_messages, conversation_id, user_id, request_charge)
+
+    async def create_deletion_job(self, user_id, conversation_ids: list):
+        return await asyncio.to_thread(self.store.create_deletion_job, user_id, conversation_ids)
+
+    async def get_deletion_job(self, user_id, job_id):
+        return await asyncio.to_thread(self.store.get_deletion_job, user_id, job_id)
+
+    async def update_deletion_job(self, job, **fields):
+        return await asyncio.to_thread(self.store.update_deletion_job, job, **fields)
+
+    async def get_unfinished_deletion_jobs(self):
+        return await asyncio.to_thread(self.store.get_unfinished_deletion_jobs)
+
+
+def create_local_store(store: str = CONVERSATION_STORE, path: str = CONVERSATION_STORE_SQLITE_PATH, asynchronous: bool = False):
+    # The local conversation store selected by CONVERSATION_STORE, None when the history is kept in CosmosDB
+    if store == "cosmos":
+        return None
+    path = ":memory:" if store == "memory" else path
+    return AsyncSQLiteConversationStore(path) if asynchronous else SQLiteConversationStore(path)
@@ -0,0 +1,265 @@
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError
+
+from backend.history.utils import (
+    CONCURRENCY_RETRIES,
+    DELETION_JOB_PROGRESS_EVERY,
+    RequestCharge,
+    deletion_job_wait,
+    finished_deletion_job_fields
+)
+
+
+class ConversationStore():
+    """Chat history: conversations, their messages and deletion jobs, partitioned by user id.
+
+    Implemented by CosmosConversationClient and by SQLiteConversationStore, a local stand-in.
+    Documents have the same shape in every store. Writes of documents read from the store
+    fail with CosmosAccessConditionFailedError when the document changed in the meantime.
+    """
+
+    def ensure(self):
+        raise NotImplementedError
+
+    def create_conversation(self, user_id, title = ''):
+        raise NotImplementedError
+
+    def upsert_conversation(self, conversation):
+        raise NotImplementedError
+
+    def get_conversation(self, user_id, conversation_id):
+        raise NotImplementedError
+
+    def get_conversations(self, user_id, sort_order = 'DESC'):
+        raise NotImplementedError
+
+    def get_conversations_page(self, user_id, page_size, continuation_token=None, sort_order='DESC'):
+        raise NotImplementedError
+
+    def delete_conversation(self, user_id, conversation_id, request_charge: RequestCharge = None):
+        raise NotImplementedError
+
+    def mark_conversations_deleted(self, user_id, conversation_ids=None, request_charge: RequestCharge = None):
+        raise NotImplementedError
+
+    def purge_conversations(self, user_id, conversation_ids: list, request_charge: RequestCharge = None):
+        raise NotImplementedError
+
+    def create_messages(self, conversation_id, user_id, input_messages: list, request_charge: RequestCharge = None):
+        raise NotImplementedError
+
+    def add_conversation(self, conversation: dict):
+        ## writes a conversation document built by the caller, unless it exists already
+        raise NotImplementedError
+
+    def save_messages(self, user_id, messages: list, request_charge: RequestCharge = None):
+        ## writes complete message documents in one atomic operation that can be repeated
+        raise NotImplementedError
+
+    def get_messages(self, user_id, conversation_id):
+        raise NotImplementedError
+
+    def delete_messages(self, conversation_id, user_id, request_charge: RequestCharge = None):
+        raise NotImplementedError
+
+    def create_deletion_job(self, user_id, conversation_ids: list):
+        raise NotImplementedError
+
+    def get_deletion_job(self, user_id, job_id):
+        raise NotImplementedError
+
+    def update_deletion_job(self, job, **fields):
+        ## fails with CosmosAccessConditionFailedError when the job changed since it was read
+        raise NotImplementedError
+
+    def get_unfinished_deletion_jobs(self):
+        ## pending and running deletion jobs of all users, to resume them in a new process
+        raise NotImplementedError
+
+    def conversations_etag(self, user_id):
+        ## version of the user's conversation lists, None when the store can't tell without reading them
+        return None
+
+    def conversation_etag(self, user_id, conversation_id):
+        ## version of a conversation and its messages, see conversations_etag
+        return None
+
+    def update_conversation(self, user_id, conversation_id, update):
+        ## read-modify-write with optimistic concurrency, update(conversation) returns False to skip the write
+        for attempt in range(CONCURRENCY_RETRIES):
+            conversation = self.get_conversation(user_id, conversation_id)
+            if not conversation or update(conversation) is False:
+                return conversation
+            try:
+                return self.upsert_conversation(conversation)
+            except CosmosAccessConditionFailedError:
+                if attempt == CONCURRENCY_RETRIES - 1:
+                    raise
+
+    def rename_conversation(self, user_id, conversation_id, title):
+        def set_title(conversation):
+            conversation['title'] = title
+        return self.update_conversation(user_id, conversation_id, set_title)
+
+    def create_message(self, conversation_id, user_id, input_message: dict, request_charge: RequestCharge = None):
+        return self.create_messages(conversation_id, user_id, [input_message], request_charge)[0]
+
+    def run_deletion_job(self, user_id, job_id):
+        ## purges the conversations of a pending job and records the outcome on the job
+        job = self.get_deletion_job(user_id, job_id)
+        if not job or deletion_job_wait(job) != 0:
+            return job
+        try:
+            ## only one worker takes the job, the others fail the etag condition
+            job = self.update_deletion_job(job, status='running')
+        except CosmosAccessConditionFailedError:
+            return self.get_deletion_job(user_id, job_id)
+        request_charge = RequestCharge()
+        conversation_ids = job['conversationIds']
+        deleted = {'conversations': 0, 'messages': 0}
+        try:
+            for i in range(0, len(conversation_ids), DELETION_JOB_PROGRESS_EVERY):
+                if i:
+                    try:
+                        ## the progress refreshes updatedAt, a job that keeps it fresh isn't taken over
+                        job = self.update_deletion_job(job, deletedConversations=deleted['conversations'],
+                                                       deletedMessages=deleted['messages'])
+                    except CosmosAccessConditionFailedError:
+                        ## another worker took the job over, it finishes the purge
+                        return self.get_deletion_job(user_id, job_id)
+                purged = self.purge_conversations(user_id, conversation_ids[i:i + DELETION_JOB_PROGRESS_EVERY], request_charge)
+                deleted = {key: deleted[key] + purged[key] for key in deleted}
+        except Exception as e:
+            self.update_deletion_job(job, status='failed', error=str(e), requestCharge=request_charge.total,
+                                     **finished_deletion_job_fields())
+            raise
+        return self.update_deletion_job(job, status='succeeded', deletedConversations=deleted['conversations'],
+                                        deletedMessages=deleted['messages'], requestCharge=request_charge.total,
+                                        **finished_deletion_job_fields())
+
+
+class AsyncConversationStore():
+    """Async counterpart of ConversationStore, see there.
+
+    start() and close() bracket the lifetime of the store in a serving event loop.
+    """
+
+    async def start(self):
+        return self
+
+    async def close(self):
+        pass
+
+    async def ensure(self):
+        raise NotImplementedError
+
+    async def create_conversation(self, user_id, title = ''):
+        raise NotImplementedError
+
+    async def upsert_conversation(self, conversation):
+        raise NotImplementedError
+
+    async def get_conversation(self, user_id, conversation_id):
+        raise NotImplementedError
+
+    async def get_conversations(self, user_id, sort_order = 'DESC'):
+        raise NotImplementedError
+
+    async def get_conversations_page(self, user_id, page_size, continuation_token=None, sort_order='DESC'):
+        raise NotImplementedError
+
+    async def delete_conversation(self, user_id, conversation_id, request_charge: RequestCharge = None):
+        raise NotImplementedError
+
+    async def mark_conversations_deleted(self, user_id, conversation_ids=None, request_charge: RequestCharge = None):
+        raise NotImplementedError
+
+    async def purge_conversations(self, user_id, conversation_ids: list, request_charge: RequestCharge = None):
+        raise NotImplementedError
+
+    async def create_messages(self, conversation_id, user_id, input_messages: list, request_charge: RequestCharge = None):
+        raise NotImplementedError
+
+    async def add_conversation(self, conversation: dict):
+        ## writes a conversation document built by the caller, unless it exists already
+        raise NotImplementedError
+
+    async def save_messages(self, user_id, messages: list, request_charge: RequestCharge = None):
+        ## writes complete message documents in one atomic operation that can be repeated
+        raise NotImplementedError
+
+    async def get_messages(self, user_id, conversation_id):
+        raise NotImplementedError
+
+    async def delete_messages(self, conversation_id, user_id, request_charge: RequestCharge = None):
+        raise NotImplementedError
+
+    async def create_deletion_job(self, user_id, conversation_ids: list):
+        raise NotImplementedError
+
+    async def get_deletion_job(self, user_id, job_id):
+        raise NotImplementedError
+
+    async def update_deletion_job(self, job, **fields):
+        raise NotImplementedError
+
+    async def get_unfinished_deletion_jobs(self):
+        raise NotImplementedError
+
+    async def conversations_etag(self, user_id):
+        return None
+
+    async def conversation_etag(self, user_id, conversation_id):
+        return None
+
+    async def update_conversation(self, user_id, conversation_id, update):
+        ## read-modify-write with optimistic concurrency, update(conversation) returns False to skip the write
+        for attempt in range(CONCURRENCY_RETRIES):
+            conversation = await self.get_conversation(user_id, conversation_id)
+            if not conversation or update(conversation) is False:
+                return conversation
+            try:
+                return await self.upsert_conversation(conversation)
+            except CosmosAccessConditionFailedError:
+                if attempt == CONCURRENCY_RETRIES - 1:
+                    raise
+
+    async def rename_conversation(self, user_id, conversation_id, title):
+        def set_title(conversation):
+            conversation['title'] = title
+        return await self.update_conversation(user_id, conversation_id, set_title)
+
+    async def create_message(self, conversation_id, user_id, input_message: dict, request_charge: RequestCharge = None):
+        return (await self.create_messages(conversation_id, user_id, [input_message], request_charge))[0]
+
+    async def run_deletion_job(self, user_id, job_id):
+        ## purges the conversations of a pending job and records the outcome on the job
+        job = await self.get_deletion_job(user_id, job_id)
+        if not job or deletion_job_wait(job) != 0:
+            return job
+        try:
+            ## only one worker takes the job, the others fail the etag condition
+            job = await self.update_deletion_job(job, status='running')
+        except CosmosAccessConditionFailedError:
+            return await self.get_deletion_job(user_id, job_id)
+        request_charge = RequestCharge()
+        conversation_ids = job['conversationIds']
+        deleted = {'conversations': 0, 'messages': 0}
+        try:
+            for i in range(0, len(conversation_ids), DELETION_JOB_PROGRESS_EVERY):
+                if i:
+                    try:
+                        ## the progress refreshes updatedAt, a job that keeps it fresh isn't taken over
+                        job = await self.update_deletion_job(job, deletedConversations=deleted['conversations'],
+                                                             deletedMessages=deleted['messages'])
+                    except CosmosAccessConditionFailedError:
+                        ## another worker took the job over, it finishes the purge
+                        return await self.get_deletion_job(user_id, job_id)
+                purged = await self.purge_conversations(user_id, conversation_ids[i:i + DELETION_JOB_PROGRESS_EVERY], request_charge)
+                deleted = {key: deleted[key] + purged[key] for key in deleted}
+        except Exception as e:
+            await self.update_deletion_job(job, status='failed', error=str(e), requestCharge=request_charge.total,
+                                           **finished_deletion_job_fields())
+            raise
+        return await self.update_deletion_job(job, status='succeeded', deletedConversations=deleted['conversations'],
+                                              deletedMessages=deleted['messages'], requestCharge=request_charge.total,
+                                              **finished_deletion_job_fields())
@@ -0,0 +1,173 @@
+import threading
+import uuid
+from datetime import datetime
+from azure.core import MatchConditions
+
+from backend.settings import DELETION_JOB_TTL
+
+# Attempts of a read-modify-write before a concurrent change is reported
+CONCURRENCY_RETRIES = 3
+
+# Cosmos DB accepts at most 100 operations in one transactional batch
+TRANSACTIONAL_BATCH_LIMIT = 100
+# Batches of one bulk delete that are in flight at the same time
+DELETE_CONCURRENCY = 4
+# Conversation ids passed to one query, keeps the query text well below the service limit
+CONVERSATION_IDS_PER_QUERY = 1000
+
+DELETION_JOB_TYPE = 'deletionJob'
+# Seconds without an update after which a running deletion job is taken over, its worker is assumed gone
+DELETION_JOB_STALE_AFTER = 600
+# Conversations a running deletion job purges between updates of its progress, which also keep it
+# from looking stale
+DELETION_JOB_PROGRESS_EVERY = 100
+
+# Conversations per page of /history/list when the client pages through them
+CONVERSATIONS_PAGE_SIZE = 50
+CONVERSATIONS_MAX_PAGE_SIZE = 200
+
+
+class RequestCharge():
+    """Adds up the request units (RU) of the Cosmos DB calls it is passed to as response_hook."""
+
+    def __init__(self):
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, headers, *args):
+        # bulk deletes call the hook from several threads
+        with self._lock:
+            self.total += float(headers.get("x-ms-request-charge", 0) or 0)
+
+
+def etag_condition(document: dict):
+    # Keyword arguments that make a write fail with 412 if the document changed since it was read
+    if document.get('_etag'):
+        return {'etag': document['_etag'], 'match_condition': MatchConditions.IfNotModified}
+    return {}
+
+
+def new_conversation(user_id, title = ''):
+    now = datetime.utcnow().isoformat()
+    return {
+        'id': str(uuid.uuid4()),
+        'type': 'conversation',
+        'createdAt': now,
+        'updatedAt': now,
+        'userId': user_id,
+        'title': title
+    }
+
+
+def new_message(conversation_id, user_id, input_message: dict):
+    now = datetime.utcnow().isoformat()
+    return {
+        'id': str(uuid.uuid4()),
+        'type': 'message',
+        'userId' : user_id,
+        'createdAt': now,
+        'updatedAt': now,
+        'conversationId' : conversation_id,
+        'role': input_message['role'],
+        'content': input_message['content']
+    }
+
+
+def create_messages_batch(messages: list):
+    # Insert the messages and bump the parent conversation's updatedAt in one transactional
+    # batch; all documents live in the user's partition. Fails as a whole if the
+    # conversation doesn't exist.
+    operations = [("create", (message,)) for message in messages]
+    operations.append(("patch", (messages[-1]['conversationId'], [{"op": "set", "path": "/updatedAt", "value": messages[-1]['createdAt']}])))
+    return operations
+
+
+def save_messages_batch(messages: list):
+    # Like create_messages_batch, with upserts so that the batch can be replayed, e.g. from the
+    # write-behind spool
+    operations = [("upsert", (message,)) for message in messages]
+    operations.append(("patch", (messages[-1]['conversationId'], [{"op": "set", "path": "/updatedAt", "value": messages[-1]['createdAt']}])))
+    return operations
+
+
+def conversations_page_query(user_id, sort_order='DESC'):
+    # Only the fields the history list shows, the messages are read when a conversation is opened
+    if sort_order not in ('ASC', 'DESC'):
+        raise ValueError(f"Invalid sort order '{sort_order}', expected ASC or DESC")
+    query = ("SELECT c.id, c.title, c.createdAt, c.updatedAt FROM c WHERE c.userId = @userId AND c.type='conversation' "
+             f"AND NOT IS_DEFINED(c.deleted) ORDER BY c.updatedAt {sort_order}")
+    return query, [{'name': '@userId', 'value': user_id}]
+
+
+def document_ids_query(user_id, types=('message',), conversation_ids=None, exclude_deleted=False):
+    # Only the ids of the user's documents, the query stays within the user's partition
+    query = "SELECT VALUE c.id FROM c WHERE c.userId = @userId AND ARRAY_CONTAINS(@types, c.type)"
+    parameters = [{'name': '@userId', 'value': user_id}, {'name': '@types', 'value': list(types)}]
+    if conversation_ids is not None:
+        query += " AND ARRAY_CONTAINS(@conversationIds, c.conversationId)"
+        parameters.append({'name': '@conversationIds', 'value': list(conversation_ids)})
+    if exclude_deleted:
+        query += " AND NOT IS_DEFINED(c.deleted)"
+    return query, parameters
+
+
+def transactional_batches(operations: list):
+    # Operations on documents of one partition, split into batches the service accepts
+    return [operations[i:i + TRANSACTIONAL_BATCH_LIMIT] for i in range(0, len(operations), TRANSACTIONAL_BATCH_LIMIT)]
+
+
+def delete_operations(document_ids: list):
+    return [("delete", (document_id,)) for document_id in document_ids]
+
+
+def soft_delete_operations(conversation_ids: list):
+    # Deleted conversations are hidden from the user right away and purged by a deletion job
+    return [("patch", (conversation_id, [{"op": "set", "path": "/deleted", "value": True}])) for conversation_id in conversation_ids]
+
+
+def new_deletion_job(user_id, conversation_ids: list):
+    now = datetime.utcnow().isoformat()
+    return {
+        'id': str(uuid.uuid4()),
+        'type': DELETION_JOB_TYPE,
+        'userId': user_id,
+        'createdAt': now,
+        'updatedAt': now,
+        'status': 'pending',
+        'conversationIds': conversation_ids,
+        'deletedConversations': 0,
+        'deletedMessages': 0,
+        'requestCharge': 0.0,
+        'error': None
+    }
+
+
+def deletion_job_wait(job: dict):
+    # Seconds until a worker may run the job: pending jobs right away, running jobs once they are
+    # stale; None for finished jobs
+    if job['status'] == 'pending':
+        return 0
+    if job['status'] == 'running':
+        age = (datetime.utcnow() - datetime.fromisoformat(job['updatedAt'])).total_seconds()
+        return max(0, DELETION_JOB_STALE_AFTER - age)
+    return None
+
+
+def finished_deletion_job_fields():
+    # Finished jobs expire, this needs a default time to live (-1 is enough) on the container
+    return {'ttl': DELETION_JOB_TTL} if DELETION_JOB_TTL > 0 else {}
+
+
+def deletion_job_status(job: dict):
+    # What the status endpoint reports about a deletion job
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'conversations': len(job['conversationIds']),
+        'deleted_conversations': job['deletedConversations'],
+        'deleted_messages': job['deletedMessages'],
+        'request_charge': job['requestCharge'],
+        'error': job['error'],
+        'createdAt': job['createdAt'],
+        'updatedAt': job['updatedAt']
+    }
@@ -0,0 +1,429 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.history.utils import TRANSACTIONAL_BATCH_LIMIT, new_message
+from backend.settings import HISTORY_SPOOL_DIR, HISTORY_WRITE_RETRIES, HISTORY_WRITE_FLUSH_INTERVAL
+
+try:
+    import fcntl
+except ImportError:  # Windows, spool files of other processes can't be told apart from live ones
+    fcntl = None
+
+# Messages written in one batch, the batch also patches the conversation's updatedAt
+WRITE_BATCH_MESSAGES = TRANSACTIONAL_BATCH_LIMIT - 1
+# Conversations flushed at the same time
+WRITE_CONCURRENCY = 4
+# Backoff between attempts of a failed write, in seconds
+WRITE_RETRY_BACKOFF = 0.2
+WRITE_RETRY_MAX_BACKOFF = 30
+
+FAILED_WRITES_FILE = "failed.jsonl"
+
+
+class HistorySpool():
+    """Append-only journal of the queued writes of one process.
+
+    Every write is fsync'ed before the request is answered and acknowledged once it is stored.
+    The file is emptied whenever nothing is pending. Spool files left behind by a crashed
+    process are adopted by recover(); each process holds a lock on its own file so that live
+    ones are left alone. Stored writes are upserts, replaying one twice is harmless.
+    """
+
+    def __init__(self, directory: str = HISTORY_SPOOL_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"spool-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl")
+        self._file = open(self.path, "a", encoding="utf-8")
+        if fcntl:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def _write(self, entries, sync):
+        self._file.write("".join(json.dumps(entry) + "\n" for entry in entries))
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def append(self, records: list):
+        with self._lock:
+            self._write([{"op": "write", "record": record} for record in records], sync=True)
+            self._pending += len(records)
+
+    def ack(self, record_ids: list):
+        with self._lock:
+            self._pending -= len(record_ids)
+            if self._pending <= 0:
+                self._pending = 0
+                self._file.seek(0)
+                self._file.truncate()
+            else:
+                self._write([{"op": "ack", "id": record_id} for record_id in record_ids], sync=False)
+
+    def dead_letter(self, record: dict, error: str):
+        with open(os.path.join(self.directory, FAILED_WRITES_FILE), "a", encoding="utf-8") as f:
+            f.write(json.dumps(dict(record, error=error)) + "\n")
+
+    def recover(self):
+        ## the pending writes of spool files no process holds, in the order they were queued
+        if not fcntl:
+            return []
+        records = []
+        for path in sorted(glob.glob(os.path.join(self.directory, "spool-*.jsonl"))):
+            if path == self.path:
+                continue
+            try:
+                f = open(path, "r+", encoding="utf-8")
+            except OSError:
+                continue
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                pending = {}
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the process died while writing this line, its request was never answered
+                        continue
+                    if entry.get("op") == "write":
+                        pending[entry["record"]["id"]] = entry["record"]
+                    elif entry.get("op") == "ack":
+                        pending.pop(entry["id"], None)
+                if pending:
+                    self.append(list(pending.values()))
+                    records.extend(pending.values())
+                os.remove(path)
+        if records:
+            logging.warning("Recovered %d queued chat history writes from %s", len(records), self.directory)
+        return records
+
+    def close(self):
+        with self._lock:
+            empty = self._pending == 0
+            self._file.close()
+        if empty:
+            os.remove(self.path)
+
+
+class _WriteBehindState():
+    # Bookkeeping shared by WriteBehindQueue and AsyncWriteBehindQueue, callers hold the lock
+
+    def __init__(self, spool_dir: str, retries: int):
+        self.spool_dir = spool_dir
+        self.retries = retries
+        self.spool = None
+        self._records = {}
+        self._flushing = set()
+        self._counters = {"flushed": 0, "failed": 0, "retries": 0}
+
+    def _open_spool(self):
+        ## fresh bookkeeping in the process that serves the writes
+        self.spool = HistorySpool(self.spool_dir)
+        self._records = {}
+        self._flushing = set()
+        self._counters = {"flushed": 0, "failed": 0, "retries": 0}
+
+    def _new_record(self, conversation_id, user_id, input_messages, conversation):
+        return {
+            "id": uuid.uuid4().hex,
+            "userId": user_id,
+            "conversationId": conversation_id,
+            "conversation": conversation,
+            "messages": [new_message(conversation_id, user_id, input_message) for input_message in input_messages],
+            "attempts": 0,
+            "notBefore": 0,
+            "queuedAt": time.time(),
+        }
+
+    def _add(self, records):
+        for record in records:
+            self._records[record["id"]] = record
+
+    def _is_pending(self, user_id, conversation_id=None):
+        return any(record["userId"] == user_id and conversation_id in (None, record["conversationId"])
+                   for record in self._records.values())
+
+    def _heads(self):
+        ## the first queued write of each conversation that isn't being flushed
+        heads = {}
+        for record in self._records.values():
+            key = (record["userId"], record["conversationId"])
+            if key not in self._flushing:
+                heads.setdefault(key, record)
+        return heads.values()
+
+    def _take(self, now):
+        ## the writes to flush, grouped by conversation; a conversation's writes are stored in
+        ## the order they were queued, so one that waits for a retry holds back the later ones
+        groups = {}
+        closed = set(self._flushing)
+        for record in self._records.values():
+            key = (record["userId"], record["conversationId"])
+            if key in closed:
+                continue
+            group = groups.setdefault(key, [])
+            if (not group and record["notBefore"] > now) or \
+                    (group and sum(len(r["messages"]) for r in group) + len(record["messages"]) > WRITE_BATCH_MESSAGES):
+                closed.add(key)
+                continue
+            group.append(record)
+        groups = [group for group in groups.values() if group]
+        for group in groups:
+            self._flushing.add((group[0]["userId"], group[0]["conversationId"]))
+        return groups
+
+    def _next_attempt(self):
+        return min((record["notBefore"] for record in self._heads()), default=None)
+
+    def _is_due(self, now):
+        next_attempt = self._next_attempt()
+        return next_attempt is not None and next_attempt <= now
+
+    def _complete(self, group):
+        self._flushing.discard((group[0]["userId"], group[0]["conversationId"]))
+        for record in group:
+            del self._records[record["id"]]
+        self._counters["flushed"] += sum(len(record["messages"]) for record in group)
+        self.spool.ack([record["id"] for record in group])
+
+    def _fail(self, group, error):
+        self._flushing.discard((group[0]["userId"], group[0]["conversationId"]))
+        given_up = []
+        for record in group:
+            record["attempts"] += 1
+            # the conversation is gone, e.g. deleted by the user: retrying won't help
+            if record["attempts"] >= self.retries or getattr(error, "status_code", None) == 404:
+                del self._records[record["id"]]
+                given_up.append(record)
+            else:
+                backoff = min(WRITE_RETRY_BACKOFF * 2 ** record["attempts"], WRITE_RETRY_MAX_BACKOFF)
+                record["notBefore"] = time.time() + backoff * random.uniform(0.5, 1)
+                self._counters["retries"] += 1
+        for record in given_up:
+            logging.error("Giving up on chat history write %s of conversation %s: %s", record["id"], record["conversationId"], error)
+            self._counters["failed"] += len(record["messages"])
+            self.spool.dead_letter(record, str(error))
+        if given_up:
+            self.spool.ack([record["id"] for record in given_up])
+
+    def stats(self):
+        now = time.time()
+        return dict(
+            self._counters,
+            depth=len(self._records),
+            pending_messages=sum(len(record["messages"]) for record in self._records.values()),
+            flushing=len(self._flushing),
+            oldest_age=round(now - min((record["queuedAt"] for record in self._records.values()), default=now), 3),
+        )
+
+
+class WriteBehindQueue(_WriteBehindState):
+    """Writes chat history messages to a ConversationStore in the background.
+
+    create_messages() journals the messages in the spool and returns without waiting for the
+    store. A worker thread collects the writes for flush_interval, stores each conversation's
+    writes in one batch and retries failures with backoff; writes that keep failing are set
+    aside in the spool directory. wait() lets reads catch up with the queued writes of a user.
+
+    The spool and the worker thread are started by the first write of each process, so a queue
+    created before a pre-forking server (uwsgi, gunicorn) forks its workers is started in every
+    worker. wait() only covers writes queued in the same process: a read served by another
+    worker doesn't wait for them.
+    """
+
+    def __init__(self, store, spool_dir: str = HISTORY_SPOOL_DIR, retries: int = HISTORY_WRITE_RETRIES,
+                 flush_interval: float = HISTORY_WRITE_FLUSH_INTERVAL):
+        super().__init__(spool_dir, retries)
+        self.store = store
+        self.flush_interval = flush_interval
+        self._cond = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._closed = False
+        self._pid = None
+        self._executor = None
+        self._worker = None
+
+    def start(self):
+        ## opens the spool and starts the worker thread, once per process
+        if self._pid == os.getpid():
+            return self
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # a forked process inherits the queue but not its thread
+                self._cond = threading.Condition()
+                self._open_spool()
+                self._add(self.spool.recover())
+                self._executor = ThreadPoolExecutor(max_workers=WRITE_CONCURRENCY, thread_name_prefix="history-write")
+                self._worker = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self._worker.start()
+                self._pid = os.getpid()
+        return self
+
+    def create_messages(self, conversation_id, user_id, input_messages: list, conversation: dict = None):
+        ## queues the messages, and the new conversation they start; returns the message documents
+        self.start()
+        record = self._new_record(conversation_id, user_id, input_messages, conversation)
+        self.spool.append([record])
+        with self._cond:
+            self._add([record])
+            self._cond.notify_all()
+        return record["messages"]
+
+    def wait(self, user_id, conversation_id=None, timeout=None):
+        ## True once the user's writes queued in this process, or those of one conversation, are stored or given up
+        if self._pid != os.getpid():
+            return True
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._is_pending(user_id, conversation_id), timeout)
+
+    def stats(self):
+        with self._cond:
+            return super().stats()
+
+    def _flush(self, group):
+        try:
+            conversation = next((record["conversation"] for record in group if record["conversation"]), None)
+            if conversation:
+                self.store.add_conversation(conversation)
+            self.store.save_messages(group[0]["userId"], [message for record in group for message in record["messages"]])
+        except Exception as e:
+            logging.warning("Exception while writing chat history of conversation %s", group[0]["conversationId"], exc_info=True)
+            with self._cond:
+                self._fail(group, e)
+                self._cond.notify_all()
+            return
+        with self._cond:
+            self._complete(group)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._is_due(time.time()):
+                    next_attempt = self._next_attempt()
+                    self._cond.wait(None if next_attempt is None else max(next_attempt - time.time(), self.flush_interval))
+                closed = self._closed
+            if not closed:
+                # collect the writes of the rest of the turn into the same batches
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed, self.flush_interval)
+            with self._cond:
+                groups = self._take(time.time())
+            if closed and not groups:
+                return
+            list(self._executor.map(self._flush, groups))
+
+    def close(self, timeout=None):
+        ## stores what is ready; writes still waiting for a retry stay in the spool for the next start
+        if self._pid != os.getpid():
+            return
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join(timeout)
+        self._executor.shutdown(wait=True)
+        self.spool.close()
+
+
+class AsyncWriteBehindQueue(_WriteBehindState):
+    """Async counterpart of WriteBehindQueue for an AsyncConversationStore, see there.
+
+    start() and close() bracket the worker task in the serving event loop, the spool is opened
+    by start() too. wait() only covers writes queued in the same process.
+    """
+
+    def __init__(self, store, spool_dir: str = HISTORY_SPOOL_DIR, retries: int = HISTORY_WRITE_RETRIES,
+                 flush_interval: float = HISTORY_WRITE_FLUSH_INTERVAL):
+        super().__init__(spool_dir, retries)
+        self.store = store
+        self.flush_interval = flush_interval
+        self._changed = asyncio.Event()
+        self._closed = False
+        self._worker = None
+
+    async def start(self):
+        if self._worker is None:
+            self._open_spool()
+            self._add(await asyncio.to_thread(self.spool.recover))
+            self._worker = asyncio.create_task(self._run())
+        return self
+
+    async def create_messages(self, conversation_id, user_id, input_messages: list, conversation: dict = None):
+        record = self._new_record(conversation_id, user_id, input_messages, conversation)
+        # fsync off the event loop
+        await asyncio.to_thread(self.spool.append, [record])
+        self._add([record])
+        self._notify()
+        return record["messages"]
+
+    async def wait(self, user_id, conversation_id=None, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._is_pending(user_id, conversation_id):
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    def _notify(self):
+        self._changed.set()
+
+    async def _flush(self, group):
+        try:
+            conversation = next((record["conversation"] for record in group if record["conversation"]), None)
+            if conversation:
+                await self.store.add_conversation(conversation)
+            await self.store.save_messages(group[0]["userId"], [message for record in group for message in record["messages"]])
+        except Exception as e:
+            logging.warning("Exception while writing chat history of conversation %s", group[0]["conversationId"], exc_info=True)
+            self._fail(group, e)
+        else:
+            self._complete(group)
+        self._notify()
+
+    async def _run(self):
+        while not self._closed:
+            if not self._records:
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+            # collect the writes of the rest of the turn into the same batches
+            await asyncio.sleep(self.flush_interval)
+            groups = self._take(time.time())
+            if not groups:
+                next_attempt = self._next_attempt()
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), max(next_attempt - time.time(), self.flush_interval))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for i in range(0, len(groups), WRITE_CONCURRENCY):
+                await asyncio.gather(*(self._flush(group) for group in groups[i:i + WRITE_CONCURRENCY]))
+
+    async def close(self):
+        self._closed = True
+        self._notify()
+        if self._worker is not None:
+            await self._worker
+            self._worker = None
+        if self.spool is None:
+            return
+        groups = self._take(time.time())
+        await asyncio.gather(*(self._flush(group) for group in groups))
+        self.spool.close()
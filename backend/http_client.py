@@ -0,0 +1,56 @@
+import threading
+import aiohttp
+import requests
+from azure.core.pipeline.transport import AioHttpTransport
+from requests.adapters import HTTPAdapter
+
+from backend.settings import (
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_MAXSIZE,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+)
+
+# One pooled session per process, shared by all outbound calls (Azure OpenAI, Microsoft Graph,
+# Azure Cognitive Search) so that they reuse keep-alive connections instead of paying TCP and
+# TLS setup on every request.
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def create_http_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_http_session() -> requests.Session:
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                _http_session = create_http_session()
+    return _http_session
+
+
+def get_http_timeout():
+    # (connect, read) tuple as accepted by requests and openai's request_timeout
+    return (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+
+def create_aiohttp_session(**kwargs) -> aiohttp.ClientSession:
+    # Must be called from within the event loop that will use the session
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_CONNECTIONS * HTTP_POOL_MAXSIZE, limit_per_host=HTTP_POOL_MAXSIZE)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, **kwargs)
+
+
+def create_azure_aio_transport(pool_maxsize: int) -> AioHttpTransport:
+    # Transport for async Azure SDK clients with a bounded connection pool, closed together with
+    # the client. The session is configured like the one the SDK would create on its own.
+    # Must be called from within the event loop that will use the client.
+    connector = aiohttp.TCPConnector(limit=pool_maxsize, limit_per_host=pool_maxsize)
+    session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar(), auto_decompress=False, trust_env=True)
+    return AioHttpTransport(session=session, session_owner=True)
@@ -0,0 +1,179 @@
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ACS Integration Settings
+AZURE_SEARCH_SERVICE = os.environ.get("AZURE_SEARCH_SERVICE")
+AZURE_SEARCH_INDEX = os.environ.get("AZURE_SEARCH_INDEX")
+AZURE_SEARCH_KEY = os.environ.get("AZURE_SEARCH_KEY")
+AZURE_SEARCH_USE_SEMANTIC_SEARCH = os.environ.get("AZURE_SEARCH_USE_SEMANTIC_SEARCH", "false")
+AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG = os.environ.get("AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG", "default")
+AZURE_SEARCH_TOP_K = os.environ.get("AZURE_SEARCH_TOP_K", 5)
+AZURE_SEARCH_ENABLE_IN_DOMAIN = os.environ.get("AZURE_SEARCH_ENABLE_IN_DOMAIN", "true")
+AZURE_SEARCH_CONTENT_COLUMNS = os.environ.get("AZURE_SEARCH_CONTENT_COLUMNS")
+AZURE_SEARCH_FILENAME_COLUMN = os.environ.get("AZURE_SEARCH_FILENAME_COLUMN")
+AZURE_SEARCH_TITLE_COLUMN = os.environ.get("AZURE_SEARCH_TITLE_COLUMN")
+AZURE_SEARCH_URL_COLUMN = os.environ.get("AZURE_SEARCH_URL_COLUMN")
+AZURE_SEARCH_VECTOR_COLUMNS = os.environ.get("AZURE_SEARCH_VECTOR_COLUMNS")
+AZURE_SEARCH_QUERY_TYPE = os.environ.get("AZURE_SEARCH_QUERY_TYPE")
+AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_COLUMN")
+
+# AOAI Integration Settings
+AZURE_OPENAI_RESOURCE = os.environ.get("AZURE_OPENAI_RESOURCE")
+AZURE_OPENAI_MODEL = os.environ.get("AZURE_OPENAI_MODEL")
+AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT")
+AZURE_OPENAI_KEY = os.environ.get("AZURE_OPENAI_KEY")
+AZURE_OPENAI_TEMPERATURE = os.environ.get("AZURE_OPENAI_TEMPERATURE", 0)
+AZURE_OPENAI_TOP_P = os.environ.get("AZURE_OPENAI_TOP_P", 1.0)
+AZURE_OPENAI_MAX_TOKENS = os.environ.get("AZURE_OPENAI_MAX_TOKENS", 1000)
+AZURE_OPENAI_STOP_SEQUENCE = os.environ.get("AZURE_OPENAI_STOP_SEQUENCE")
+AZURE_OPENAI_SYSTEM_MESSAGE = os.environ.get("AZURE_OPENAI_SYSTEM_MESSAGE", "You are an AI assistant that helps people find information.")
+AZURE_OPENAI_PREVIEW_API_VERSION = os.environ.get("AZURE_OPENAI_PREVIEW_API_VERSION", "2023-06-01-preview")
+AZURE_OPENAI_STREAM = os.environ.get("AZURE_OPENAI_STREAM", "true")
+AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME", "gpt-35-turbo-16k") # Name of the model, e.g. 'gpt-35-turbo-16k' or 'gpt-4'
+AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ.get("AZURE_OPENAI_EMBEDDING_ENDPOINT")
+AZURE_OPENAI_EMBEDDING_KEY = os.environ.get("AZURE_OPENAI_EMBEDDING_KEY")
+
+
+SHOULD_STREAM = True if AZURE_OPENAI_STREAM.lower() == "true" else False
+
+# CosmosDB Integration Settings
+AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
+AZURE_COSMOSDB_ACCOUNT = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
+AZURE_COSMOSDB_CONVERSATIONS_CONTAINER = os.environ.get("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER")
+AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
+AZURE_COSMOSDB_POOL_MAXSIZE = int(os.environ.get("AZURE_COSMOSDB_POOL_MAXSIZE", 32)) # Connections of the async client, see app_async.py
+CONVERSATION_STORE = os.environ.get("CONVERSATION_STORE", "cosmos").lower() # 'cosmos', or a local stand-in: 'memory' or 'sqlite'
+CONVERSATION_STORE_SQLITE_PATH = os.environ.get("CONVERSATION_STORE_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "sample-app-aoai-history.sqlite3"))
+DELETION_JOB_TTL = int(os.environ.get("DELETION_JOB_TTL", 7 * 24 * 3600)) # Seconds a finished deletion job is kept, 0 keeps it
+
+# Outbound HTTP Client Settings
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", 10)) # Number of hosts to keep a connection pool for
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 32)) # Keep-alive connections per host
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 120))
+
+# Group Membership Cache Settings
+AZURE_GRAPH_GROUPS_PAGE_SIZE = os.environ.get("AZURE_GRAPH_GROUPS_PAGE_SIZE") # Groups per Graph page, up to 999 (Graph default is 100)
+GROUPS_CACHE_TTL = float(os.environ.get("GROUPS_CACHE_TTL", 300)) # Seconds, 0 disables the cache
+GROUPS_CACHE_NEGATIVE_TTL = float(os.environ.get("GROUPS_CACHE_NEGATIVE_TTL", 30)) # Seconds to remember a failed lookup
+GROUPS_CACHE_MAXSIZE = int(os.environ.get("GROUPS_CACHE_MAXSIZE", 4096)) # Number of users to keep
+
+# Cache Backend Settings
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory") # 'memory' (per worker process) or 'sqlite' (shared by the workers on a host)
+CACHE_SQLITE_PATH = os.environ.get("CACHE_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "sample-app-aoai-cache.sqlite3"))
+
+# Title Generation Settings
+TITLE_GENERATOR = os.environ.get("TITLE_GENERATOR", "openai").lower() # 'openai' asks the model for a title, 'local' extracts keywords without a model call
+
+# Answer Cache Settings
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 3600)) # Seconds a cached answer is served
+ANSWER_CACHE_MAXSIZE = int(os.environ.get("ANSWER_CACHE_MAXSIZE", 1000)) # Number of answers to keep
+
+# History Write-Behind Settings
+HISTORY_WRITE_BEHIND = os.environ.get("HISTORY_WRITE_BEHIND", "false").lower() == "true"
+HISTORY_SPOOL_DIR = os.environ.get("HISTORY_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "sample-app-aoai-history-spool"))
+HISTORY_WRITE_RETRIES = int(os.environ.get("HISTORY_WRITE_RETRIES", 5)) # Attempts before a write is set aside in the spool directory
+HISTORY_WRITE_FLUSH_INTERVAL = float(os.environ.get("HISTORY_WRITE_FLUSH_INTERVAL", 0.05)) # Seconds to collect writes into one batch
+HISTORY_WRITE_WAIT_TIMEOUT = float(os.environ.get("HISTORY_WRITE_WAIT_TIMEOUT", 5)) # Seconds reads wait for queued writes of the conversation
+
+# History Cache Settings
+HISTORY_CACHE_ENABLED = os.environ.get("HISTORY_CACHE_ENABLED", "false").lower() == "true"
+HISTORY_CACHE_TTL = float(os.environ.get("HISTORY_CACHE_TTL", 300)) # Seconds a conversation list or message list is served from the cache
+HISTORY_CACHE_MAXSIZE = int(os.environ.get("HISTORY_CACHE_MAXSIZE", 10000)) # Number of cached lists and version tokens
+
+
+## Typed settings ##
+# The request related settings are parsed and validated once when the app starts, so a
+# malformed value fails the boot instead of the first user request.
+def _parse_number(name, value, number_type, minimum=None, maximum=None):
+    try:
+        number = number_type(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a valid {number_type.__name__}, got '{value}'")
+    if (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+        raise ValueError(f"{name} must be between {minimum} and {maximum}, got {number}")
+    return number
+
+def _split_columns(value) -> Tuple[str, ...]:
+    return tuple(value.split("|")) if value else ()
+
+
+@dataclass(frozen=True)
+class AzureOpenAISettings:
+    model: Optional[str]
+    temperature: float
+    top_p: float
+    max_tokens: int
+    stop: Optional[Tuple[str, ...]]
+    system_message: str
+    stream: bool
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            model=AZURE_OPENAI_MODEL,
+            temperature=_parse_number("AZURE_OPENAI_TEMPERATURE", AZURE_OPENAI_TEMPERATURE, float, 0, 2),
+            top_p=_parse_number("AZURE_OPENAI_TOP_P", AZURE_OPENAI_TOP_P, float, 0, 1),
+            max_tokens=_parse_number("AZURE_OPENAI_MAX_TOKENS", AZURE_OPENAI_MAX_TOKENS, int, 1),
+            stop=_split_columns(AZURE_OPENAI_STOP_SEQUENCE) or None,
+            system_message=AZURE_OPENAI_SYSTEM_MESSAGE,
+            stream=SHOULD_STREAM
+        )
+
+
+@dataclass(frozen=True)
+class AzureSearchSettings:
+    service: Optional[str]
+    index: Optional[str]
+    key: Optional[str]
+    top_k: int
+    query_type: str
+    semantic_search_config: str
+    in_domain: bool
+    content_columns: Tuple[str, ...]
+    vector_columns: Tuple[str, ...]
+    title_column: Optional[str]
+    url_column: Optional[str]
+    filename_column: Optional[str]
+    permitted_groups_column: Optional[str]
+
+    @classmethod
+    def from_env(cls):
+        query_type = "simple"
+        if AZURE_SEARCH_QUERY_TYPE:
+            query_type = AZURE_SEARCH_QUERY_TYPE
+        elif AZURE_SEARCH_USE_SEMANTIC_SEARCH.lower() == "true" and AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG:
+            query_type = "semantic"
+
+        return cls(
+            service=AZURE_SEARCH_SERVICE,
+            index=AZURE_SEARCH_INDEX,
+            key=AZURE_SEARCH_KEY,
+            top_k=_parse_number("AZURE_SEARCH_TOP_K", AZURE_SEARCH_TOP_K, int, 1),
+            query_type=query_type,
+            semantic_search_config=AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG or "",
+            in_domain=AZURE_SEARCH_ENABLE_IN_DOMAIN.lower() == "true",
+            content_columns=_split_columns(AZURE_SEARCH_CONTENT_COLUMNS),
+            vector_columns=_split_columns(AZURE_SEARCH_VECTOR_COLUMNS),
+            title_column=AZURE_SEARCH_TITLE_COLUMN or None,
+            url_column=AZURE_SEARCH_URL_COLUMN or None,
+            filename_column=AZURE_SEARCH_FILENAME_COLUMN or None,
+            permitted_groups_column=AZURE_SEARCH_PERMITTED_GROUPS_COLUMN or None
+        )
+
+
+def _check_choice(name, value, choices):
+    if value not in choices:
+        raise ValueError(f"{name} must be one of {', '.join(choices)}, got '{value}'")
+
+
+_check_choice("TITLE_GENERATOR", TITLE_GENERATOR, ("openai", "local"))
+_check_choice("CONVERSATION_STORE", CONVERSATION_STORE, ("cosmos", "memory", "sqlite"))
+openai_settings = AzureOpenAISettings.from_env()
+search_settings = AzureSearchSettings.from_env()
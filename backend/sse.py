@@ -0,0 +1,125 @@
+import json
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List, NamedTuple
+
+# Read upstream bodies in large blocks. Azure OpenAI streams with chunked transfer encoding,
+# so a read returns as soon as a chunk arrives and never waits for the block to fill up.
+SSE_READ_CHUNK_SIZE = 64 * 1024
+
+SSE_DONE = "[DONE]"
+
+
+class ServerSentEvent(NamedTuple):
+    event: str
+    data: str
+
+
+class SSEParser():
+    """Incremental parser for a text/event-stream body.
+
+    Feed it raw bytes as they arrive; it returns every event completed by them. Handles
+    multi-line data fields, comments, and \\n, \\r\\n or \\r line endings split across reads.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._event = "message"
+        self._data = []
+
+    def feed(self, chunk: bytes) -> List[ServerSentEvent]:
+        buffer = self._buffer
+        buffer += chunk
+
+        # only consume complete lines, a trailing \r may still be followed by \n
+        search_end = len(buffer) - 1 if buffer.endswith(b"\r") else len(buffer)
+        end = max(buffer.rfind(b"\n", 0, search_end), buffer.rfind(b"\r", 0, search_end))
+        if end == -1:
+            return []
+
+        lines = bytes(buffer[:end + 1]).splitlines()
+        del buffer[:end + 1]
+
+        events = []
+        for line in lines:
+            if not line:
+                self._dispatch(events)
+            else:
+                self._process_line(line)
+        return events
+
+    def close(self) -> List[ServerSentEvent]:
+        # Dispatch whatever is left, upstreams do not always terminate the last event
+        events = []
+        if self._buffer:
+            self._process_line(bytes(self._buffer).rstrip(b"\r\n"))
+            self._buffer.clear()
+        self._dispatch(events)
+        return events
+
+    def _process_line(self, line: bytes):
+        if line.startswith(b":"):
+            return
+
+        field, sep, value = line.partition(b":")
+        if sep and value.startswith(b" "):
+            value = value[1:]
+
+        if field == b"data":
+            self._data.append(value)
+        elif field == b"event":
+            self._event = value.decode("utf-8")
+
+    def _dispatch(self, events: List[ServerSentEvent]):
+        if self._data:
+            events.append(ServerSentEvent(self._event, b"\n".join(self._data).decode("utf-8")))
+        self._event = "message"
+        self._data = []
+
+
+def iter_sse_events(chunks: Iterable[bytes]) -> Iterator[ServerSentEvent]:
+    parser = SSEParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+async def aiter_sse_events(chunks: AsyncIterable[bytes]) -> AsyncIterator[ServerSentEvent]:
+    parser = SSEParser()
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.close():
+        yield event
+
+
+def parse_event_json(event: ServerSentEvent) -> List[dict]:
+    if event.event == "error":
+        try:
+            payload = json.loads(event.data)
+        except ValueError:
+            payload = event.data
+        return [payload if isinstance(payload, dict) and "error" in payload else {"error": payload}]
+
+    try:
+        return [json.loads(event.data)]
+    except ValueError:
+        if "\n" not in event.data:
+            raise
+        # Tolerate upstreams that omit the blank line between single-line events
+        return [json.loads(line) for line in event.data.split("\n") if line and line != SSE_DONE]
+
+
+def iter_sse_json(chunks: Iterable[bytes]) -> Iterator[dict]:
+    """Yields the JSON payload of every event until the [DONE] sentinel.
+    Error events are yielded as {"error": ...}."""
+    for event in iter_sse_events(chunks):
+        if event.data == SSE_DONE:
+            return
+        yield from parse_event_json(event)
+
+
+async def aiter_sse_json(chunks: AsyncIterable[bytes]) -> AsyncIterator[dict]:
+    async for event in aiter_sse_events(chunks):
+        if event.data == SSE_DONE:
+            return
+        for payload in parse_event_json(event):
+            yield payload
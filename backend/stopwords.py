@@ -0,0 +1,175 @@
+# Stopwords used by the local title generator, one entry per language in
+# SUPPORTED_LANGUAGE_CODES (scripts/data_preparation.py). The lists hold the most frequent
+# function words and question words, enough to pick the content words of a chat message.
+# Chinese, Japanese and Thai are written without spaces between words; they are handled
+# by the character based fallback in backend/title_generator.py and need no list.
+
+_PORTUGUESE = """
+a ao aos as até com como da das de do dos e é ela ele eles em entre era essa esse esta
+este eu foi há isso isto já mais mas me meu minha muito na nas não nem no nos o onde os
+ou para pela pelo por porque posso pode pôde qual quais quando que quem se sem ser seu
+sua são também te tem tenho um uma umas uns você vocês estou está estão sobre preciso
+"""
+
+STOPWORDS = {
+    "ar": """
+        في من على إلى عن مع هذا هذه ذلك تلك التي الذي الذين هو هي هم أنا نحن أنت أن إن كان
+        كانت ما ماذا لماذا كيف متى أين هل لا لم لن قد كل بعض أو ثم حتى بين عند غير يمكن
+        """,
+    "hy": """
+        և ու է են էր էին եմ ես դու նա մենք դուք նրանք այս այդ այն որ ինչ ինչպես ինչու
+        երբ որտեղ թե կամ բայց համար հետ մեջ վրա մասին չէ ոչ կա կարող
+        """,
+    "eu": """
+        eta edo baina da dira zen ziren naiz gara dut du dute ez bai hau hori hura hauek
+        zer nola noiz non zergatik nor ni zu hura gu zuek haiek ere bat batzuk
+        """,
+    "bg": """
+        и в във на с със за от до по при към че да не ли е са бе бях съм си сме сте
+        аз ти той тя то ние вие те това този тази тези как какво кога къде защо кой
+        коя кои или но ако може много има
+        """,
+    "ca": """
+        a al als amb de del dels el els en és i la les lo o per perquè que qui què com
+        quan on un una uns unes jo tu ell ella nosaltres vosaltres ells elles em et es
+        ens us hi ho no sí però més molt puc pot són està estan
+        """,
+    "cs": """
+        a aby ale ani by byl byla bylo být co což do i jak jaké jaký je jsem jsi jsme
+        jste jsou k kde kdy když ke která které který mi mít mám na nebo není o od po
+        pro proč s se si ta tak také tam ten to tu v ve z za že já ty on ona my vy oni
+        můžu může
+        """,
+    "da": """
+        af alle at bliver da de dem den denne der det dette du efter eller en er et for
+        fra har have hun hvad hvem hvor hvordan hvorfor hvis i ikke jeg jer kan man med
+        men mig min mit nu og om på sig skal som til ud under var vi vil være
+        """,
+    "nl": """
+        aan al als ben bij dan dat de deze die dit doen door een en er geen had heb
+        hebben het hij hoe hun ik in is je kan kunnen maar me met mij mijn moet na naar
+        niet nog nu of om onder ons ook op over te tot u uit van veel voor waar wanneer
+        wat waarom was we wie wij wil worden wordt zijn ze zich zo
+        """,
+    "en": """
+        a about above after again all am an and any are as at be because been before
+        being below between both but by can could did do does doing down during each
+        few for from further get got had has have having he her here hers him his how
+        i if in into is it its itself just know let me more most my need no nor not
+        now of off on once only or other our out over own please same she should so
+        some such tell than that the their them then there these they this those
+        through to too under until up very want was we were what when where which
+        while who whom why will with would you your yours s t d ll m re ve explain
+        give show many much
+        """,
+    "fi": """
+        ja on ei se että hän he me te minä sinä olen olet oli ovat olla mitä mikä miten
+        miksi milloin missä kuka kun jos tai mutta myös vain niin tämä tuo nämä ne kanssa
+        voi voin voiko onko kuinka paljon
+        """,
+    "fr": """
+        à au aux avec ce ces cette comment dans de des du elle elles en est et être il
+        ils je j la le les leur lui ma mais me mes moi mon ne nous on ou où par pas pour
+        pourquoi quand que quel quelle quels qui sa se ses son sont sur ta te tes toi ton
+        tu un une vos votre vous l d qu n s c m t y a ai peux peut combien est-ce
+        """,
+    "gl": """
+        a ao aos as co coa como con da das de do dos e é el ela eles en entre era esta
+        este eu foi ha iso isto máis mais me meu miña moito na nas non no nos o onde os
+        ou para pero por porque que quen se sen ser seu súa son tamén ten teño un unha
+        """,
+    "de": """
+        aber alle als am an auch auf aus bei bin bis bist da damit dann das dass dein
+        dem den der des die dies diese dieser du durch ein eine einem einen einer er es
+        für gibt hat habe haben ich ihr im in ist ja kann kein man mein mich mir mit
+        muss nach nicht noch nur ob oder sein sich sie sind so über um und uns von vor
+        war warum was weil welche wenn wer werden wie wir wird wo zu zum zur
+        """,
+    "el": """
+        και το τα η ο οι του της των τον την με σε σε από για να θα δεν μη είναι ήταν
+        εγώ εσύ αυτός αυτή αυτό εμείς εσείς αυτοί τι πώς πότε πού γιατί ποιος ποια ποιο
+        ή αλλά αν ένα μια μου σου μας σας πολύ μπορώ μπορεί
+        """,
+    "hi": """
+        और का की के को में से पर है हैं था थे थी यह वह ये वे मैं हम तुम आप क्या कैसे
+        कब कहाँ क्यों कौन कि भी तो ही या लेकिन एक नहीं मुझे हमें कर करना सकते सकता
+        """,
+    "hu": """
+        a az és egy hogy nem is van volt vagy de ha meg már csak mint még én te ő mi ti
+        ők ez az mit mi hogyan mikor hol miért ki kell lehet nekem nagyon
+        """,
+    "id": """
+        dan di ke dari yang untuk dengan pada ini itu adalah atau juga tidak bisa saya
+        kami kita anda dia mereka apa bagaimana kapan di mana mengapa siapa ada akan
+        sudah belum harus dapat seperti dalam
+        """,
+    "ga": """
+        agus an na is ar le de do i ó go a ag mé tú sé sí muid sibh siad cad conas cén
+        cathain cá cén fáth cé níl tá bhí ní nach ach nó seo sin
+        """,
+    "it": """
+        a ad al alla alle agli ai anche che chi come con cosa da dal dalla dei del della
+        delle di dove e è ed gli ha hanno ho il in io la le lei lo loro lui ma mi mio
+        mia ne nel nella no non noi o per perché più posso può quale quali quando
+        quanto questa questo se si sono su sua suo te ti tu un una uno voi l dell un
+        """,
+    "ko": """
+        그 이 저 것 수 등 및 또는 그리고 하지만 그러나 어떻게 무엇 무엇을 왜 언제 어디
+        누가 있 있는 있나요 없 없는 나 저는 제가 우리 당신 합니다 하는 해요 입니다
+        """,
+    "lv": """
+        un ir bija būs es tu viņš viņa mēs jūs viņi kas ko kā kad kur kāpēc kurš kura
+        vai bet arī ar par no uz pie līdz ka tas tā tie šis šī ne nav var
+        """,
+    "no": """
+        og i jeg det at en et den til er som på de med han av ikke der så var meg seg
+        men ett har om vi min mitt ha hadde hun nå over da ved fra du ut sin dem oss
+        opp man kan hva hvordan hvorfor hvor når hvem eller skal vil
+        """,
+    "fa": """
+        و در به از که این آن با را برای است هست بود می من تو او ما شما آنها چه چرا
+        چگونه کی کجا کدام یا اما هم نه یک تا بر
+        """,
+    "pl": """
+        a aby ale bo być był była co czy dla do gdy gdzie i ich ja jak jaki jest jestem
+        jego jej już lub ma mam mi mnie może mogę na nie nas o od on ona oni po pod przez
+        przy się są ta tak te ten to tu ty w we wy z za że dlaczego kiedy ile który
+        """,
+    "pt-Br": _PORTUGUESE,
+    "pt-Pt": _PORTUGUESE,
+    "ro": """
+        a al ale am ar are au ca care ce cu cum când de din după eu el ea este fi în
+        la le lor mai mi mă ne nu o pe pentru sa să se si și sunt te tu un una unde
+        vă voi noi ei ele de ce cine pot poate
+        """,
+    "ru": """
+        и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по
+        только ее мне было вот от меня еще нет о из ему теперь когда даже ну ли если уже
+        или ни быть был него до вас нибудь опять уж вам ведь там потом себя ничего ей
+        может они тут где есть надо ней для мы тебя их чем была сам чтобы без будто
+        чего раз тоже себе под будет ж тогда кто этот того потому этого какой почему
+        как сколько можно
+        """,
+    "es": """
+        a al algo como con cual cuales cuando de del donde el ella ellos en entre era es
+        esa ese esta este estoy está están fue ha hay la las le les lo los me mi mis muy
+        más no nos o para pero por porque puedo puede qué que quien se sea ser si sin
+        sobre su sus también te tengo tiene tu un una uno unos y ya yo cómo cuándo dónde
+        cuánto cuántos
+        """,
+    "sv": """
+        och i att det som en på är av för med till den har de inte om ett han men var
+        jag sig från vi så kan man när år säga hur vad varför vem vilken eller du ni
+        hon dem min mitt mig skulle kunna måste
+        """,
+    "tr": """
+        ve ile bir bu şu o da de mi mı mu mü ne nasıl neden niçin ne zaman nerede kim
+        hangi için gibi ama veya ya ben sen biz siz onlar var yok çok daha en ki
+        """,
+    "zh-Hans": "",
+    "zh-Hant": "",
+    "ja": "",
+    "th": "",
+}
+
+STOPWORDS = {language: frozenset(words.split()) for language, words in STOPWORDS.items()}
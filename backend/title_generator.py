@@ -0,0 +1,116 @@
+import re
+import unicodedata
+
+from backend.stopwords import STOPWORDS
+
+TITLE_MAX_WORDS = 4
+# Titles of messages written without spaces (Chinese, Japanese, Thai) are cut by characters
+TITLE_MAX_CHARS = 16
+
+# Elisions and hyphenated words split into separate words, e.g. "l'entreprise", "e-mail"
+_WORD_SEPARATORS = re.compile(r"[-'’]")
+_UNSEGMENTED_SCRIPT = re.compile(r"[\u0e00-\u0e7f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+
+# word -> languages it is a stopword in, to guess the language of a message
+_STOPWORD_LANGUAGES = {}
+for _language, _words in STOPWORDS.items():
+    for _word in _words:
+        _STOPWORD_LANGUAGES.setdefault(_word, []).append(_language)
+
+
+def _strip_punctuation(word):
+    return "".join(ch for ch in word if not unicodedata.category(ch).startswith(("P", "S")))
+
+
+def _ends_clause(word):
+    # Sentence and clause punctuation ends a phrase, e.g. "budget, travel" are two phrases
+    return bool(word) and unicodedata.category(word[-1]).startswith("P")
+
+
+def _split_words(text):
+    # [(word, ends_clause)]
+    words = []
+    for raw in text.split():
+        parts = [_strip_punctuation(part) for part in _WORD_SEPARATORS.split(raw)]
+        parts = [part for part in parts if part]
+        for i, part in enumerate(parts):
+            words.append((part, i == len(parts) - 1 and _ends_clause(raw)))
+    return words
+
+
+def detect_language(words):
+    hits = {}
+    for word, _ in words:
+        for language in _STOPWORD_LANGUAGES.get(word.casefold(), ()):
+            hits[language] = hits.get(language, 0) + 1
+    if not hits:
+        return "en"
+    # ties are resolved by the order of STOPWORDS, which keeps the result deterministic
+    return max(hits, key=lambda language: (hits[language], -list(STOPWORDS).index(language)))
+
+
+def _candidate_phrases(words, stopwords):
+    # Runs of content words between stopwords and punctuation, a cheap stand-in for noun phrases
+    phrases = []
+    current = []
+    for word, ends_clause in words:
+        if word.casefold() in stopwords:
+            if current:
+                phrases.append(current)
+            current = []
+            continue
+        current.append(word)
+        if ends_clause:
+            phrases.append(current)
+            current = []
+    if current:
+        phrases.append(current)
+    return phrases
+
+
+def _score_phrases(phrases):
+    # RAKE word scores: words in longer and repeated phrases score higher
+    frequency = {}
+    degree = {}
+    for phrase in phrases:
+        for word in phrase:
+            key = word.casefold()
+            frequency[key] = frequency.get(key, 0) + 1
+            degree[key] = degree.get(key, 0) + len(phrase)
+    return [sum(degree[w.casefold()] / frequency[w.casefold()] for w in phrase) for phrase in phrases]
+
+
+def _format_title(words):
+    title = " ".join(words)
+    return title[:1].upper() + title[1:]
+
+
+def generate_local_title(conversation_messages):
+    """Deterministic title from the keywords of the first user message, without a model call.
+
+    Returns a title of at most TITLE_MAX_WORDS words, or None when there is no user message to work with.
+    """
+    text = next((m["content"] for m in conversation_messages if m["role"] == "user" and m.get("content")), "")
+    text = text.strip()
+    if not text:
+        return None
+
+    if len(_UNSEGMENTED_SCRIPT.findall(text)) > len(text) // 3:
+        title = "".join(ch for ch in text if not unicodedata.category(ch).startswith(("P", "S", "Z", "C")))
+        return title[:TITLE_MAX_CHARS] or None
+
+    words = _split_words(text)
+    stopwords = STOPWORDS[detect_language(words)]
+    phrases = _candidate_phrases(words, stopwords)
+    if not phrases:
+        return _format_title([word for word, _ in words[:TITLE_MAX_WORDS]]) or None
+
+    scores = _score_phrases(phrases)
+    ranked = sorted(range(len(phrases)), key=lambda i: (-scores[i], i))
+
+    # the best phrase, followed by the second best when it is a single word; kept in message order
+    selected = ranked[:1]
+    if len(phrases[ranked[0]]) == 1 and len(ranked) > 1:
+        selected = sorted(ranked[:2])
+    title_words = [word for i in selected for word in phrases[i]]
+    return _format_title(title_words[:TITLE_MAX_WORDS])
@@ -0,0 +1,309 @@
+import json
+from dataclasses import dataclass
+from typing import Optional
+
+from backend.settings import (
+    AZURE_SEARCH_SERVICE,
+    AZURE_SEARCH_INDEX,
+    AZURE_SEARCH_KEY,
+    AZURE_SEARCH_PERMITTED_GROUPS_COLUMN,
+    AZURE_OPENAI_RESOURCE,
+    AZURE_OPENAI_MODEL,
+    AZURE_OPENAI_ENDPOINT,
+    AZURE_OPENAI_KEY,
+    AZURE_OPENAI_PREVIEW_API_VERSION,
+    AZURE_OPENAI_EMBEDDING_ENDPOINT,
+    AZURE_OPENAI_EMBEDDING_KEY,
+    AzureOpenAISettings,
+    AzureSearchSettings,
+    openai_settings,
+    search_settings,
+)
+
+GRAPH_TRANSITIVE_MEMBER_OF_URL = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+
+AZURE_OPENAI_API_VERSION = "2023-03-15-preview"
+
+TITLE_PROMPT = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
+
+
+def should_use_data():
+    if AZURE_SEARCH_SERVICE and AZURE_SEARCH_INDEX and AZURE_SEARCH_KEY:
+        return True
+    return False
+
+
+def format_as_ndjson(obj: dict) -> str:
+    return json.dumps(obj, ensure_ascii=False) + "\n"
+
+## Delta stream format ##
+# Clients opt in by sending "stream_format": "delta" in the request body. Instead of
+# re-sending the accumulated response on every token, the stream then consists of:
+#   {"type": "start", "id", "model", "created", "object", "history_metadata"}  (once)
+#   {"type": "tool", "message": {"role": "tool", "content": ...}}              (once, with data only)
+#   {"type": "delta", "content": "..."}                                        (per token)
+#   {"type": "end", "id", "delta_count", "content_length"}                     (once)
+# Errors are sent as {"type": "error", "error": ...} and end the stream.
+# On /history/generate the stream additionally starts with
+#   {"type": "history_metadata", "history_metadata": {...}}
+# and, for a new conversation, carries {"type": "title", "conversation_id", "title"} once
+# the title has been generated, usually after the answer.
+# Requests to /history/generate with "save_answer": true have the server store the tool and
+# assistant messages once the answer is complete, instead of the client posting them to
+# /history/update. The outcome is reported as "saved" in the last event: in the "end" event,
+# and in history_metadata of a final accumulated line that repeats the complete answer.
+STREAM_FORMAT_DELTA = "delta"
+
+def use_delta_stream(request_body):
+    return request_body.get("stream_format") == STREAM_FORMAT_DELTA
+
+def format_delta_start(chunk, history_metadata):
+    return format_as_ndjson({
+        "type": "start",
+        "id": chunk["id"],
+        "model": chunk["model"],
+        "created": chunk["created"],
+        "object": chunk["object"],
+        "history_metadata": history_metadata
+    })
+
+def format_history_metadata_event(history_metadata):
+    return format_as_ndjson({"type": "history_metadata", "history_metadata": history_metadata})
+
+def format_title_event(history_metadata):
+    return format_as_ndjson({
+        "type": "title",
+        "conversation_id": history_metadata.get("conversation_id"),
+        "title": history_metadata.get("title")
+    })
+
+def with_title(line, title):
+    # Copy of an accumulated NDJSON line with the generated title, None for lines without history_metadata
+    obj = json.loads(line)
+    if not isinstance(obj.get("history_metadata"), dict):
+        return None
+    obj["history_metadata"]["title"] = title
+    return format_as_ndjson(obj)
+
+def format_delta_end(response_id, delta_count, content_length, saved=None):
+    end = {
+        "type": "end",
+        "id": response_id,
+        "delta_count": delta_count,
+        "content_length": content_length
+    }
+    if saved is not None:
+        end["saved"] = saved
+    return format_as_ndjson(end)
+
+
+def get_aoai_base_url():
+    return AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
+
+def get_with_data_endpoint():
+    return f"{get_aoai_base_url()}openai/deployments/{AZURE_OPENAI_MODEL}/extensions/chat/completions?api-version={AZURE_OPENAI_PREVIEW_API_VERSION}"
+
+def get_without_data_endpoint():
+    return f"{get_aoai_base_url()}openai/deployments/{AZURE_OPENAI_MODEL}/chat/completions?api-version={AZURE_OPENAI_API_VERSION}"
+
+
+def build_filter_string(userGroups):
+    # Construct filter string from the list of groups the user is a member of
+    if userGroups:
+        group_ids = ", ".join([obj['id'] for obj in userGroups])
+        return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
+
+    return None
+
+def get_fallback_filter_string():
+    ## Used for testing, when the groups of the user can't be read
+    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, 'ms-audit'))"
+
+
+@dataclass(frozen=True)
+class RequestTemplate:
+    """Chat completions request computed once from the settings.
+
+    build() only adds the messages and, for "on your data" requests, the search filter.
+    The template itself is shared between requests and must not be modified.
+    """
+    body: dict
+    headers: dict
+    data_source_parameters: Optional[dict] = None
+
+    def build(self, messages, filter=None):
+        body = dict(self.body, messages=messages)
+        if self.data_source_parameters is not None:
+            body["dataSources"] = [{
+                "type": "AzureCognitiveSearch",
+                "parameters": dict(self.data_source_parameters, filter=filter)
+            }]
+        return body, dict(self.headers)
+
+
+def _completion_parameters(openai: AzureOpenAISettings):
+    return {
+        "temperature": openai.temperature,
+        "max_tokens": openai.max_tokens,
+        "top_p": openai.top_p,
+        "stop": list(openai.stop) if openai.stop else None,
+        "stream": openai.stream
+    }
+
+def build_with_data_template(openai: AzureOpenAISettings, search: AzureSearchSettings):
+    return RequestTemplate(
+        body=_completion_parameters(openai),
+        headers={
+            'Content-Type': 'application/json',
+            'api-key': AZURE_OPENAI_KEY,
+            "x-ms-useragent": "GitHubSampleWebApp/PublicAPI/2.0.0"
+        },
+        data_source_parameters={
+            "endpoint": f"https://{search.service}.search.windows.net",
+            "key": search.key,
+            "indexName": search.index,
+            "apiVersion": "2020-07-01-Preview",
+            "fieldsMapping": {
+                "contentFields": list(search.content_columns),
+                "titleField": search.title_column,
+                "urlField": search.url_column,
+                "filepathField": search.filename_column,
+                "vectorFields": list(search.vector_columns)
+            },
+            "inScope": search.in_domain,
+            "topNDocuments": search.top_k,
+            "queryType": search.query_type,
+            "semanticConfiguration": search.semantic_search_config,
+            "roleInformation": openai.system_message,
+            "embeddingEndpoint": AZURE_OPENAI_EMBEDDING_ENDPOINT,
+            "embeddingKey": AZURE_OPENAI_EMBEDDING_KEY
+        }
+    )
+
+def build_without_data_template(openai: AzureOpenAISettings):
+    return RequestTemplate(
+        body=_completion_parameters(openai),
+        headers={
+            'Content-Type': 'application/json',
+            'api-key': AZURE_OPENAI_KEY
+        }
+    )
+
+with_data_template = build_with_data_template(openai_settings, search_settings)
+without_data_template = build_without_data_template(openai_settings)
+
+
+def build_body_headers_with_data(request_messages, filter):
+    return with_data_template.build(request_messages, filter)
+
+
+def new_with_data_response(history_metadata):
+    return {
+        "id": "",
+        "model": "",
+        "created": 0,
+        "object": "",
+        "choices": [{
+            "messages": []
+        }],
+        'history_metadata': history_metadata
+    }
+
+def update_with_data_response(response, lineJson):
+    # Merge one upstream "extensions/chat/completions" chunk into the accumulated response
+    response["id"] = lineJson["id"]
+    response["model"] = lineJson["model"]
+    response["created"] = lineJson["created"]
+    response["object"] = lineJson["object"]
+
+    role = lineJson["choices"][0]["messages"][0]["delta"].get("role")
+    if role == "tool":
+        response["choices"][0]["messages"].append(lineJson["choices"][0]["messages"][0]["delta"])
+    elif role == "assistant":
+        response["choices"][0]["messages"].append({
+            "role": "assistant",
+            "content": ""
+        })
+    else:
+        deltaText = lineJson["choices"][0]["messages"][0]["delta"]["content"]
+        if deltaText != "[DONE]":
+            response["choices"][0]["messages"][1]["content"] += deltaText
+
+    return response
+
+
+def format_stream_without_data_chunk(line, responseText, history_metadata):
+    return {
+        "id": line["id"],
+        "model": line["model"],
+        "created": line["created"],
+        "object": line["object"],
+        "choices": [{
+            "messages": [{
+                "role": "assistant",
+                "content": responseText
+            }]
+        }],
+        "history_metadata": history_metadata
+    }
+
+
+def build_body_headers_without_data(request_messages):
+    messages = [
+        {
+            "role": "system",
+            "content": openai_settings.system_message
+        }
+    ]
+
+    for message in request_messages:
+        messages.append({
+            "role": message["role"] ,
+            "content": message["content"]
+        })
+
+    return without_data_template.build(messages)
+
+
+def format_non_streaming_without_data(response, history_metadata):
+    return {
+        "id": response["id"],
+        "model": response["model"],
+        "created": response["created"],
+        "object": response["object"],
+        "choices": [{
+            "messages": [{
+                "role": "assistant",
+                "content": response["choices"][0]["message"]["content"]
+            }]
+        }],
+        "history_metadata": history_metadata
+    }
+
+
+def format_upstream_error(status_code, text):
+    # Failed requests get a plain JSON body instead of an event stream
+    try:
+        payload = json.loads(text)
+        if isinstance(payload, dict) and 'error' in payload:
+            return payload
+    except ValueError:
+        pass
+    return {"error": f"Request failed with status code {status_code}: {text}"}
+
+
+# How long a finished answer waits for a title that is still being generated
+TITLE_WAIT_TIMEOUT = 10
+
+def get_placeholder_title(conversation_messages):
+    # Stored until the generated title is written back, also the fallback on errors
+    return conversation_messages[-1]['content']
+
+def prepare_title_messages(conversation_messages):
+    ## make sure the messages are sorted by _ts descending
+    messages = [{'role': msg['role'], 'content': msg['content']} for msg in conversation_messages]
+    messages.append({'role': 'user', 'content': TITLE_PROMPT})
+    return messages
+
+def parse_title(completion):
+    return json.loads(completion['choices'][0]['message']['content'])['title']
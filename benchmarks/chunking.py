@@ -0,0 +1,119 @@
+"""Benchmark of the document chunking of scripts/data_utils.py.
+
+Generates a corpus of text, markdown and python documents and times chunk_content_helper
+against the langchain splitters it replaced, which encode every candidate split again and
+every chunk once more to report its size. Needs the packages of scripts/data_utils.py and
+langchain (requirements-dev.txt). Run it from the repository root:
+
+    python benchmarks/chunking.py --documents 200 --words 5000 --rounds 3
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+WORDS = ["the", "index", "chunk", "token", "search", "document", "azure", "overlap", "embedding",
+         "(see", "below)", "model,", "data;", "cost:", "[1]", "über", "naïve", "résumé"]
+
+
+def sentence(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 24))) + rng.choice([".", ".", "!", "?"])
+
+
+def text_document(rng, words):
+    paragraphs = []
+    while sum(len(p.split()) for p in paragraphs) < words:
+        paragraphs.append(" ".join(sentence(rng) for _ in range(rng.randint(2, 8))))
+    return "\n\n".join(paragraphs)
+
+
+def markdown_document(rng, words):
+    sections = []
+    while sum(len(s.split()) for s in sections) < words:
+        sections.append(f"## Section {len(sections)}\n\n{text_document(rng, 200)}\n\n```\ncode = {len(sections)}\n```")
+    return "# Title\n\n" + "\n\n".join(sections)
+
+
+def python_document(rng, words):
+    functions = []
+    while sum(len(f.split()) for f in functions) < words:
+        body = "\n".join(f"    x{i} = '{sentence(rng)}'" for i in range(rng.randint(3, 12)))
+        functions.append(f"def function_{len(functions)}(x):\n{body}\n    return x\n")
+    return "\n\n".join(functions)
+
+
+def legacy_chunks(content, file_format, num_tokens, token_overlap):
+    # chunk_content_helper before the token chunker
+    from langchain.text_splitter import MarkdownTextSplitter, RecursiveCharacterTextSplitter, PythonCodeTextSplitter
+    from data_utils import TOKEN_ESTIMATOR, parser_factory
+
+    parser = parser_factory(file_format)
+    doc = parser.parse(content)
+    if TOKEN_ESTIMATOR.estimate_tokens(doc.content) < num_tokens:
+        return [doc.content]
+    if file_format == "markdown":
+        splitter = MarkdownTextSplitter.from_tiktoken_encoder(chunk_size=num_tokens, chunk_overlap=token_overlap)
+        chunks, current = [], ""
+        for chunk in splitter.split_text(content):
+            if current and TOKEN_ESTIMATOR.estimate_tokens(current + chunk) > num_tokens:
+                chunks.append(current)
+                current = ""
+            current += chunk
+        chunks.append(current)
+        return [parser.parse(chunk).content for chunk in chunks]
+    if file_format == "python":
+        splitter = PythonCodeTextSplitter.from_tiktoken_encoder(chunk_size=num_tokens, chunk_overlap=token_overlap)
+    else:
+        splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            separators=[".", "!", "?", "\n", "\t", "}", "{", "]", "[", ")", "(", " ", ":", ";", ","],
+            chunk_size=num_tokens, chunk_overlap=token_overlap)
+    chunks = splitter.split_text(doc.content)
+    for chunk in chunks:
+        TOKEN_ESTIMATOR.estimate_tokens(chunk)
+    return chunks
+
+
+def token_chunks(content, file_format, num_tokens, token_overlap):
+    from data_utils import chunk_content_helper
+
+    return [chunk for chunk, _, _ in chunk_content_helper(content, file_format, None, token_overlap, num_tokens)]
+
+
+def bench(name, fn, corpus, rounds, num_tokens, token_overlap):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        chunks = sum(len(fn(content, file_format, num_tokens, token_overlap)) for file_format, content in corpus)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    median = timings[len(timings) // 2]
+    size = sum(len(content) for _, content in corpus)
+    print(f"{name:<16} median {median:7.2f} s  {size / median / 2**20:6.2f} MiB/s  {chunks:7d} chunks")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--words", type=int, default=5000)
+    parser.add_argument("--num-tokens", type=int, default=1024)
+    parser.add_argument("--token-overlap", type=int, default=128)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    generators = {"text": text_document, "markdown": markdown_document, "python": python_document}
+    corpus = [(file_format, generators[file_format](rng, args.words))
+              for file_format in rng.choices(list(generators), k=args.documents)]
+    size = sum(len(content) for _, content in corpus)
+    print(f"{args.documents} documents, {size / 2**20:.1f} MiB, {args.num_tokens} tokens per chunk, overlap {args.token_overlap}")
+
+    bench("langchain", legacy_chunks, corpus, args.rounds, args.num_tokens, args.token_overlap)
+    bench("token chunker", token_chunks, corpus, args.rounds, args.num_tokens, args.token_overlap)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark of the /history endpoints of app.py against the local conversation store.
+
+Seeds one user with conversations and messages, then times the requests the chat history
+panel makes through the Flask test client, without a CosmosDB account. Set the store to use
+with --store (memory or sqlite). Run it from the repository root:
+
+    python benchmarks/history_store.py --store memory --conversations 1000 --rounds 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def bench(name, fn, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        response = fn()
+        timings.append(time.perf_counter() - start)
+        assert response.status_code < 300, response.get_data(as_text=True)
+    timings.sort()
+    median = timings[len(timings) // 2]
+    p95 = timings[int(len(timings) * 0.95)]
+    print(f"{name:<36} median {median * 1000:7.2f} ms  p95 {p95 * 1000:7.2f} ms  {1 / median:8.0f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--conversations", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    # the store is selected when app.py is imported
+    os.environ["CONVERSATION_STORE"] = args.store
+    if args.store == "sqlite":
+        os.environ["CONVERSATION_STORE_SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "history.sqlite3")
+    import app  # noqa: E402
+    from backend.auth.sample_user import sample_user  # noqa: E402
+
+    store = app.cosmos_conversation_client
+    user_id = sample_user["X-Ms-Client-Principal-Id"]
+    conversation_ids = []
+    for i in range(args.conversations):
+        conversation = store.create_conversation(user_id, title=f"Conversation {i}")
+        store.create_messages(conversation["id"], user_id, [
+            {"role": "user" if j % 2 == 0 else "assistant", "content": f"Message {j} of conversation {i}"}
+            for j in range(args.messages)
+        ])
+        conversation_ids.append(conversation["id"])
+    print(f"store: {args.store}, {args.conversations} conversations with {args.messages} messages each")
+
+    client = app.app.test_client()
+    turn = [{"role": "user", "content": "What is the benchmark?"}, {"role": "assistant", "content": "This one."}]
+    bench("GET /history/list (all)", lambda: client.get("/history/list"), args.rounds)
+    bench(f"GET /history/list?page_size={args.page_size}", lambda: client.get(f"/history/list?page_size={args.page_size}"), args.rounds)
+    bench("POST /history/read", lambda: client.post("/history/read", json={"conversation_id": conversation_ids[0]}), args.rounds)
+    bench("POST /history/update", lambda: client.post("/history/update", json={"conversation_id": conversation_ids[-1], "messages": turn}), args.rounds)
+    bench("POST /history/rename", lambda: client.post("/history/rename", json={"conversation_id": conversation_ids[1], "title": "Renamed"}), args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Microbenchmark for parsing the Azure OpenAI "extensions/chat/completions" event stream.
+
+Compares the previous loop (iter_lines with 10 byte reads, one json.loads per line) with the
+buffered SSE parser in backend/sse.py on a synthetic stream: one tool message with citations
+followed by token deltas. Run it from the repository root:
+
+    python benchmarks/sse_parser.py --tokens 2000 --rounds 20
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from backend.sse import SSE_READ_CHUNK_SIZE, iter_sse_json  # noqa: E402
+
+
+def build_stream(tokens, citations):
+    def event(delta):
+        chunk = {
+            "id": "chatcmpl-bench",
+            "model": "gpt-35-turbo-16k",
+            "created": 1700000000,
+            "object": "extensions.chat.completion.chunk",
+            "choices": [{"index": 0, "messages": [{"delta": delta, "index": 0, "end_turn": False}]}]
+        }
+        return b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n"
+
+    tool_content = json.dumps({
+        "citations": [{
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 60,
+            "title": f"Document {i}",
+            "url": f"https://example.com/documents/{i}",
+            "filepath": f"document_{i}.pdf",
+            "chunk_id": str(i)
+        } for i in range(citations)],
+        "intent": "[\"benchmark\"]"
+    })
+
+    parts = [event({"role": "tool", "content": tool_content}), event({"role": "assistant"})]
+    parts += [event({"content": f" token{i}"}) for i in range(tokens)]
+    parts.append(b"data: [DONE]\n\n")
+    return b"".join(parts)
+
+
+def make_response(payload):
+    response = requests.Response()
+    response.raw = io.BytesIO(payload)
+    response.status_code = 200
+    return response
+
+
+def parse_iter_lines(payload):
+    count = 0
+    for line in make_response(payload).iter_lines(chunk_size=10):
+        if line:
+            line = line.lstrip(b'data:').decode('utf-8')
+            if line.strip() == "[DONE]":
+                break
+            json.loads(line)
+            count += 1
+    return count
+
+
+def parse_buffered(payload):
+    count = 0
+    for _ in iter_sse_json(make_response(payload).iter_content(chunk_size=SSE_READ_CHUNK_SIZE)):
+        count += 1
+    return count
+
+
+def bench(name, fn, payload, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        events = fn(payload)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<28} {events:>6} events  {best * 1000:8.2f} ms  {len(payload) / best / 2**20:8.1f} MB/s")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--citations", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    payload = build_stream(args.tokens, args.citations)
+    print(f"stream size: {len(payload) / 1024:.1f} KB")
+    baseline = bench("iter_lines(chunk_size=10)", parse_iter_lines, payload, args.rounds)
+    buffered = bench("buffered SSE parser", parse_buffered, payload, args.rounds)
+    print(f"speedup: {baseline / buffered:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-import { UserInfo, ConversationRequest, Conversation, ChatMessage, CosmosDBHealth, CosmosDBStatus } from "./models";
+import { UserInfo, ConversationRequest, Conversation, ConversationPage, ChatMessage, CosmosDBHealth, CosmosDBStatus } from "./models";
 import { chatHistorySampleData } from "../constants/chatHistory";
 
 export async function conversationApi(options: ConversationRequest, abortSignal: AbortSignal): Promise<Response> {
@@ -35,39 +35,31 @@ export const fetchChatHistoryInit = (): Conversation[] | null => {
     return chatHistorySampleData;
 }
 
-export const historyList = async (): Promise<Conversation[] | null> => {
-    const response = await fetch("/history/list", {
+export const historyList = async (pageSize: number = 50, continuationToken: string | null = null): Promise<ConversationPage | null> => {
+    // One page of conversation headers, the messages are read when a conversation is opened
+    const params = new URLSearchParams({ page_size: pageSize.toString() });
+    if (continuationToken) {
+        params.set("continuation_token", continuationToken);
+    }
+    const response = await fetch(`/history/list?${params.toString()}`, {
         method: "GET",
     }).then(async (res) => {
         const payload = await res.json();
-        if (!Array.isArray(payload)) {
+        if (!Array.isArray(payload?.conversations)) {
             console.error("There was an issue fetching your data.");
             return null;
         }
-        const conversations: Conversation[] = await Promise.all(payload.map(async (conv: any) => {
-            let convMessages: ChatMessage[] = [];
-            convMessages = await historyRead(conv.id)
-            .then((res) => {
-                return res
-            })
-            .catch((err) => {
-                console.error("error fetching messages: ", err)
-                return []
-            })
-            const conversation: Conversation = {
-                id: conv.id,
-                title: conv.title,
-                date: conv.createdAt,
-                messages: convMessages
-            };
-            return conversation;
+        const conversations: Conversation[] = payload.conversations.map((conv: any) => ({
+            id: conv.id,
+            title: conv.title,
+            date: conv.createdAt,
+            messages: []
         }));
-        return conversations;
+        return { conversations, continuationToken: payload.continuation_token ?? null };
     }).catch((err) => {
         console.error("There was an issue fetching your data.");
         return null
     })
-
     return response
 }
 
@@ -111,11 +103,13 @@ export const historyGenerate = async (options: ConversationRequest, abortSignal:
     if(convId){
         body = JSON.stringify({
             conversation_id: convId,
-            messages: options.messages
+            messages: options.messages,
+            save_answer: true
         })
     }else{
         body = JSON.stringify({
-            messages: options.messages
+            messages: options.messages,
+            save_answer: true
         })
     }
     const response = await fetch("/history/generate", {
@@ -35,6 +35,11 @@ export type Conversation = {
     date: string;
 }
 
+export type ConversationPage = {
+    conversations: Conversation[];
+    continuationToken: string | null;
+}
+
 export enum ChatCompletionType {
     ChatCompletion = "chat.completion",
     ChatCompletionChunk = "chat.completion.chunk"
@@ -54,6 +59,7 @@ export type ChatResponse = {
         conversation_id: string;
         title: string;
         date: string;
+        saved?: boolean;
     }
     error?: any;
 }
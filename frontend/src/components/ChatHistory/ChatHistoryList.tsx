@@ -1,8 +1,9 @@
-import { GroupedList, IGroup, IGroupHeaderProps, IRenderFunction, List, Stack, StackItem, Text } from '@fluentui/react';
+import { DefaultButton, GroupedList, IGroup, IGroupHeaderProps, IRenderFunction, List, Stack, StackItem, Text } from '@fluentui/react';
 import React, { useContext } from 'react';
 import { AppStateContext } from '../../state/AppProvider';
 import { ChatHistoryListItemGroups } from './ChatHistoryListItem';
 import { Conversation } from '../../api/models';
+import { historyList } from '../../api';
 
 interface ChatHistoryListProps {}
 
@@ -60,8 +61,23 @@ const groupByMonth = (entries: Conversation[]) => {
 const ChatHistoryList: React.FC<ChatHistoryListProps> = () => {
     const appStateContext = useContext(AppStateContext);
     const chatHistory = appStateContext?.state.chatHistory;
+    const continuationToken = appStateContext?.state.chatHistoryContinuationToken;
+    const [isLoadingMore, setIsLoadingMore] = React.useState(false);
 
     React.useEffect(() => {}, [appStateContext?.state.chatHistory]);
+
+    // the next page, when the list is scrolled to its end or "Load more" is clicked
+    const loadMore = async () => {
+        if (isLoadingMore || !continuationToken) {
+            return;
+        }
+        setIsLoadingMore(true);
+        const page = await historyList(undefined, continuationToken);
+        if (page) {
+            appStateContext?.dispatch({ type: 'FETCH_MORE_CHAT_HISTORY', payload: page });
+        }
+        setIsLoadingMore(false);
+    };
     
     let groupedChatHistory;
     if(chatHistory && chatHistory.length > 0){
@@ -77,7 +93,15 @@ const ChatHistoryList: React.FC<ChatHistoryListProps> = () => {
     }
     
     return (
-        <ChatHistoryListItemGroups groupedChatHistory={groupedChatHistory}/>
+        <ChatHistoryListItemGroups
+            groupedChatHistory={groupedChatHistory}
+            onScrollToEnd={loadMore}
+            footer={continuationToken && (
+                <Stack horizontal horizontalAlign='center' style={{ width: "100%", margin: "10px 0" }}>
+                    <DefaultButton text={isLoadingMore ? "Loading..." : "Load more"} disabled={isLoadingMore} onClick={loadMore}/>
+                </Stack>
+            )}
+        />
     );
 };
 
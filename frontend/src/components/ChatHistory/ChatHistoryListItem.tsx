@@ -7,7 +7,7 @@ import { GroupedChatHistory } from './ChatHistoryList';
 import styles from "./ChatHistoryPanel.module.css"
 import { useBoolean } from '@fluentui/react-hooks';
 import { Conversation } from '../../api/models';
-import { historyDelete, historyRename } from '../../api';
+import { historyDelete, historyRead, historyRename } from '../../api';
 import { useEffect, useRef, useState } from 'react';
 
 interface ChatHistoryListItemCellProps {
@@ -17,6 +17,8 @@ interface ChatHistoryListItemCellProps {
 
 interface ChatHistoryListItemGroupsProps {
   groupedChatHistory: GroupedChatHistory[];
+  footer?: React.ReactNode;
+  onScrollToEnd?: () => void;
 }
 
 const formatMonth = (month: string) => {
@@ -100,8 +102,16 @@ export const ChatHistoryListItemCell: React.FC<ChatHistoryListItemCellProps> = (
         setEditTitle(item?.title)
     };
 
-    const handleSelectItem = () => {
+    const handleSelectItem = async () => {
         onSelect(item)
+        if(item.messages.length === 0){
+            // the history list only has the conversation headers, load the messages on first open
+            const messages = await historyRead(item.id)
+            const conversation = { ...item, messages }
+            appStateContext?.dispatch({ type: 'UPDATE_CURRENT_CHAT', payload: conversation } )
+            appStateContext?.dispatch({ type: 'UPDATE_CHAT_HISTORY', payload: conversation } )
+            return
+        }
         appStateContext?.dispatch({ type: 'UPDATE_CURRENT_CHAT', payload: item } )
     }
 
@@ -243,7 +253,7 @@ export const ChatHistoryListItemCell: React.FC<ChatHistoryListItemCellProps> = (
     );
 };
 
-export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps> = ({ groupedChatHistory }) => {
+export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps> = ({ groupedChatHistory, footer, onScrollToEnd }) => {
   const [ , setSelectedItem] = React.useState<Conversation | null>(null);
  
   const handleSelectHistory = (item?: Conversation) => {
@@ -258,8 +268,15 @@ export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps>
     );
   };
 
+  const handleScroll = (event: React.UIEvent<HTMLDivElement>) => {
+    const list = event.currentTarget;
+    if (onScrollToEnd && list.scrollHeight - list.scrollTop - list.clientHeight < 50) {
+        onScrollToEnd();
+    }
+  };
+
   return (
-    <div className={styles.listContainer}>
+    <div className={styles.listContainer} onScroll={handleScroll}>
       {groupedChatHistory.map((group) => (
         group.entries.length > 0 && <Stack horizontalAlign="start" verticalAlign="center" key={group.month} className={styles.chatGroup} aria-label={`chat history group: ${group.month}`}>
           <Stack aria-label={group.month} className={styles.chatMonth}>{formatMonth(group.month)}</Stack>
@@ -275,6 +292,7 @@ export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps>
           }}/>
         </Stack>
       ))}
+      {footer}
     </div>
   );
 };
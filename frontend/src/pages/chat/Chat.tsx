@@ -46,6 +46,8 @@ const Chat = () => {
     const [activeCitation, setActiveCitation] = useState<[content: string, id: string, title: string, filepath: string, url: string, metadata: string]>();
     const [isCitationPanelOpen, setIsCitationPanelOpen] = useState<boolean>(false);
     const abortFuncs = useRef([] as AbortController[]);
+    // set when /history/generate has saved the answer itself, see historyGenerate
+    const answerSaved = useRef<boolean>(false);
     const [showAuthMessage, setShowAuthMessage] = useState<boolean>(true);
     const [messages, setMessages] = useState<ChatMessage[]>([])
     const [processMessages, setProcessMessages] = useState<messageStatus>(messageStatus.NotRunning);
@@ -239,6 +241,7 @@ const Chat = () => {
             setMessages(request.messages)
         }
         let result = {} as ChatResponse;
+        answerSaved.current = false;
         try {
             const response = conversationId ? await historyGenerate(request, abortController.signal, conversationId) : await historyGenerate(request, abortController.signal);
             if(!response?.ok){
@@ -327,6 +330,7 @@ const Chat = () => {
                     abortFuncs.current = abortFuncs.current.filter(a => a !== abortController);
                     return;
                 }
+                answerSaved.current = !!result.history_metadata?.saved;
                 appStateContext?.dispatch({ type: 'UPDATE_CURRENT_CHAT', payload: resultConversation });
                 setMessages([...messages, ...result.choices[0].messages]);
             }
@@ -446,7 +450,9 @@ const Chat = () => {
         }
 
         if (appStateContext && appStateContext.state.currentChat && processMessages === messageStatus.Done) {
-                if(appStateContext.state.isCosmosDBAvailable.cosmosDB){
+                if(appStateContext.state.isCosmosDBAvailable.cosmosDB && answerSaved.current){
+                    answerSaved.current = false;
+                }else if(appStateContext.state.isCosmosDBAvailable.cosmosDB){
                     if(!appStateContext?.state.currentChat?.messages){
                         console.error("Failure fetching current chat state.")
                         return 
@@ -1,13 +1,14 @@
 import React, { createContext, useReducer, ReactNode, useEffect } from 'react';
 import { appStateReducer } from './AppReducer';
 import { ChatHistoryLoadingState, CosmosDBHealth, historyList, historyEnsure, CosmosDBStatus } from '../api';
-import { Conversation } from '../api';
+import { Conversation, ConversationPage } from '../api';
   
 export interface AppState {
     isChatHistoryOpen: boolean;
     chatHistoryLoadingState: ChatHistoryLoadingState;
     isCosmosDBAvailable: CosmosDBHealth;
     chatHistory: Conversation[] | null;
+    chatHistoryContinuationToken: string | null;
     filteredChatHistory: Conversation[] | null;
     currentChat: Conversation | null;
 }
@@ -23,12 +24,14 @@ export type Action =
     | { type: 'DELETE_CHAT_ENTRY', payload: string } // API Call
     | { type: 'DELETE_CHAT_HISTORY'}  // API Call
     | { type: 'DELETE_CURRENT_CHAT_MESSAGES', payload: string }  // API Call
-    | { type: 'FETCH_CHAT_HISTORY', payload: Conversation[] | null }  // API Call
+    | { type: 'FETCH_CHAT_HISTORY', payload: ConversationPage | null }  // API Call
+    | { type: 'FETCH_MORE_CHAT_HISTORY', payload: ConversationPage }  // API Call
 
 const initialState: AppState = {
     isChatHistoryOpen: false,
     chatHistoryLoadingState: ChatHistoryLoadingState.Loading,
     chatHistory: null,
+    chatHistoryContinuationToken: null,
     filteredChatHistory: null,
     currentChat: null,
     isCosmosDBAvailable: {
@@ -51,7 +54,8 @@ type AppStateProviderProps = {
 
     useEffect(() => {
         // Check for cosmosdb config and fetch initial data here
-        const fetchChatHistory = async (): Promise<Conversation[] | null> => {
+        // only the first page, later pages are loaded from the chat history list
+        const fetchChatHistory = async (): Promise<ConversationPage | null> => {
             const result = await historyList().then((response) => {
                 if(response){
                     dispatch({ type: 'FETCH_CHAT_HISTORY', payload: response });
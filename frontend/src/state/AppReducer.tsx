@@ -47,7 +47,7 @@ export const appStateReducer = (state: AppState, action: Action): AppState => {
             return { ...state, chatHistory: filteredChat };
         case 'DELETE_CHAT_HISTORY':
             //TODO: make api call to delete all conversations from DB
-            return { ...state, chatHistory: [], filteredChatHistory: [], currentChat: null };
+            return { ...state, chatHistory: [], chatHistoryContinuationToken: null, filteredChatHistory: [], currentChat: null };
         case 'DELETE_CURRENT_CHAT_MESSAGES':
             //TODO: make api call to delete current conversation messages from DB
             if(!state.currentChat || !state.chatHistory){
@@ -62,7 +62,19 @@ export const appStateReducer = (state: AppState, action: Action): AppState => {
                 currentChat: updatedCurrentChat
             };
         case 'FETCH_CHAT_HISTORY':
-            return { ...state, chatHistory: action.payload };
+            return {
+                ...state,
+                chatHistory: action.payload?.conversations ?? null,
+                chatHistoryContinuationToken: action.payload?.continuationToken ?? null
+            };
+        case 'FETCH_MORE_CHAT_HISTORY':
+            // conversations created or moved up since the first page are already listed
+            const listedIds = new Set((state.chatHistory ?? []).map(chat => chat.id));
+            return {
+                ...state,
+                chatHistory: [...(state.chatHistory ?? []), ...action.payload.conversations.filter(chat => !listedIds.has(chat.id))],
+                chatHistoryContinuationToken: action.payload.continuationToken
+            };
         case 'SET_COSMOSDB_STATUS':
             return { ...state, isCosmosDBAvailable: action.payload };
         default:
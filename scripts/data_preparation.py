@@ -13,7 +13,7 @@ from azure.identity import AzureCliCredential
 from azure.search.documents import SearchClient
 from tqdm import tqdm
 
-from data_utils import chunk_directory
+from data_utils import chunk_directory, legacy_chunk_ids, IngestionManifest
 
 SUPPORTED_LANGUAGE_CODES = {
     "ar": "Arabic",
@@ -247,7 +247,7 @@ def create_or_update_search_index(
     
     return True
 
-def upload_documents_to_index(service_name, subscription_id, resource_group, index_name, docs, credential, upload_batch_size = 50):
+def upload_documents_to_index(service_name, subscription_id, resource_group, index_name, docs, credential, upload_batch_size = 50, deleted_ids = (), delete_legacy_ids = False):
     if credential is None:
         raise ValueError("credential cannot be None")
     
@@ -256,12 +256,14 @@ def upload_documents_to_index(service_name, subscription_id, resource_group, ind
     id = 0
     for document in docs:
         d = dataclasses.asdict(document)
-        # add id to documents
-        d.update({"@search.action": "upload", "id": str(id)})
+        # add id to documents, chunks of files have a stable id
+        d.update({"@search.action": "upload", "id": document.id or str(id)})
         if "contentVector" in d and d["contentVector"] is None:
             del d["contentVector"]
         to_upload_dicts.append(d)
         id += 1
+    # chunks of removed or shrunk files, and with delete_legacy_ids those numbered by an earlier version
+    to_upload_dicts.extend({"@search.action": "delete", "id": deleted_id} for deleted_id in deleted_ids)
     
     endpoint = "https://{}.search.windows.net/".format(service_name)
     admin_key = json.loads(
@@ -277,6 +279,8 @@ def upload_documents_to_index(service_name, subscription_id, resource_group, ind
         index_name=index_name,
         credential=AzureKeyCredential(admin_key),
     )
+    if delete_legacy_ids:
+        to_upload_dicts.extend({"@search.action": "delete", "id": legacy_id} for legacy_id in legacy_chunk_ids(search_client))
     # Upload the documents in batches of upload_batch_size
     for i in tqdm(range(0, len(to_upload_dicts), upload_batch_size), desc="Indexing Chunks..."):
         batch = to_upload_dicts[i: i + upload_batch_size]
@@ -332,7 +336,8 @@ def validate_index(service_name, subscription_id, resource_group, index_name):
                 print(f"Request failed. Please investigate. Status code: {response.status_code}")
             break
 
-def create_index(config, credential, form_recognizer_client=None, embedding_model_endpoint=None, use_layout=False, njobs=4):
+def create_index(config, credential, form_recognizer_client=None, embedding_model_endpoint=None, use_layout=False, njobs=4, embedding_concurrency=4,
+                 embedding_requests_per_minute=None, embedding_tokens_per_minute=None, embedding_cache_path=None, manifest_path=None):
     service_name = config["search_service_name"]
     subscription_id = config["subscription_id"]
     resource_group = config["resource_group"]
@@ -358,26 +363,38 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
     if not create_or_update_search_index(service_name, subscription_id, resource_group, index_name, config["semantic_config_name"], credential, language, vector_config_name=config.get("vector_config_name", None)):
         raise Exception(f"Failed to create or update index {index_name}")
     
-    # chunk directory
+    # chunk directory, only the files that changed since the last run with a manifest
     print("Chunking directory...")
+    manifest = IngestionManifest(manifest_path) if manifest_path else None
     add_embeddings = False
     if config.get("vector_config_name") and embedding_model_endpoint:
         add_embeddings = True
     result = chunk_directory(config["data_path"], num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
                              azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
-                             add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint)
+                             add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, embedding_concurrency=embedding_concurrency,
+                             embedding_requests_per_minute=embedding_requests_per_minute, embedding_tokens_per_minute=embedding_tokens_per_minute,
+                             embedding_cache_path=embedding_cache_path, manifest=manifest)
 
-    if len(result.chunks) == 0:
+    # with a manifest, no chunks means that no file changed
+    if len(result.chunks) == 0 and (manifest is None or not manifest.files):
         raise Exception("No chunks found. Please check the data path and chunk size.")
 
     print(f"Processed {result.total_files} files")
+    if manifest is not None:
+        print(f"Unchanged: {result.num_unchanged_files} files")
     print(f"Unsupported formats: {result.num_unsupported_format_files} files")
     print(f"Files with errors: {result.num_files_with_errors} files")
     print(f"Found {len(result.chunks)} chunks")
+    if manifest is not None:
+        print(f"Deleting {len(result.deleted_ids)} chunks")
 
     # upload documents to index
     print("Uploading documents to index...")
-    upload_documents_to_index(service_name, subscription_id, resource_group, index_name, result.chunks, credential)
+    # every file was ingested, chunks left by runs before chunk ids were stable are replaced
+    upload_documents_to_index(service_name, subscription_id, resource_group, index_name, result.chunks, credential, deleted_ids=result.deleted_ids,
+                              delete_legacy_ids=manifest is None or manifest.created)
+    if manifest is not None:
+        manifest.save()
 
     # check if index is ready/validate index
     print("Validating index...")
@@ -388,7 +405,7 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
 def valid_range(n):
     n = int(n)
     if n < 1 or n > 32:
-        raise argparse.ArgumentTypeError("njobs must be an Integer between 1 and 32.")
+        raise argparse.ArgumentTypeError("Must be an Integer between 1 and 32.")
     return n
 
 if __name__ == "__main__": 
@@ -400,6 +417,11 @@ if __name__ == "__main__":
     parser.add_argument("--njobs", type=valid_range, default=4, help="Number of jobs to run (between 1 and 32). Default=4")
     parser.add_argument("--embedding-model-endpoint", type=str, help="Endpoint for the embedding model to use for vector search. Format: 'https://<AOAI resource name>.openai.azure.com/openai/deployments/<Ada deployment name>/embeddings?api-version=2023-03-15-preview'")
     parser.add_argument("--embedding-model-key", type=str, help="Key for the embedding model to use for vector search.")
+    parser.add_argument("--embedding-concurrency", type=valid_range, default=4, help="Number of embedding requests to run at a time (between 1 and 32). Default=4")
+    parser.add_argument("--embedding-rpm", type=int, help="Requests per minute quota of the embedding model deployment. Requests are scheduled to stay within it.")
+    parser.add_argument("--embedding-tpm", type=int, help="Tokens per minute quota of the embedding model deployment. Requests are scheduled to stay within it.")
+    parser.add_argument("--embedding-cache", type=str, help="SQLite file to keep embeddings in across runs. Only chunks that aren't in it yet are embedded.")
+    parser.add_argument("--manifest-dir", type=str, help="Directory to keep a manifest of the ingested files of each index in. Only new and changed files are ingested, chunks of removed files are deleted.")
     args = parser.parse_args()
 
     with open(args.config) as f:
@@ -421,7 +443,10 @@ if __name__ == "__main__":
         if index_config.get("vector_config_name") and not args.embedding_model_endpoint:
             raise Exception("ERROR: Vector search is enabled in the config, but no embedding model endpoint and key were provided. Please provide these values or disable vector search.")
     
-        create_index(index_config, credential, form_recognizer_client, embedding_model_endpoint=args.embedding_model_endpoint, use_layout=args.form_rec_use_layout, njobs=args.njobs)
+        create_index(index_config, credential, form_recognizer_client, embedding_model_endpoint=args.embedding_model_endpoint, use_layout=args.form_rec_use_layout, njobs=args.njobs, embedding_concurrency=args.embedding_concurrency,
+                     embedding_requests_per_minute=args.embedding_rpm, embedding_tokens_per_minute=args.embedding_tpm,
+                     embedding_cache_path=args.embedding_cache,
+                     manifest_path=os.path.join(args.manifest_dir, f"{index_config['index_name']}.manifest.json") if args.manifest_dir else None)
         print("Data preparation for index", index_config["index_name"], "completed")
 
     print(f"Data preparation script completed. {len(config)} indexes updated.")
\ No newline at end of file
@@ -1,16 +1,22 @@
 """Data utilities for index preparation."""
 import ast
-from asyncio import sleep
+import hashlib
 import html
 import json
 import os
+import random
 import re
 import requests
+import sqlite3
+import threading
+import time
 import openai
 from abc import ABC, abstractmethod
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import dataclass
-from functools import partial
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 from typing import List, Dict, Optional, Generator, Tuple
 
 import markdown
@@ -18,8 +24,8 @@ import tiktoken
 from azure.identity import DefaultAzureCredential
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ResourceNotFoundError
 from bs4 import BeautifulSoup
-from langchain.text_splitter import MarkdownTextSplitter, RecursiveCharacterTextSplitter, PythonCodeTextSplitter
 from tqdm import tqdm
 
 FILE_FORMAT_DICT = {
@@ -34,8 +40,37 @@ FILE_FORMAT_DICT = {
 
 RETRY_COUNT = 5
 
-SENTENCE_ENDINGS = [".", "!", "?"]
-WORDS_BREAKS = list(reversed([",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]))
+# Chunks are embedded in requests of up to EMBEDDING_BATCH_SIZE inputs and EMBEDDING_BATCH_TOKENS
+# tokens, EMBEDDING_CONCURRENCY requests at a time
+EMBEDDING_BATCH_SIZE = 16
+EMBEDDING_BATCH_TOKENS = 8191
+EMBEDDING_CONCURRENCY = 4
+
+# Backoff of embedding requests that failed, doubled on every retry up to the maximum, in seconds
+EMBEDDING_RETRY_BACKOFF = 2
+EMBEDDING_RETRY_MAX_BACKOFF = 60
+
+# Vectors kept by the embedding cache, about 6 KB each for text-embedding-ada-002
+EMBEDDING_CACHE_MAXSIZE = 200000
+
+# Where chunks may end, strongest break first; each pattern matches the position of a break, see TokenChunker
+TEXT_BREAKS = [
+    r"(?<=[.!?])(?=\s|$)",
+    r"(?=[\s(\[{])|(?<=[,;:)\]}])",
+]
+PYTHON_BREAKS = [
+    r"(?=\nclass )|(?=\ndef )|(?=\n\tdef )",
+    r"(?=\n\n)",
+    r"(?=\n)",
+    r"(?=\s)",
+]
+MARKDOWN_BREAKS = [
+    r"(?=\n#{1,6} )",
+    r"(?=```\n)|(?=\n(?:\*\*\*+|---+|___+)\n)",
+    r"(?=\n\n)",
+    r"(?=\n)",
+    r"(?=\s)",
+]
 
 PDF_HEADERS = {
     "title": "h1",
@@ -268,8 +303,15 @@ class ParserFactory:
 
         return parser
 
+@lru_cache(maxsize=None)
+def gpt2_tokenizer():
+    # loaded on first use, tiktoken downloads it the first time
+    return tiktoken.get_encoding("gpt2")
+
 class TokenEstimator(object):
-    GPT2_TOKENIZER = tiktoken.get_encoding("gpt2")
+    @property
+    def GPT2_TOKENIZER(self):
+        return gpt2_tokenizer()
 
     def estimate_tokens(self, text: str) -> int:
         return len(self.GPT2_TOKENIZER.encode(text))
@@ -280,8 +322,93 @@ class TokenEstimator(object):
         )
         return newTokens
 
+class TokenChunker(object):
+    """Splits text into chunks of at most num_tokens tokens, encoding it once.
+
+    Chunks are slices of the token array. Each one ends at the strongest break (see
+    TEXT_BREAKS) in the second half of its window, at the last weakest break otherwise, and
+    only mid-word when there is none. The next chunk starts exactly token_overlap tokens
+    before the end of the previous one. Sizes are the lengths of the slices, the text of a
+    chunk is cut from the original text at the character offsets of its tokens. A character
+    of more tokens than num_tokens is a chunk of its own.
+    """
+
+    def __init__(self, breaks: List[str] = TEXT_BREAKS, encoding = None):
+        self.breaks = [re.compile(pattern) for pattern in breaks]
+        self._encoding = encoding
+
+    @property
+    def encoding(self):
+        return self._encoding or gpt2_tokenizer()
+
+    def encode(self, text: str) -> Tuple[List[int], List[Optional[int]]]:
+        """Tokens of the text and the character offset of every token boundary, None where
+        a boundary falls inside a character of several bytes."""
+        tokens = self.encoding.encode(text, disallowed_special=())
+        byte_offsets = [0]
+        for token_bytes in self.encoding.decode_tokens_bytes(tokens):
+            byte_offsets.append(byte_offsets[-1] + len(token_bytes))
+        if text.isascii():
+            return tokens, byte_offsets
+        char_offsets = {}
+        byte_offset = 0
+        for char_offset, char in enumerate(text):
+            char_offsets[byte_offset] = char_offset
+            byte_offset += len(char.encode("utf-8"))
+        char_offsets[byte_offset] = len(text)
+        return tokens, [char_offsets.get(offset) for offset in byte_offsets]
+
+    def _break_boundaries(self, text: str, offsets: List[Optional[int]]) -> List[List[int]]:
+        # token boundaries at the breaks of each strength, in ascending order
+        boundary_at = {offset: i for i, offset in enumerate(offsets) if offset is not None}
+        return [
+            sorted({boundary_at[m.start()] for m in pattern.finditer(text) if m.start() in boundary_at})
+            for pattern in self.breaks
+        ]
+
+    def _chunk_end(self, start: int, limit: int, boundaries: List[List[int]], offsets: List[Optional[int]]) -> int:
+        for strength, candidates in enumerate(boundaries):
+            # weaker breaks than the last are only taken in the second half of the window
+            lowest = start if strength == len(boundaries) - 1 else start + (limit - start) // 2
+            i = bisect_right(candidates, limit) - 1
+            if i >= 0 and candidates[i] > lowest:
+                return candidates[i]
+        end = limit
+        while end > start + 1 and offsets[end] is None:
+            end -= 1
+        # the window ends inside the first character, which is taken whole
+        while offsets[end] is None:
+            end += 1
+        return end
+
+    def chunk(self, text: str, num_tokens: int, token_overlap: int = 0) -> Generator[Tuple[str, int], None, None]:
+        """Yields (content, number of tokens) of the chunks of the text, in order."""
+        tokens, offsets = self.encode(text)
+        yield from self.chunk_tokens(text, tokens, offsets, num_tokens, token_overlap)
+
+    def chunk_tokens(self, text: str, tokens: List[int], offsets: List[Optional[int]], num_tokens: int,
+                     token_overlap: int = 0) -> Generator[Tuple[str, int], None, None]:
+        """Like chunk(), for text that is already encoded, see encode()."""
+        token_overlap = max(0, min(token_overlap, num_tokens - 1))
+        boundaries = self._break_boundaries(text, offsets)
+        start = 0
+        while start < len(tokens):
+            limit = min(start + num_tokens, len(tokens))
+            end = len(tokens) if limit == len(tokens) else self._chunk_end(start, limit, boundaries, offsets)
+            content = text[offsets[start]:offsets[end]].strip()
+            if content:
+                yield content, end - start
+            if end == len(tokens):
+                break
+            start = max(end - token_overlap, start + 1)
+            while start < end and offsets[start] is None:
+                start += 1
+
 parser_factory = ParserFactory()
 TOKEN_ESTIMATOR = TokenEstimator()
+TEXT_CHUNKER = TokenChunker(TEXT_BREAKS)
+PYTHON_CHUNKER = TokenChunker(PYTHON_BREAKS)
+MARKDOWN_CHUNKER = TokenChunker(MARKDOWN_BREAKS)
 
 class UnsupportedFormatError(Exception):
     """Exception raised when a format is not supported by a parser."""
@@ -298,6 +425,9 @@ class ChunkingResult:
         num_unsupported_format_files (int): Number of files with unsupported format.
         num_files_with_errors (int): Number of files with errors.
         skipped_chunks (int): Number of chunks skipped.
+        deleted_ids (List[str]): Ids of the chunks of removed or shrunk files to delete from the index.
+        num_unchanged_files (int): Number of files skipped because they didn't change since the last run.
+        chunk_sizes (List[int]): Number of tokens of each chunk.
     """
     chunks: List[Document]
     total_files: int
@@ -305,6 +435,101 @@ class ChunkingResult:
     num_files_with_errors: int = 0
     # some chunks might be skipped to small number of tokens
     skipped_chunks: int = 0
+    deleted_ids: List[str] = field(default_factory=list)
+    num_unchanged_files: int = 0
+    chunk_sizes: List[int] = field(default_factory=list)
+
+
+def chunk_id(filepath: str, chunk_index: int) -> str:
+    """The index id of a chunk, the same on every run for the same file path and chunk."""
+    return hashlib.sha256(f"{filepath}\n{chunk_index}".encode("utf-8")).hexdigest()[:32]
+
+
+def legacy_chunk_ids(search_client) -> List[str]:
+    """The ids an index may still have from before chunk_id, when the chunks of a run were
+    numbered from 0. Empty if the index has no chunk "0"; deleting an id that doesn't exist is
+    harmless."""
+    try:
+        search_client.get_document(key="0", selected_fields=["id"])
+    except ResourceNotFoundError:
+        return []
+    return [str(i) for i in range(search_client.get_document_count())]
+
+
+def file_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestionManifest(object):
+    """The files of a directory as of the last ingestion into an index, kept in a JSON file.
+
+    Every file has its size, mtime, content hash, number of chunks and the fingerprint of the
+    settings it was chunked and embedded with. A file whose size and mtime are unchanged isn't
+    read; one whose hash is unchanged isn't processed again, unless the settings changed. The
+    manifest should only be saved once the changes it records are uploaded. created is True
+    when there was no manifest yet, i.e. every file is ingested.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.files = {}
+        self.created = not os.path.exists(path)
+        if not self.created:
+            with open(path, "r", encoding="utf8") as f:
+                self.files = json.load(f).get("files", {})
+
+    @staticmethod
+    def fingerprint(**settings) -> str:
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def changes(self, directory_path: str, file_paths: List[str], fingerprint: Optional[str] = None) -> Tuple[List[str], List[str]]:
+        """The files to process, and the relative paths of the files removed since the last run."""
+        changed = []
+        seen = set()
+        for file_path in file_paths:
+            rel_file_path = os.path.relpath(file_path, directory_path)
+            seen.add(rel_file_path)
+            entry = self.files.get(rel_file_path)
+            if entry is None or entry.get("settings") != fingerprint:
+                changed.append(file_path)
+                continue
+            stat = os.stat(file_path)
+            if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                continue
+            if entry["size"] == stat.st_size and entry["sha256"] == file_hash(file_path):
+                # touched but not changed, checked by size and mtime again next time
+                entry["mtime"] = stat.st_mtime
+                continue
+            changed.append(file_path)
+        return changed, [rel_file_path for rel_file_path in self.files if rel_file_path not in seen]
+
+    def chunk_count(self, rel_file_path: str) -> int:
+        entry = self.files.get(rel_file_path)
+        return entry["chunks"] if entry else 0
+
+    def update(self, file_path: str, rel_file_path: str, chunks: int, fingerprint: Optional[str] = None):
+        stat = os.stat(file_path)
+        self.files[rel_file_path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": file_hash(file_path),
+            "chunks": chunks,
+            "settings": fingerprint
+        }
+
+    def remove(self, rel_file_path: str):
+        self.files.pop(rel_file_path, None)
+
+    def save(self):
+        # replaced in one step, an interrupted save leaves the previous manifest
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf8") as f:
+            json.dump({"files": self.files}, f)
+        os.replace(temp_path, self.path)
 
 def get_files_recursively(directory_path: str) -> List[str]:
     """Gets all files in the given directory recursively.
@@ -418,40 +643,304 @@ def extract_pdf_content(file_path, form_recognizer_client, use_layout=False):
     full_text = "".join([page_text for _, _, page_text in page_map])
     return full_text
 
-def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int) -> Generator[Tuple[str, int], None, None]:
-    # TODO: solve for token overlap
-    current_chunk = ""
-    total_size = 0
-    for chunked_content in chunked_content_list:
-        chunk_size = TOKEN_ESTIMATOR.estimate_tokens(chunked_content)
-        if total_size > 0:
-            new_size = total_size + chunk_size
-            if new_size > num_tokens:
-                yield current_chunk, total_size
-                current_chunk = ""
-                total_size = 0
-        total_size += chunk_size
-        current_chunk += chunked_content
-    if total_size > 0:
-        yield current_chunk, total_size
-
-
-def get_embedding(text, azure_credential, embedding_endpoint):
+def get_embeddings(texts: List[str], azure_credential, embedding_endpoint) -> List[List[float]]:
     try:
         endpoint_parts = embedding_endpoint.split("/openai/deployments/")
         base_url = endpoint_parts[0]
         deployment_id = endpoint_parts[1].split("/embeddings")[0]
 
-        openai.api_version = '2023-05-15'
-        openai.api_base = base_url
-        openai.api_key = azure_credential.get_token("https://cognitiveservices.azure.com/.default").token
-        openai.api_type = "azure_ad"
-
-        embeddings = openai.Embedding.create(deployment_id=deployment_id, input=text)
-        return embeddings['data'][0]["embedding"]
+        # the settings are passed per request rather than set on the module, requests run in threads
+        embeddings = openai.Embedding.create(
+            deployment_id=deployment_id,
+            input=texts,
+            api_version='2023-05-15',
+            api_base=base_url,
+            api_key=azure_credential.get_token("https://cognitiveservices.azure.com/.default").token,
+            api_type="azure_ad"
+        )
+        return [item["embedding"] for item in sorted(embeddings['data'], key=lambda item: item["index"])]
 
     except Exception as e:
-        raise Exception(f"Error getting embeddings with endpoint={embedding_endpoint} with error={e}")
+        raise Exception(f"Error getting embeddings with endpoint={embedding_endpoint} with error={e}") from e
+
+
+def get_embedding(text, azure_credential, embedding_endpoint):
+    return get_embeddings([text], azure_credential, embedding_endpoint)[0]
+
+
+class EmbeddingRateLimiter(object):
+    """Schedules embedding requests within a requests and tokens per minute budget.
+
+    Both budgets are token buckets that hold a minute's worth and refill continuously; a
+    budget of None is unlimited. A throttled request (429) pauses every request for the
+    Retry-After of the response; server errors (5xx), timeouts and connection errors are
+    retried after a jittered exponential backoff, other errors (e.g. 400) are raised at once.
+    One limiter is shared by all the threads that send embedding requests.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                 retries: int = RETRY_COUNT, backoff: float = EMBEDDING_RETRY_BACKOFF,
+                 max_backoff: float = EMBEDDING_RETRY_MAX_BACKOFF):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0
+        self.requests = 0
+        self.throttled = 0
+        self.retried = 0
+
+    def _refill(self, now):
+        elapsed = now - self.refilled_at
+        self.refilled_at = now
+        if self.requests_per_minute:
+            self.available_requests = min(self.requests_per_minute,
+                                          self.available_requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self.available_tokens = min(self.tokens_per_minute,
+                                        self.available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens: int):
+        """Blocks until a request of the given number of tokens fits the budgets, and takes it."""
+        if self.tokens_per_minute:
+            # a request larger than the budget waits for a full bucket
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if self.requests_per_minute and self.available_requests < 1:
+                    wait = max(wait, (1 - self.available_requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute and self.available_tokens < tokens:
+                    wait = max(wait, (tokens - self.available_tokens) * 60 / self.tokens_per_minute)
+                if wait <= 0:
+                    if self.requests_per_minute:
+                        self.available_requests -= 1
+                    if self.tokens_per_minute:
+                        self.available_tokens -= tokens
+                    self.requests += 1
+                    return
+            time.sleep(wait)
+
+    def _retryable(self, error):
+        error = error.__cause__ or error
+        if isinstance(error, (openai.error.APIConnectionError, openai.error.Timeout, openai.error.TryAgain,
+                              openai.error.ServiceUnavailableError, openai.error.RateLimitError,
+                              requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        status = getattr(error, "http_status", None)
+        return status is not None and (status == 429 or status >= 500)
+
+    def _retry_after(self, error):
+        error = error.__cause__ or error
+        if getattr(error, "http_status", None) != 429 and not isinstance(error, openai.error.RateLimitError):
+            return None
+        headers = getattr(error, "headers", None) or {}
+        for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+            try:
+                return float(headers[header]) * scale
+            except (KeyError, TypeError, ValueError):
+                continue
+        return 0
+
+    def call(self, fn, tokens: int = 0):
+        """Calls fn within the budgets, retrying it when it fails with a retryable error; raises the last error."""
+        for attempt in range(self.retries + 1):
+            self.acquire(tokens)
+            try:
+                return fn()
+            except Exception as e:
+                if attempt == self.retries or not self._retryable(e):
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+                retry_after = self._retry_after(e)
+                with self.lock:
+                    self.retried += 1
+                    if retry_after is not None:
+                        self.throttled += 1
+                        # the whole deployment is throttled, not only this request
+                        delay = max(delay, retry_after)
+                        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                time.sleep(delay)
+
+    def stats(self) -> Dict[str, int]:
+        return {"requests": self.requests, "throttled": self.throttled, "retried": self.retried}
+
+
+class EmbeddingCache(object):
+    """Embeddings of chunk texts in a local SQLite file, kept across runs.
+
+    Vectors are keyed by the hash of the embedding deployment and the text and stored as
+    float32 arrays. Once more than maxsize vectors are stored, the least recently used are
+    evicted. Only used from the thread that created it.
+    """
+
+    LOOKUP_BATCH = 500
+
+    def __init__(self, path: str, maxsize: int = EMBEDDING_CACHE_MAXSIZE):
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB, used_at REAL) WITHOUT ROWID")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used_at ON embeddings (used_at)")
+
+    @staticmethod
+    def key(deployment: str, text: str) -> bytes:
+        return hashlib.sha256(f"{deployment}\n{text}".encode("utf-8")).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, List[float]]:
+        """The cached vectors of the keys, by key; missing keys are left out."""
+        found = {}
+        unique_keys = list(set(keys))
+        for i in range(0, len(unique_keys), self.LOOKUP_BATCH):
+            batch = unique_keys[i:i + self.LOOKUP_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            for key, vector in self.conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch):
+                found[key] = array("f", vector).tolist()
+            self.conn.execute(f"UPDATE embeddings SET used_at = ? WHERE key IN ({placeholders})", [time.time(), *batch])
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def set_many(self, items: Dict[bytes, List[float]], evict: bool = True):
+        ## without evict, the cache may exceed maxsize until evict() is called
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector, used_at) VALUES (?, ?, ?)",
+            [(key, array("f", vector).tobytes(), now) for key, vector in items.items()]
+        )
+        if evict:
+            self.evict()
+
+    def evict(self):
+        cursor = self.conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,)
+        )
+        self.evicted += max(0, cursor.rowcount)
+
+    def size(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": self.size(),
+            "evicted": self.evicted
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+def embedding_deployment(embedding_endpoint: str) -> str:
+    # the endpoint without its api-version, vectors don't depend on it
+    return embedding_endpoint.split("/embeddings")[0].rstrip("/")
+
+
+def batch_by_tokens(sizes: List[int], max_size: int = EMBEDDING_BATCH_SIZE,
+                    max_tokens: int = EMBEDDING_BATCH_TOKENS) -> List[List[int]]:
+    """Packs consecutive items into batches of at most max_size items and max_tokens tokens.
+    Returns the indexes of the items of each batch. An item larger than max_tokens is a batch
+    of its own."""
+    batches = []
+    batch, batch_tokens = [], 0
+    for i, size in enumerate(sizes):
+        if batch and (len(batch) == max_size or batch_tokens + size > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_documents(
+        documents: List[Document], azure_credential, embedding_endpoint,
+        sizes: Optional[List[int]] = None,
+        concurrency: int = EMBEDDING_CONCURRENCY,
+        ignore_errors: bool = False,
+        rate_limiter: Optional[EmbeddingRateLimiter] = None,
+        cache: Optional[EmbeddingCache] = None
+) -> int:
+    """Sets the contentVector of the documents, embedding their content in batches.
+    Args:
+        documents (List[Document]): The documents to embed.
+        sizes (List[int]): The number of tokens of each document, estimated if None.
+        concurrency (int): The number of embedding requests to run at a time.
+        ignore_errors (bool): If true, leaves the contentVector of documents whose batch
+            failed as None. Otherwise raises the error.
+        rate_limiter (EmbeddingRateLimiter): Schedules and retries the requests, one without
+            budgets if None.
+        cache (EmbeddingCache): Vectors found there aren't requested again, the vectors of
+            each batch are added to it as soon as the batch is embedded.
+    Returns:
+        int: The number of documents that weren't embedded.
+    """
+    # the indexes of the documents to embed
+    missing = list(range(len(documents)))
+    if cache is not None:
+        deployment = embedding_deployment(embedding_endpoint)
+        keys = [EmbeddingCache.key(deployment, doc.content) for doc in documents]
+        cached = cache.get_many(keys)
+        for doc, key in zip(documents, keys):
+            doc.contentVector = cached.get(key)
+        missing = [i for i, doc in enumerate(documents) if doc.contentVector is None]
+        if not missing:
+            return 0
+
+    if sizes is None:
+        tokens = TOKEN_ESTIMATOR.GPT2_TOKENIZER.encode_batch([documents[i].content for i in missing], disallowed_special=())
+        sizes = dict(zip(missing, (len(doc_tokens) for doc_tokens in tokens)))
+
+    rate_limiter = rate_limiter or EmbeddingRateLimiter()
+
+    def embed_batch(batch):
+        texts = [documents[i].content for i in batch]
+        return rate_limiter.call(lambda: get_embeddings(texts, azure_credential, embedding_endpoint),
+                                 tokens=sum(sizes[i] for i in batch))
+
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            batches = [[missing[j] for j in batch] for batch in batch_by_tokens([sizes[i] for i in missing])]
+            futures = [executor.submit(embed_batch, batch) for batch in batches]
+            for batch, future in zip(batches, futures):
+                try:
+                    vectors = future.result()
+                except Exception:
+                    if not ignore_errors:
+                        for pending in futures:
+                            pending.cancel()
+                        raise
+                    failed += len(batch)
+                    continue
+                # results come back in the order of the batches, vectors in the order of their inputs
+                for i, vector in zip(batch, vectors):
+                    documents[i].contentVector = vector
+                if cache is not None:
+                    # kept as soon as they are paid for, also when the run is interrupted later
+                    cache.set_many({keys[i]: documents[i].contentVector for i in batch}, evict=False)
+    finally:
+        if cache is not None:
+            cache.evict()
+    return failed
 
 
 def chunk_content_helper(
@@ -465,32 +954,26 @@ def chunk_content_helper(
     parser = parser_factory(file_format)
     doc = parser.parse(content, file_name=file_name)
 
-    # if the original doc after parsing is < num_tokens return as it is
-    doc_content_size = TOKEN_ESTIMATOR.estimate_tokens(doc.content)
-    if doc_content_size < num_tokens:
-        yield doc.content, doc_content_size, doc
+    # the document is encoded once, its tokens are reused for chunking. Markdown is chunked in
+    # the original content, so that chunks end at headings and code blocks; its sizes are those
+    # of the markdown
+    if file_format == "markdown":
+        chunker, text = MARKDOWN_CHUNKER, content
     else:
-        if file_format == "markdown":
-            splitter = MarkdownTextSplitter.from_tiktoken_encoder(
-                chunk_size=num_tokens, chunk_overlap=token_overlap)
-            chunked_content_list = splitter.split_text(
-                content)  # chunk the original content
-            for chunked_content, chunk_size in merge_chunks_serially(chunked_content_list, num_tokens):
-                chunk_doc = parser.parse(chunked_content, file_name=file_name)
-                chunk_doc.title = doc.title
-                yield chunk_doc.content, chunk_size, chunk_doc
-        else:
-            if file_format == "python":
-                splitter = PythonCodeTextSplitter.from_tiktoken_encoder(
-                    chunk_size=num_tokens, chunk_overlap=token_overlap)
-            else:
-                splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-                    separators=SENTENCE_ENDINGS + WORDS_BREAKS,
-                    chunk_size=num_tokens, chunk_overlap=token_overlap)
-            chunked_content_list = splitter.split_text(doc.content)
-            for chunked_content in chunked_content_list:
-                chunk_size = TOKEN_ESTIMATOR.estimate_tokens(chunked_content)
-                yield chunked_content, chunk_size, doc
+        chunker, text = PYTHON_CHUNKER if file_format == "python" else TEXT_CHUNKER, doc.content
+    tokens, offsets = chunker.encode(text)
+
+    # if the doc is < num_tokens return it as it is
+    if len(tokens) < num_tokens:
+        yield doc.content, len(tokens), doc
+    elif file_format == "markdown":
+        for chunked_content, chunk_size in chunker.chunk_tokens(content, tokens, offsets, num_tokens, token_overlap):
+            chunk_doc = parser.parse(chunked_content, file_name=file_name)
+            chunk_doc.title = doc.title
+            yield chunk_doc.content, chunk_size, chunk_doc
+    else:
+        for chunked_content, chunk_size in chunker.chunk_tokens(doc.content, tokens, offsets, num_tokens, token_overlap):
+            yield chunked_content, chunk_size, doc
 
 def chunk_content(
     content: str,
@@ -505,7 +988,8 @@ def chunk_content(
     use_layout = False,
     add_embeddings = False,
     azure_credential = None,
-    embedding_endpoint = None
+    embedding_endpoint = None,
+    embedding_cache: Optional[EmbeddingCache] = None
 ) -> ChunkingResult:
     """Chunks the given content. If ignore_errors is true, returns None
         in case of an error
@@ -517,6 +1001,7 @@ def chunk_content(
         num_tokens (int): The number of tokens in each chunk.
         min_chunk_size (int): The minimum chunk size below which chunks will be filtered.
         token_overlap (int): The number of tokens to overlap between chunks.
+        embedding_cache (EmbeddingCache): Embeddings of chunks seen before are taken from it.
     Returns:
         List[Document]: List of chunked documents.
     """
@@ -540,20 +1025,10 @@ def chunk_content(
             token_overlap=token_overlap
         )
         chunks = []
+        chunk_sizes = []
         skipped_chunks = 0
         for chunk, chunk_size, doc in chunked_context:
             if chunk_size >= min_chunk_size:
-                if add_embeddings:
-                    for _ in range(RETRY_COUNT):
-                        try:
-                            doc.contentVector = get_embedding(chunk, azure_credential, embedding_endpoint)
-                            break
-                        except:
-                            sleep(30)
-                    if doc.contentVector is None:
-                        raise Exception(f"Error getting embedding for chunk={chunk}")
-                    
-
                 chunks.append(
                     Document(
                         content=chunk,
@@ -562,9 +1037,13 @@ def chunk_content(
                         contentVector=doc.contentVector
                     )
                 )
+                chunk_sizes.append(chunk_size)
             else:
                 skipped_chunks += 1
 
+        if add_embeddings:
+            embed_documents(chunks, azure_credential, embedding_endpoint, sizes=chunk_sizes, cache=embedding_cache)
+
     except UnsupportedFormatError as e:
         if ignore_errors:
             return ChunkingResult(
@@ -581,6 +1060,7 @@ def chunk_content(
         chunks=chunks,
         total_files=1,
         skipped_chunks=skipped_chunks,
+        chunk_sizes=chunk_sizes,
     )
 
 def chunk_file(
@@ -689,6 +1169,7 @@ def process_file(
             embedding_endpoint=embedding_endpoint
         )
         for chunk_idx, chunk_doc in enumerate(result.chunks):
+            chunk_doc.id = chunk_id(convert_escaped_to_posix(rel_file_path), chunk_idx)
             chunk_doc.filepath = rel_file_path
             chunk_doc.metadata = json.dumps({"chunk_id": str(chunk_idx)})
     except Exception as e:
@@ -713,7 +1194,12 @@ def chunk_directory(
         njobs=4,
         add_embeddings = False,
         azure_credential = None,
-        embedding_endpoint = None
+        embedding_endpoint = None,
+        embedding_concurrency: int = EMBEDDING_CONCURRENCY,
+        embedding_requests_per_minute: Optional[int] = None,
+        embedding_tokens_per_minute: Optional[int] = None,
+        embedding_cache_path: Optional[str] = None,
+        manifest: Optional[IngestionManifest] = None
 ):
     """
     Chunks the given directory recursively
@@ -730,18 +1216,40 @@ def chunk_directory(
         form_recognizer_client: Optional form recognizer client to use for pdf files.
         use_layout (bool): If true, uses Layout model for pdf files. Otherwise, uses Read.
         add_embeddings (bool): If true, adds a vector embedding to each chunk using the embedding model endpoint and key.
+        embedding_concurrency (int): The number of embedding requests to run at a time, once all files are chunked.
+        embedding_requests_per_minute (int): The requests per minute budget of the embedding deployment, unlimited if None.
+        embedding_tokens_per_minute (int): The tokens per minute budget of the embedding deployment, unlimited if None.
+        embedding_cache_path (str): SQLite file of an EmbeddingCache, only chunks missing from it are embedded.
+        manifest (IngestionManifest): If set, only files that changed since it was saved, or were ingested with
+            other chunking, url or embedding settings, are chunked, and the result has the ids of the chunks to
+            delete. The manifest is updated, but not saved.
 
     Returns:
         List[Document]: List of chunked documents.
     """
     chunks = []
+    chunk_sizes = []
     total_files = 0
     num_unsupported_format_files = 0
     num_files_with_errors = 0
     skipped_chunks = 0
+    # files chunked without errors, with their number of chunks
+    processed_files = []
 
     all_files_directory = get_files_recursively(directory_path)
     files_to_process = [file_path for file_path in all_files_directory if os.path.isfile(file_path)]
+    num_unchanged_files = 0
+    if manifest is not None:
+        # every file is ingested again when these change
+        fingerprint = IngestionManifest.fingerprint(
+            num_tokens=num_tokens, min_chunk_size=min_chunk_size, token_overlap=token_overlap, url_prefix=url_prefix,
+            use_layout=use_layout,
+            embedding_deployment=embedding_deployment(embedding_endpoint) if add_embeddings and embedding_endpoint else None
+        )
+        all_files = len(files_to_process)
+        files_to_process, removed_files = manifest.changes(directory_path, files_to_process, fingerprint)
+        num_unchanged_files = all_files - len(files_to_process)
+        print(f"{len(files_to_process)} new or changed files, {num_unchanged_files} unchanged, {len(removed_files)} removed")
     print(f"Total files to process={len(files_to_process)} out of total directory size={len(all_files_directory)}")
 
 
@@ -754,12 +1262,14 @@ def chunk_directory(
                                        min_chunk_size=min_chunk_size, url_prefix=url_prefix,
                                        token_overlap=token_overlap,
                                        extensions_to_process=extensions_to_process,
-                                       form_recognizer_client=form_recognizer_client, use_layout=use_layout, add_embeddings=add_embeddings,
-                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint)
+                                       form_recognizer_client=form_recognizer_client, use_layout=use_layout, add_embeddings=False)
             if is_error:
                 num_files_with_errors += 1
                 continue
+            if result.num_files_with_errors == 0:
+                processed_files.append((file_path, len(result.chunks)))
             chunks.extend(result.chunks)
+            chunk_sizes.extend(result.chunk_sizes)
             num_unsupported_format_files += result.num_unsupported_format_files
             num_files_with_errors += result.num_files_with_errors
             skipped_chunks += result.skipped_chunks
@@ -770,26 +1280,70 @@ def chunk_directory(
                                        min_chunk_size=min_chunk_size, url_prefix=url_prefix,
                                        token_overlap=token_overlap,
                                        extensions_to_process=extensions_to_process,
-                                       form_recognizer_client=None, use_layout=use_layout, add_embeddings=add_embeddings,
-                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint)
+                                       form_recognizer_client=None, use_layout=use_layout, add_embeddings=False)
         with ProcessPoolExecutor(max_workers=njobs) as executor:
             futures = list(tqdm(executor.map(process_file_partial, files_to_process), total=len(files_to_process)))
-            for result, is_error in futures:
+            for file_path, (result, is_error) in zip(files_to_process, futures):
                 total_files += 1
                 if is_error:
                     num_files_with_errors += 1
                     continue
+                if result.num_files_with_errors == 0:
+                    processed_files.append((file_path, len(result.chunks)))
                 chunks.extend(result.chunks)
+                chunk_sizes.extend(result.chunk_sizes)
                 num_unsupported_format_files += result.num_unsupported_format_files
                 num_files_with_errors += result.num_files_with_errors
                 skipped_chunks += result.skipped_chunks
 
+    # the chunks of all files are embedded together, in full batches
+    failed_files = set()
+    if add_embeddings and chunks:
+        print(f"Embedding {len(chunks)} chunks with {embedding_concurrency} concurrent requests")
+        rate_limiter = EmbeddingRateLimiter(embedding_requests_per_minute, embedding_tokens_per_minute)
+        embedding_cache = EmbeddingCache(embedding_cache_path) if embedding_cache_path else None
+        try:
+            # the sizes counted while chunking, the chunks aren't encoded again
+            failed = embed_documents(chunks, azure_credential, embedding_endpoint, sizes=chunk_sizes,
+                                     concurrency=embedding_concurrency, ignore_errors=ignore_errors,
+                                     rate_limiter=rate_limiter, cache=embedding_cache)
+        finally:
+            if embedding_cache is not None:
+                print(f"Embedding cache: {embedding_cache.stats()}")
+                embedding_cache.close()
+        print(f"Embedding requests: {rate_limiter.stats()}")
+        if failed:
+            failed_files = {chunk.filepath for chunk in chunks if chunk.contentVector is None}
+            print(f"Failed to embed {failed} chunks of {len(failed_files)} files")
+            kept = [i for i, chunk in enumerate(chunks) if chunk.filepath not in failed_files]
+            chunks = [chunks[i] for i in kept]
+            chunk_sizes = [chunk_sizes[i] for i in kept]
+            num_files_with_errors += len(failed_files)
+
+    # files that failed keep their chunks in the index and are retried on the next run
+    deleted_ids = []
+    if manifest is not None:
+        for file_path, num_chunks in processed_files:
+            rel_file_path = os.path.relpath(file_path, directory_path)
+            if rel_file_path in failed_files:
+                continue
+            posix_path = convert_escaped_to_posix(rel_file_path)
+            deleted_ids.extend(chunk_id(posix_path, i) for i in range(num_chunks, manifest.chunk_count(rel_file_path)))
+            manifest.update(file_path, rel_file_path, num_chunks, fingerprint)
+        for rel_file_path in removed_files:
+            posix_path = convert_escaped_to_posix(rel_file_path)
+            deleted_ids.extend(chunk_id(posix_path, i) for i in range(manifest.chunk_count(rel_file_path)))
+            manifest.remove(rel_file_path)
+
     return ChunkingResult(
             chunks=chunks,
             total_files=total_files,
             num_unsupported_format_files=num_unsupported_format_files,
             num_files_with_errors=num_files_with_errors,
             skipped_chunks=skipped_chunks,
+            deleted_ids=deleted_ids,
+            num_unchanged_files=num_unchanged_files,
+            chunk_sizes=chunk_sizes,
         )
 
 
@@ -23,7 +23,7 @@ from azure.search.documents import SearchClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
 
-from data_utils import chunk_directory
+from data_utils import chunk_directory, legacy_chunk_ids, IngestionManifest
 
 
 def create_search_index(index_name, index_client):
@@ -75,18 +75,22 @@ def create_search_index(index_name, index_client):
         print(f"Search index {index_name} already exists")
 
 
-def upload_documents_to_index(docs, search_client, upload_batch_size=50):
+def upload_documents_to_index(docs, search_client, upload_batch_size=50, deleted_ids=(), delete_legacy_ids=False):
     to_upload_dicts = []
 
     id = 0
     for document in docs:
         d = dataclasses.asdict(document)
-        # add id to documents
-        d.update({"@search.action": "upload", "id": str(id)})
+        # add id to documents, chunks of files have a stable id
+        d.update({"@search.action": "upload", "id": document.id or str(id)})
         if "contentVector" in d and d["contentVector"] is None:
             del d["contentVector"]
         to_upload_dicts.append(d)
         id += 1
+    # chunks of removed or shrunk files, and with delete_legacy_ids those numbered by an earlier version
+    to_upload_dicts.extend({"@search.action": "delete", "id": deleted_id} for deleted_id in deleted_ids)
+    if delete_legacy_ids:
+        to_upload_dicts.extend({"@search.action": "delete", "id": legacy_id} for legacy_id in legacy_chunk_ids(search_client))
 
     # Upload the documents in batches of upload_batch_size
     for i in tqdm(
@@ -127,13 +131,15 @@ def validate_index(index_name, index_client):
 
 
 def create_and_populate_index(
-    index_name, index_client, search_client, form_recognizer_client, azure_credential, embedding_endpoint
+    index_name, index_client, search_client, form_recognizer_client, azure_credential, embedding_endpoint,
+    embedding_cache_path=None, manifest_path=None
 ):
     # create or update search index with compatible schema
     create_search_index(index_name, index_client)
 
-    # chunk directory
+    # chunk directory, only the files that changed since the last run with a manifest
     print("Chunking directory...")
+    manifest = IngestionManifest(manifest_path) if manifest_path else None
     result = chunk_directory(
         "./data",
         form_recognizer_client=form_recognizer_client,
@@ -142,20 +148,31 @@ def create_and_populate_index(
         njobs=1,
         add_embeddings=True,
         azure_credential=azd_credential,
-        embedding_endpoint=embedding_endpoint
+        embedding_endpoint=embedding_endpoint,
+        embedding_cache_path=embedding_cache_path,
+        manifest=manifest
     )
 
-    if len(result.chunks) == 0:
+    # with a manifest, no chunks means that no file changed
+    if len(result.chunks) == 0 and (manifest is None or not manifest.files):
         raise Exception("No chunks found. Please check the data path and chunk size.")
 
     print(f"Processed {result.total_files} files")
+    if manifest is not None:
+        print(f"Unchanged: {result.num_unchanged_files} files")
     print(f"Unsupported formats: {result.num_unsupported_format_files} files")
     print(f"Files with errors: {result.num_files_with_errors} files")
     print(f"Found {len(result.chunks)} chunks")
+    if manifest is not None:
+        print(f"Deleting {len(result.deleted_ids)} chunks")
 
     # upload documents to index
     print("Uploading documents to index...")
-    upload_documents_to_index(result.chunks, search_client)
+    # every file was ingested, chunks left by runs before chunk ids were stable are replaced
+    upload_documents_to_index(result.chunks, search_client, deleted_ids=result.deleted_ids,
+                              delete_legacy_ids=manifest is None or manifest.created)
+    if manifest is not None:
+        manifest.save()
 
     # check if index is ready/validate index
     print("Validating index...")
@@ -201,6 +218,16 @@ if __name__ == "__main__":
         required=False,
         help="Optional. Use this OpenAI endpoint to generate embeddings for the documents",
     )
+    parser.add_argument(
+        "--embeddingcache",
+        required=False,
+        help="Optional. SQLite file to keep embeddings in across runs, only chunks that aren't in it yet are embedded",
+    )
+    parser.add_argument(
+        "--manifest",
+        required=False,
+        help="Optional. JSON file to keep a manifest of the ingested files in, only new and changed files are ingested and chunks of removed files are deleted",
+    )
     args = parser.parse_args()
 
     # Use the current user identity to connect to Azure services unless a key is explicitly set for any of them
@@ -231,6 +258,7 @@ if __name__ == "__main__":
         credential=formrecognizer_creds,
     )
     create_and_populate_index(
-        args.index, index_client, search_client, form_recognizer_client, azd_credential, args.embeddingendpoint
+        args.index, index_client, search_client, form_recognizer_client, azd_credential, args.embeddingendpoint,
+        args.embeddingcache, args.manifest
     )
     print("Data preparation for index", args.index, "completed")
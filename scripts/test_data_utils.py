@@ -0,0 +1,307 @@
+import os
+import time
+
+import openai
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+import data_utils
+from data_utils import (MARKDOWN_BREAKS, Document, EmbeddingCache, EmbeddingRateLimiter, IngestionManifest,
+                        TokenChunker, batch_by_tokens, chunk_content_helper, chunk_directory, chunk_id,
+                        embed_documents, legacy_chunk_ids)
+
+
+class ByteEncoding():
+    # one token per byte, so that characters of several bytes span several tokens
+    def __init__(self):
+        self.encoded = 0
+
+    def encode(self, text, disallowed_special=()):
+        self.encoded += 1
+        return list(text.encode("utf-8"))
+
+    def decode_tokens_bytes(self, tokens):
+        return [bytes([token]) for token in tokens]
+
+
+@pytest.mark.parametrize("num_tokens,token_overlap", [(16, 0), (16, 5), (7, 6), (40, 39)])
+def test_token_chunker_overlap_and_size(num_tokens, token_overlap):
+    text = "".join(f"w{i}," for i in range(60))
+    chunks = list(TokenChunker(encoding=ByteEncoding()).chunk(text, num_tokens, token_overlap))
+    assert all(len(content) == size <= num_tokens for content, size in chunks)
+    # every chunk starts exactly token_overlap tokens before the end of the previous one, and
+    # at least one token after its start
+    rebuilt = chunks[0][0]
+    for (previous, _), (content, _) in zip(chunks, chunks[1:]):
+        overlap = min(token_overlap, len(previous) - 1)
+        assert content[:overlap] == previous[len(previous) - overlap:]
+        rebuilt += content[overlap:]
+    assert rebuilt == text
+
+
+def test_token_chunker_keeps_characters_whole():
+    chunker = TokenChunker(encoding=ByteEncoding())
+    # a window of one token can't end between the bytes of a character
+    assert list(chunker.chunk("ééé", 1)) == [("é", 2)] * 3
+    chunks = list(chunker.chunk("aé bé cé dé", 4, 1))
+    assert "".join(content for content, _ in chunks).replace(" ", "") == "aébécédé"
+    assert all(size <= 4 for _, size in chunks)
+
+
+def test_markdown_is_encoded_once(monkeypatch):
+    encoding = ByteEncoding()
+    monkeypatch.setattr(data_utils, "MARKDOWN_CHUNKER", TokenChunker(MARKDOWN_BREAKS, encoding=encoding))
+    content = "\n\n".join(f"## Section {i}\n\nSome text of section {i}." for i in range(10))
+    chunks = list(chunk_content_helper(content, "markdown", "doc.md", token_overlap=0, num_tokens=64))
+    assert encoding.encoded == 1
+    assert len(chunks) > 1 and all(size <= 64 for _, size, _ in chunks)
+    # chunks end at headings
+    assert ["Section 1" in content for content, _, _ in chunks[:2]] == [False, True]
+
+
+def fake_embeddings(texts, azure_credential, embedding_endpoint):
+    # a vector per text, the first batch answers last; batches with a "bad" text fail
+    if "doc0" in texts:
+        time.sleep(0.05)
+    if any(text.startswith("bad") for text in texts):
+        raise Exception("400 Bad Request")
+    return [[float(len(text)), float(ord(text[-1]))] for text in texts]
+
+
+def test_batch_by_tokens():
+    assert batch_by_tokens([]) == []
+    assert batch_by_tokens([1] * 5, max_size=2) == [[0, 1], [2, 3], [4]]
+    assert batch_by_tokens([4, 4, 3, 5, 1], max_size=16, max_tokens=8) == [[0, 1], [2, 3], [4]]
+    # an item larger than max_tokens is a batch of its own
+    assert batch_by_tokens([2, 20, 2], max_tokens=8) == [[0], [1], [2]]
+
+
+def test_embed_documents_writes_vectors_back_in_order(monkeypatch):
+    monkeypatch.setattr(data_utils, "get_embeddings", fake_embeddings)
+    contents = ["doc0", "doc1", "bad2", "doc3", "doc4", "doc5"]
+    documents = [Document(content=content) for content in contents]
+    failed = embed_documents(documents, None, "https://x/openai/deployments/ada/embeddings", sizes=[3000] * 6,
+                             concurrency=3, ignore_errors=True, rate_limiter=EmbeddingRateLimiter(retries=0))
+    # batches of two, the one with "bad2" failed and the others kept their own vectors
+    assert failed == 2
+    assert [doc.contentVector for doc in documents] == \
+        [[4.0, ord("0")], [4.0, ord("1")], None, None, [4.0, ord("4")], [4.0, ord("5")]]
+
+    with pytest.raises(Exception, match="400"):
+        embed_documents([Document(content="bad")], None, "https://x/openai/deployments/ada/embeddings", sizes=[1],
+                        rate_limiter=EmbeddingRateLimiter(retries=0))
+
+
+def test_chunk_directory_embeds_with_chunk_sizes(monkeypatch, tmp_path):
+    monkeypatch.setattr(data_utils, "TEXT_CHUNKER", TokenChunker(encoding=ByteEncoding()))
+    monkeypatch.setattr(data_utils, "get_embeddings", fake_embeddings)
+    def gpt2_tokenizer():
+        raise AssertionError("chunks were encoded again to be embedded")
+    monkeypatch.setattr(data_utils, "gpt2_tokenizer", gpt2_tokenizer)
+    (tmp_path / "a.txt").write_text("One sentence of text. " * 20)
+    (tmp_path / "b.txt").write_text("Another one of text, longer. " * 20)
+
+    result = chunk_directory(str(tmp_path), num_tokens=100, njobs=1, add_embeddings=True,
+                             embedding_endpoint="https://x/openai/deployments/ada/embeddings")
+    assert result.num_files_with_errors == 0 and len(result.chunks) > 2
+    assert len(result.chunk_sizes) == len(result.chunks)
+    assert all(len(chunk.content) <= size <= 100 for chunk, size in zip(result.chunks, result.chunk_sizes))
+    assert all(chunk.contentVector for chunk in result.chunks)
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_rate_limiter_acquire(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(data_utils, "time", clock)
+    limiter = EmbeddingRateLimiter(requests_per_minute=2, tokens_per_minute=1000)
+    limiter.acquire(600)
+    assert clock.slept == [] and limiter.available_tokens == 400 and limiter.available_requests == 1
+    # waits until the missing 200 tokens are refilled
+    limiter.acquire(600)
+    assert clock.slept == [pytest.approx(12)]
+    assert limiter.available_tokens == pytest.approx(0) and limiter.available_requests == pytest.approx(0.4)
+    # a request larger than the budget waits for a full bucket
+    limiter.acquire(5000)
+    assert clock.slept[1:] == [pytest.approx(60)] and limiter.available_tokens == pytest.approx(0)
+    limiter.paused_until = clock.now + 5
+    limiter.acquire(0)
+    assert clock.slept[2:] == [pytest.approx(5)]
+    assert limiter.stats() == {"requests": 4, "throttled": 0, "retried": 0}
+
+
+def test_rate_limiter_retry_after():
+    limiter = EmbeddingRateLimiter()
+    def throttled(headers):
+        # get_embeddings raises its own exception from the openai one
+        try:
+            raise openai.error.RateLimitError("Too many requests", http_status=429, headers=headers)
+        except Exception as e:
+            try:
+                raise Exception("Error getting embeddings") from e
+            except Exception as wrapped:
+                return wrapped
+    assert limiter._retry_after(throttled({"retry-after-ms": "1500", "retry-after": "2"})) == 1.5
+    assert limiter._retry_after(throttled({"retry-after": "3"})) == 3
+    assert limiter._retry_after(throttled({"retry-after": "soon"})) == 0
+    assert limiter._retry_after(throttled(None)) == 0
+    assert limiter._retry_after(openai.error.APIError("Server error", http_status=500)) is None
+
+
+def test_rate_limiter_retries_only_transient_errors(monkeypatch):
+    monkeypatch.setattr(data_utils, "time", FakeClock())
+    limiter = EmbeddingRateLimiter(retries=3)
+    def failing(*errors):
+        calls = []
+        def fn():
+            calls.append(1)
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return "ok"
+        return fn, calls
+
+    fn, calls = failing(openai.error.RateLimitError(http_status=429), openai.error.APIError(http_status=503),
+                        openai.error.APIConnectionError("reset"))
+    assert limiter.call(fn) == "ok" and len(calls) == 4
+    for error in (openai.error.InvalidRequestError("too long", None, http_status=400),
+                  openai.error.AuthenticationError(http_status=401), ValueError("bug")):
+        fn, calls = failing(error)
+        with pytest.raises(type(error)):
+            limiter.call(fn)
+        assert len(calls) == 1
+    assert limiter.stats()["retried"] == 3
+
+
+def test_embedding_cache_hits_misses_and_eviction(monkeypatch, tmp_path):
+    clock = FakeClock()
+    monkeypatch.setattr(data_utils, "time", clock)
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite3"), maxsize=2)
+    a, b, c = (EmbeddingCache.key("ada", text) for text in "abc")
+    assert EmbeddingCache.key("ada", "a") != EmbeddingCache.key("ada-2", "a")
+    cache.set_many({a: [0.5, 1.0], b: [2.0, 3.0]})
+    clock.now += 1
+    assert cache.get_many([a, c, a]) == {a: [0.5, 1.0]}
+    assert (cache.hits, cache.misses) == (2, 1)
+    # b is the least recently used, a was read since it was stored
+    clock.now += 1
+    cache.set_many({c: [4.0, 5.0]})
+    assert cache.get_many([a, b, c]) == {a: [0.5, 1.0], c: [4.0, 5.0]}
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"], stats["evicted"]) == (4, 2, 2, 1)
+    assert stats["hit_rate"] == pytest.approx(4 / 6)
+    cache.close()
+
+
+def test_embed_documents_caches_each_batch(monkeypatch, tmp_path):
+    monkeypatch.setattr(data_utils, "get_embeddings", fake_embeddings)
+    endpoint = "https://x/openai/deployments/ada/embeddings?api-version=2023-05-15"
+
+    class RecordingCache(EmbeddingCache):
+        def set_many(self, items, evict=True):
+            stored.append(sorted(len(vector) for vector in items.values()))
+            super().set_many(items, evict)
+
+    stored = []
+    cache = RecordingCache(str(tmp_path / "embeddings.sqlite3"))
+    cache.set_many({EmbeddingCache.key("https://x/openai/deployments/ada", "doc1"): [9.0]})
+    stored.clear()
+    documents = [Document(content=content) for content in ["doc0", "doc1", "doc2", "bad3", "doc4"]]
+    with pytest.raises(Exception, match="400"):
+        embed_documents(documents, None, endpoint, sizes=[3000] * 5, concurrency=1, cache=cache,
+                        rate_limiter=EmbeddingRateLimiter(retries=0))
+    # doc1 came from the cache; the batch of doc0 and doc2 was stored before the next one failed
+    assert documents[1].contentVector == [9.0] and stored == [[2, 2]]
+    documents = [Document(content=content) for content in ["doc0", "doc1", "doc2", "doc4"]]
+    assert embed_documents(documents, None, endpoint, sizes=[3000] * 4, cache=cache) == 0
+    assert cache.hits == 1 + 3 and stored == [[2, 2], [2]]
+    cache.close()
+
+
+def test_ingestion_manifest_changes(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    for name in "abcd":
+        (data / f"{name}.txt").write_text(f"file {name}")
+    paths = {name: str(data / f"{name}.txt") for name in "abcd"}
+    manifest = IngestionManifest(str(tmp_path / "manifest.json"))
+    assert manifest.created
+    assert manifest.changes(str(data), list(paths.values()), "v1") == (list(paths.values()), [])
+    for name, path in paths.items():
+        manifest.update(path, f"{name}.txt", 1, "v1")
+    manifest.save()
+
+    (data / "b.txt").write_text("file b, changed")
+    (data / "d.txt").unlink()
+    (data / "e.txt").write_text("file e")
+    # c is touched without changing: its new mtime is recorded instead of processing it again
+    os.utime(paths["c"], (1, 1))
+    manifest = IngestionManifest(str(tmp_path / "manifest.json"))
+    assert not manifest.created
+    files = [paths["a"], paths["b"], paths["c"], str(data / "e.txt")]
+    assert manifest.changes(str(data), files, "v1") == ([paths["b"], str(data / "e.txt")], ["d.txt"])
+    assert manifest.files["c.txt"]["mtime"] == 1
+    # every file is processed again with other settings
+    assert manifest.changes(str(data), files, "v2") == (files, ["d.txt"])
+    assert IngestionManifest.fingerprint(num_tokens=1024, url_prefix=None) == \
+        IngestionManifest.fingerprint(url_prefix=None, num_tokens=1024) != IngestionManifest.fingerprint(num_tokens=512, url_prefix=None)
+
+
+def test_chunk_directory_deletes_chunks_of_shrunk_and_removed_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(data_utils, "TEXT_CHUNKER", TokenChunker(encoding=ByteEncoding()))
+    data = tmp_path / "data"
+    (data / "sub").mkdir(parents=True)
+    (data / "a.txt").write_text("Some sentence of the first file. " * 8)
+    (data / "sub" / "b.txt").write_text("Another sentence, in a folder. " * 4)
+    manifest = IngestionManifest(str(tmp_path / "manifest.json"))
+
+    def ingest(**kwargs):
+        result = chunk_directory(str(data), num_tokens=64, njobs=1, manifest=manifest, **kwargs)
+        manifest.save()
+        return result
+
+    result = ingest()
+    chunks = {path: manifest.chunk_count(path) for path in ("a.txt", os.path.join("sub", "b.txt"))}
+    assert chunks["a.txt"] > 2 and chunks[os.path.join("sub", "b.txt")] > 1
+    assert [chunk.id for chunk in result.chunks[:2]] == [chunk_id("a.txt", 0), chunk_id("a.txt", 1)]
+    assert result.deleted_ids == []
+
+    (data / "a.txt").write_text("A short file now.")
+    (data / "sub" / "b.txt").unlink()
+    result = ingest()
+    assert [chunk.id for chunk in result.chunks] == [chunk_id("a.txt", 0)]
+    assert result.deleted_ids == [chunk_id("a.txt", i) for i in range(1, chunks["a.txt"])] + \
+        [chunk_id("sub/b.txt", i) for i in range(chunks[os.path.join("sub", "b.txt")])]
+    assert ingest().chunks == []
+    # other chunking settings ingest every file again
+    assert [chunk.id for chunk in ingest(token_overlap=8).chunks] == [chunk_id("a.txt", 0)]
+
+
+def test_legacy_chunk_ids():
+    class SearchClient():
+        def __init__(self, ids):
+            self.ids = ids
+
+        def get_document(self, key, selected_fields=None):
+            if key not in self.ids:
+                raise ResourceNotFoundError("not found")
+            return {"id": key}
+
+        def get_document_count(self):
+            return len(self.ids)
+
+    assert legacy_chunk_ids(SearchClient([chunk_id("a.txt", 0)])) == []
+    assert legacy_chunk_ids(SearchClient(["0", "1", chunk_id("a.txt", 0)])) == ["0", "1", "2"]
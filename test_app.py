@@ -1,6 +1,581 @@
-from app import format_as_ndjson
+import asyncio
+import json
+import time
+
+import pytest
+
+import app_async
+from app import format_as_ndjson, stream_without_data_delta
+from backend.sse import iter_sse_json
 
 
 def test_format_as_ndjson():
     obj = {"message": "I ❤️ 🐍 \n and escaped newlines"}
     assert format_as_ndjson(obj) == '{"message": "I ❤️ 🐍 \\n and escaped newlines"}\n'
+
+
+def test_stream_without_data_delta():
+    chunks = [
+        {"id": "1", "model": "gpt", "created": 1, "object": "chat.completion.chunk", "choices": [{"delta": {"role": "assistant"}}]},
+        {"id": "1", "model": "gpt", "created": 1, "object": "chat.completion.chunk", "choices": [{"delta": {"content": "Hello"}}]},
+        {"id": "1", "model": "gpt", "created": 1, "object": "chat.completion.chunk", "choices": [{"delta": {"content": " world"}}]},
+        {"id": "1", "model": "gpt", "created": 1, "object": "chat.completion.chunk", "choices": [{"delta": {}}]},
+    ]
+    events = [json.loads(line) for line in stream_without_data_delta(chunks, {"conversation_id": "c1"})]
+    assert [e["type"] for e in events] == ["start", "delta", "delta", "end"]
+    assert events[0]["history_metadata"] == {"conversation_id": "c1"}
+    assert "".join(e["content"] for e in events if e["type"] == "delta") == "Hello world"
+    assert events[-1] == {"type": "end", "id": "1", "delta_count": 2, "content_length": 11}
+
+
+def test_stream_saves_answer():
+    from app import stream_without_data
+
+    chunks = [
+        {"id": "1", "model": "gpt", "created": 1, "object": "chat.completion.chunk", "choices": [{"delta": {"role": "assistant"}}]},
+        {"id": "1", "model": "gpt", "created": 1, "object": "chat.completion.chunk", "choices": [{"delta": {"content": "Hello"}}]},
+    ]
+    saved = []
+    save_answer = lambda messages: saved.append(messages) or True
+
+    events = [json.loads(line) for line in stream_without_data_delta(chunks, {}, save_answer)]
+    assert events[-1]["saved"] is True
+    lines = [json.loads(line) for line in stream_without_data(chunks, {"conversation_id": "c1"}, save_answer)]
+    assert lines[-1]["history_metadata"] == {"conversation_id": "c1", "saved": True}
+    assert saved == [[{"role": "assistant", "content": "Hello"}]] * 2
+
+
+def test_async_stream_without_data_delta():
+    async def chunks():
+        yield {"id": "1", "model": "gpt", "created": 1, "object": "chat.completion.chunk", "choices": [{"delta": {"role": "assistant"}}]}
+        yield {"id": "1", "model": "gpt", "created": 1, "object": "chat.completion.chunk", "choices": [{"delta": {"content": "Hi"}}]}
+
+    async def collect():
+        return [json.loads(line) async for line in app_async.stream_without_data_delta(chunks(), {})]
+
+    events = asyncio.run(collect())
+    assert [e["type"] for e in events] == ["start", "delta", "end"]
+    assert events[-1]["content_length"] == 2
+
+
+def test_stream_without_data_forwards_error_events():
+    from app import stream_without_data
+
+    body = (
+        b'data: {"id": "1", "model": "gpt", "created": 1, "object": "chat.completion.chunk", "choices": [{"delta": {"content": "Hi"}}]}\n\n'
+        b'event: error\ndata: {"error": {"code": "429", "message": "Rate limit"}}\n\n'
+    )
+    lines = [json.loads(line) for line in stream_without_data(iter_sse_json([body]), {})]
+    assert lines[-1] == {"error": {"code": "429", "message": "Rate limit"}}
+    events = [json.loads(line) for line in stream_without_data_delta(iter_sse_json([body]), {})]
+    assert events[-1] == {"type": "error", "error": {"code": "429", "message": "Rate limit"}}
+
+    async def chunks():
+        for line in iter_sse_json([body]):
+            yield line
+
+    async def collect():
+        return [json.loads(line) async for line in app_async.stream_without_data(chunks(), {})]
+
+    assert asyncio.run(collect())[-1] == {"error": {"code": "429", "message": "Rate limit"}}
+
+
+def test_iter_sse_json():
+    body = (
+        b': keep-alive\r\n'
+        b'data: {"id": "1", "content": "Hel"}\r\n\r\n'
+        b'data: {"id": "1",\r\ndata:  "content": "lo"}\r\n\r\n'
+        b'event: error\r\ndata: {"error": {"code": "429"}}\r\n\r\n'
+        b'data: [DONE]\r\n\r\n'
+        b'data: {"id": "ignored"}\r\n\r\n'
+    )
+    # feed one byte at a time so every line ending gets split across reads
+    events = list(iter_sse_json(body[i:i + 1] for i in range(len(body))))
+    assert events == [
+        {"id": "1", "content": "Hel"},
+        {"id": "1", "content": "lo"},
+        {"error": {"code": "429"}},
+    ]
+
+
+def test_group_membership_cache():
+    from backend.auth.groups import GroupMembershipCache
+
+    cache = GroupMembershipCache(ttl=60, negative_ttl=60, maxsize=2)
+    calls = []
+
+    def loader(groups):
+        calls.append(groups)
+        return groups
+
+    assert cache.get_groups("u1", lambda: loader([{"id": "g1"}])) == [{"id": "g1"}]
+    assert cache.get_groups("u1", lambda: loader([{"id": "other"}])) == [{"id": "g1"}]
+    # failed lookups are remembered as well
+    assert cache.get_groups("u2", lambda: loader(None)) == []
+    assert cache.get_groups("u2", lambda: loader([{"id": "g2"}])) == []
+    assert len(calls) == 2
+
+    async def concurrent_lookups():
+        async def slow_loader():
+            calls.append("u3")
+            await asyncio.sleep(0.01)
+            return [{"id": "g3"}]
+        return await asyncio.gather(*[cache.aget_groups("u3", slow_loader) for _ in range(5)])
+
+    assert asyncio.run(concurrent_lookups()) == [[{"id": "g3"}]] * 5
+    assert calls.count("u3") == 1
+
+
+def test_sqlite_cache_backend_is_shared(tmp_path):
+    from backend.cache import SQLiteCacheBackend
+
+    path = str(tmp_path / "cache.sqlite3")
+    worker_1 = SQLiteCacheBackend("groups", maxsize=10, ttl=60, path=path)
+    worker_2 = SQLiteCacheBackend("groups", maxsize=10, ttl=60, path=path)
+
+    assert worker_2.get("u1") is None
+    worker_1.set("u1", {"groups": [{"id": "g1"}], "filter": "f"})
+    assert worker_2.get("u1") == {"groups": [{"id": "g1"}], "filter": "f"}
+    assert worker_2.stats()["hits"] == 1 and worker_2.stats()["misses"] == 1
+
+    assert worker_1.acquire_lease("u2", ttl=60)
+    assert not worker_2.acquire_lease("u2", ttl=60)
+    worker_1.release_lease("u2")
+    assert worker_2.acquire_lease("u2", ttl=60)
+
+
+def test_group_lease_of_other_worker_is_kept(tmp_path, monkeypatch):
+    import backend.auth.groups as groups
+    from backend.cache import SQLiteCacheBackend
+
+    monkeypatch.setattr(groups, "GROUPS_LEASE_TIMEOUT", 0.1)
+    path = str(tmp_path / "cache.sqlite3")
+    worker_1 = SQLiteCacheBackend("groups", maxsize=10, ttl=60, path=path)
+    cache = groups.GroupMembershipCache(ttl=60, negative_ttl=60, backend=SQLiteCacheBackend("groups", maxsize=10, ttl=60, path=path))
+
+    # worker 1 holds the lease for longer than the others wait
+    assert worker_1.acquire_lease("u1", ttl=60)
+    assert cache.get_groups("u1", lambda: [{"id": "g1"}]) == [{"id": "g1"}]
+
+    async def fetch():
+        return await cache.aget_groups("u2", lambda: asyncio.sleep(0, [{"id": "g2"}]))
+
+    assert worker_1.acquire_lease("u2", ttl=60)
+    assert asyncio.run(fetch()) == [{"id": "g2"}]
+    assert not cache.backend.acquire_lease("u1", ttl=60)
+    assert not cache.backend.acquire_lease("u2", ttl=60)
+
+
+def test_invalid_numeric_setting_fails(monkeypatch):
+    from backend import settings
+
+    monkeypatch.setattr(settings, "AZURE_OPENAI_TEMPERATURE", "warm")
+    with pytest.raises(ValueError, match="AZURE_OPENAI_TEMPERATURE"):
+        settings.AzureOpenAISettings.from_env()
+
+
+def test_with_data_template_is_not_modified():
+    from backend.utils import build_body_headers_with_data
+
+    body, headers = build_body_headers_with_data([{"role": "user", "content": "Hi"}], "filter-1")
+    body["dataSources"][0]["parameters"]["filter"] = "changed"
+    headers["api-key"] = "changed"
+    body, headers = build_body_headers_with_data([{"role": "user", "content": "Hi"}], "filter-2")
+    assert body["dataSources"][0]["parameters"]["filter"] == "filter-2"
+    assert headers["api-key"] != "changed"
+
+
+def test_answer_cache_key_and_replay():
+    from backend.answer_cache import AnswerCache, replay_cached_response_delta
+    from backend.utils import build_body_headers_with_data
+
+    cache = AnswerCache(ttl=60, maxsize=10)
+    question = [{"id": "a", "role": "user", "content": "How many  vacation days?", "date": "today"}]
+    body_hr, _ = build_body_headers_with_data(question, "groups/any(g:search.in(g, 'hr'))")
+    body_it, _ = build_body_headers_with_data(question, "groups/any(g:search.in(g, 'it'))")
+    same_question, _ = build_body_headers_with_data([{"role": "user", "content": "How many vacation days? "}], "groups/any(g:search.in(g, 'hr'))")
+
+    key = cache.make_key("endpoint", body_hr)
+    assert cache.make_key("endpoint", same_question) == key
+    assert cache.make_key("endpoint", body_it) != key
+
+    cache.set(key, {
+        "id": "1", "model": "gpt", "created": 1, "object": "chunk",
+        "choices": [{"messages": [{"role": "tool", "content": "{}"}, {"role": "assistant", "content": "30 days"}]}],
+        "history_metadata": {"conversation_id": "old"}
+    })
+    events = [json.loads(line) for line in replay_cached_response_delta(cache.get(key), {"conversation_id": "new"})]
+    assert [e["type"] for e in events] == ["start", "tool", "delta", "end"]
+    assert events[0]["history_metadata"] == {"conversation_id": "new"}
+    assert events[2]["content"] == "30 days"
+
+
+def test_stream_with_title():
+    from concurrent.futures import Future
+    from app import stream_with_title
+
+    history_metadata = {"conversation_id": "c1", "title": "How many vacation days?"}
+    title_job = Future()
+
+    def answer():
+        yield format_as_ndjson({"choices": [], "history_metadata": history_metadata})
+        history_metadata["title"] = "Vacation days"
+        title_job.set_result("Vacation days")
+
+    events = [json.loads(line) for line in stream_with_title(answer(), title_job, history_metadata, delta=True)]
+    assert events[0]["type"] == "history_metadata"
+    assert events[-1] == {"type": "title", "conversation_id": "c1", "title": "Vacation days"}
+
+    history_metadata["title"] = "How many vacation days?"
+    title_job = Future()
+    lines = [json.loads(line) for line in stream_with_title(answer(), title_job, history_metadata)]
+    assert lines[-1]["history_metadata"]["title"] == "Vacation days"
+
+
+def test_generate_local_title():
+    from backend.title_generator import generate_local_title
+
+    def title(content):
+        return generate_local_title([{"role": "user", "content": content}, {"role": "assistant", "content": "..."}])
+
+    assert title("How many vacation days do I get?") == "Vacation days"
+    assert title("Explain the travel expense policy for international trips, please") == "Travel expense policy"
+    assert title("Wie beantrage ich Urlaub im Dezember?") == "Beantrage Urlaub"
+    assert title("请问公司的年假政策是什么？") == "请问公司的年假政策是什么"
+    assert title("") is None
+
+
+def test_create_messages_batch():
+    from backend.history.utils import RequestCharge, create_messages_batch, new_message
+
+    messages = [new_message("c1", "u1", {"role": "tool", "content": "{}"}), new_message("c1", "u1", {"role": "assistant", "content": "Hi"})]
+    operations = create_messages_batch(messages)
+    assert [operation for operation, _ in operations] == ["create", "create", "patch"]
+    assert operations[-1][1] == ("c1", [{"op": "set", "path": "/updatedAt", "value": messages[-1]["createdAt"]}])
+
+    request_charge = RequestCharge()
+    request_charge({"x-ms-request-charge": "10.5"}, [])
+    request_charge({"x-ms-request-charge": "2"}, [])
+    assert request_charge.total == 12.5
+
+
+def test_delete_batches():
+    from backend.history.utils import TRANSACTIONAL_BATCH_LIMIT, delete_operations, document_ids_query, transactional_batches
+
+    batches = transactional_batches(delete_operations([str(i) for i in range(250)]))
+    assert [len(batch) for batch in batches] == [TRANSACTIONAL_BATCH_LIMIT, TRANSACTIONAL_BATCH_LIMIT, 50]
+    assert batches[2][0] == ("delete", ("200",))
+    assert transactional_batches([]) == []
+
+    query, parameters = document_ids_query("u1", conversation_ids=["c1"])
+    assert query.startswith("SELECT VALUE c.id FROM c")
+    assert {"name": "@conversationIds", "value": ["c1"]} in parameters
+
+
+def test_deletion_job_status():
+    from backend.history.utils import deletion_job_status, new_deletion_job, soft_delete_operations
+
+    assert soft_delete_operations(["c1"]) == [("patch", ("c1", [{"op": "set", "path": "/deleted", "value": True}]))]
+
+    job = new_deletion_job("u1", ["c1", "c2"])
+    assert job["userId"] == "u1" and job["status"] == "pending"
+    status = deletion_job_status(job)
+    assert status["job_id"] == job["id"]
+    assert status["conversations"] == 2
+    assert status["deleted_messages"] == 0
+
+
+def test_unfinished_deletion_jobs_are_resumed():
+    from datetime import datetime, timedelta
+    from azure.cosmos.exceptions import CosmosAccessConditionFailedError
+    from backend.history.localstore import SQLiteConversationStore
+    from backend.history.utils import DELETION_JOB_STALE_AFTER
+
+    store = SQLiteConversationStore()
+    conversation = store.create_conversation("u1", "Deleted")
+    store.mark_conversations_deleted("u1", [conversation["id"]])
+    pending = store.create_deletion_job("u1", [conversation["id"]])
+    # a worker took this job and stopped before finishing it
+    stale = store.create_deletion_job("u2", [])
+    stale_since = (datetime.utcnow() - timedelta(seconds=DELETION_JOB_STALE_AFTER + 1)).isoformat()
+    stale = store._write(dict(stale, status="running", updatedAt=stale_since))
+    running = store.update_deletion_job(store.create_deletion_job("u3", []), status="running")
+
+    jobs = store.get_unfinished_deletion_jobs()
+    assert {job["id"] for job in jobs} == {pending["id"], stale["id"], running["id"]}
+    for job in jobs:
+        store.run_deletion_job(job["userId"], job["id"])
+
+    assert store.get_deletion_job("u1", pending["id"])["status"] == "succeeded"
+    assert store.get_conversation("u1", conversation["id"]) is None
+    assert store.get_deletion_job("u2", stale["id"])["status"] == "succeeded"
+    assert store.get_deletion_job("u3", running["id"])["status"] == "running"
+    assert [job["id"] for job in store.get_unfinished_deletion_jobs()] == [running["id"]]
+    # a job changed by another worker since it was read isn't overwritten
+    job = store.get_deletion_job("u3", running["id"])
+    store.update_deletion_job(dict(job), status="running")
+    with pytest.raises(CosmosAccessConditionFailedError):
+        store.update_deletion_job(job, status="failed")
+
+    # finished jobs expire
+    finished = store.get_deletion_job("u1", pending["id"])
+    assert finished["ttl"] > 0
+    store._write(dict(finished, ttl=1))
+    store._conn.execute("UPDATE documents SET body = json_set(body, '$._ts', 0) WHERE id = ?", (pending["id"],))
+    assert store.get_deletion_job("u1", pending["id"]) is None
+
+
+def test_deletion_job_heartbeat(monkeypatch):
+    from backend.history import store as store_module
+    from backend.history.localstore import SQLiteConversationStore
+
+    monkeypatch.setattr(store_module, "DELETION_JOB_PROGRESS_EVERY", 2)
+    store = SQLiteConversationStore()
+    conversation_ids = [store.create_conversation("u1", str(i))["id"] for i in range(5)]
+    progress = []
+    purge_conversations = store.purge_conversations
+    def purge(user_id, ids, request_charge=None):
+        job = store.get_deletion_job("u1", job_id)
+        progress.append((job["status"], job["deletedConversations"], job["updatedAt"]))
+        return purge_conversations(user_id, ids, request_charge)
+    monkeypatch.setattr(store, "purge_conversations", purge)
+
+    job_id = store.create_deletion_job("u1", conversation_ids)["id"]
+    job = store.run_deletion_job("u1", job_id)
+    # the running job reports its progress, and refreshes updatedAt, between slices
+    assert [(status, deleted) for status, deleted, _ in progress] == [("running", 0), ("running", 2), ("running", 4)]
+    assert progress[0][2] < progress[1][2] < progress[2][2]
+    assert (job["status"], job["deletedConversations"]) == ("succeeded", 5)
+
+    # a worker whose job was taken over stops purging and leaves the job to the new one
+    conversation_ids = [store.create_conversation("u1", str(i))["id"] for i in range(4)]
+    job_id = store.create_deletion_job("u1", conversation_ids)["id"]
+    def taken_over(user_id, ids, request_charge=None):
+        store.update_deletion_job(store.get_deletion_job("u1", job_id), status="running")
+        return purge_conversations(user_id, ids, request_charge)
+    monkeypatch.setattr(store, "purge_conversations", taken_over)
+    job = store.run_deletion_job("u1", job_id)
+    assert (job["status"], job["deletedConversations"]) == ("running", 0)
+    assert len(store.get_conversations("u1")) == 2
+
+
+def test_conversations_page_query():
+    from backend.history.utils import conversations_page_query
+
+    query, parameters = conversations_page_query("u1")
+    assert query.startswith("SELECT c.id, c.title, c.createdAt, c.updatedAt FROM c")
+    assert query.endswith("ORDER BY c.updatedAt DESC")
+    assert parameters == [{"name": "@userId", "value": "u1"}]
+    with pytest.raises(ValueError):
+        conversations_page_query("u1", "DESC; DROP")
+
+
+def test_azure_aio_transport_pool_limit():
+    from backend.http_client import create_azure_aio_transport
+
+    async def run():
+        transport = create_azure_aio_transport(pool_maxsize=8)
+        assert transport.session.connector.limit == 8
+        assert transport.session.connector.limit_per_host == 8
+        await transport.open()
+        await transport.close()
+        assert transport.session is None
+
+    asyncio.run(run())
+
+
+def test_sqlite_conversation_store():
+    from azure.cosmos.exceptions import CosmosAccessConditionFailedError
+    from backend.history.localstore import AsyncSQLiteConversationStore, SQLiteConversationStore
+
+    store = SQLiteConversationStore()
+    first = store.create_conversation("u1", "First")
+    second = store.create_conversation("u1", "Second")
+    store.create_messages(first["id"], "u1", [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}])
+
+    # conversations are partitioned by user and ordered by their last message
+    assert store.get_conversation("u2", first["id"]) is None
+    assert [c["id"] for c in store.get_conversations("u1")] == [first["id"], second["id"]]
+    page, token = store.get_conversations_page("u1", 1)
+    assert page == [{"id": first["id"], "title": "First", "createdAt": first["createdAt"], "updatedAt": page[0]["updatedAt"]}]
+    assert store.get_conversations_page("u1", 1, token) == ([{k: second[k] for k in ("id", "title", "createdAt", "updatedAt")}], None)
+    assert [m["content"] for m in store.get_messages("u1", first["id"])] == ["Hi", "Hello"]
+
+    # writes of a stale copy fail like a Cosmos upsert with an etag condition
+    stale = store.get_conversation("u1", second["id"])
+    store.rename_conversation("u1", second["id"], "Renamed")
+    with pytest.raises(CosmosAccessConditionFailedError):
+        store.upsert_conversation(dict(stale, title="Stale"))
+    assert store.get_conversation("u1", second["id"])["title"] == "Renamed"
+
+    async def delete_all():
+        async_store = AsyncSQLiteConversationStore()
+        async_store.store = store
+        conversation_ids = await async_store.mark_conversations_deleted("u1")
+        job = await async_store.create_deletion_job("u1", conversation_ids)
+        return await async_store.run_deletion_job("u1", job["id"])
+
+    job = asyncio.run(delete_all())
+    assert (job["status"], job["deletedConversations"], job["deletedMessages"]) == ("succeeded", 2, 2)
+    assert store.get_conversations("u1") == []
+
+
+def test_write_behind_queue(tmp_path):
+    from backend.history.localstore import SQLiteConversationStore
+    from backend.history.utils import new_conversation
+    from backend.history.write_behind import HistorySpool, WriteBehindQueue
+
+    store = SQLiteConversationStore()
+    conversation = new_conversation("u1", "New")
+    record = {"id": "r1", "userId": "u1", "conversationId": conversation["id"], "conversation": conversation,
+              "messages": [], "attempts": 0, "notBefore": 0, "queuedAt": 0}
+    # the spool of a process that died before its writes were stored, with a torn last line
+    crashed = HistorySpool(str(tmp_path))
+    crashed.append([dict(record, messages=[{"id": "m1", "type": "message", "userId": "u1", "createdAt": "2024-01-01T00:00:00",
+                                            "conversationId": conversation["id"], "role": "user", "content": "Hi"}])])
+    crashed._file.write('{"op": "wri')
+    crashed._file.close()
+
+    queue = WriteBehindQueue(store, spool_dir=str(tmp_path), retries=2, flush_interval=0.01)
+    # nothing runs until the first write, so a queue created before the server forks its workers
+    # is started in each of them
+    assert queue._worker is None and [str(p) for p in tmp_path.iterdir()] == [crashed.path]
+    assert queue.wait("u1", timeout=0)
+    queue.create_messages(conversation["id"], "u1", [{"role": "tool", "content": "{}"}, {"role": "assistant", "content": "Hello"}])
+    queue.create_messages("missing", "u1", [{"role": "user", "content": "Lost"}])
+    assert queue.wait("u1", timeout=5)
+    assert [m["content"] for m in store.get_messages("u1", conversation["id"])] == ["Hi", "{}", "Hello"]
+    assert store.get_conversation("u1", conversation["id"])["title"] == "New"
+
+    # writes to a conversation that doesn't exist are set aside instead of retried
+    stats = queue.stats()
+    assert (stats["depth"], stats["flushed"], stats["failed"]) == (0, 3, 1)
+    assert json.loads((tmp_path / "failed.jsonl").read_text())["conversationId"] == "missing"
+    queue.close()
+    assert [p.name for p in tmp_path.iterdir()] == ["failed.jsonl"]
+
+
+def test_cached_conversation_store():
+    from backend.cache import MemoryCacheBackend
+    from backend.history.cached_store import CachedConversationStore, HistoryCache
+    from backend.history.localstore import SQLiteConversationStore
+
+    store = SQLiteConversationStore()
+    cached = CachedConversationStore(store, HistoryCache(backend=MemoryCacheBackend("history", maxsize=100, ttl=60)))
+    conversation = cached.create_conversation("u1", "First")
+    list_etag = cached.conversations_etag("u1")
+    conversation_etag = cached.conversation_etag("u1", conversation["id"])
+    assert [c["title"] for c in cached.get_conversations("u1")] == ["First"]
+    assert cached.get_messages("u1", conversation["id"]) == []
+
+    # reads are served from the cache until the app writes
+    store.create_messages(conversation["id"], "u1", [{"role": "user", "content": "Hi"}])
+    assert cached.get_messages("u1", conversation["id"]) == []
+    assert cached.conversation_etag("u1", conversation["id"]) == conversation_etag
+
+    cached.create_messages(conversation["id"], "u1", [{"role": "assistant", "content": "Hello"}])
+    assert [m["content"] for m in cached.get_messages("u1", conversation["id"])] == ["Hi", "Hello"]
+    assert cached.conversation_etag("u1", conversation["id"]) != conversation_etag
+    assert cached.conversations_etag("u1") != list_etag
+
+    cached.mark_conversations_deleted("u1")
+    assert cached.get_conversations("u1") == []
+    assert cached.get_conversation("u1", conversation["id"]) is None
+
+
+def test_history_cache_versions_are_shared_and_kept(tmp_path):
+    from backend.cache import MemoryCacheBackend, SQLiteCacheBackend
+    from backend.history.cached_store import AsyncCachedConversationStore, HistoryCache
+    from backend.history.localstore import AsyncSQLiteConversationStore
+
+    def worker_cache():
+        path = str(tmp_path / "cache.sqlite3")
+        return HistoryCache(backend=SQLiteCacheBackend("history", maxsize=100, ttl=0.01, path=path),
+                            versions=SQLiteCacheBackend("history-versions", maxsize=100, ttl=0.01, path=path))
+
+    # two workers that miss a version at the same time get the one stored first
+    worker_1, worker_2 = worker_cache(), worker_cache()
+    version = worker_1.versions.add("v:u1", "first")
+    assert (version, worker_2.versions.add("v:u1", "second")) == ("first", "first")
+    etag = worker_2.conversation_version("u1", "c1")
+    # versions outlive the cached values, the ETag only changes with a write
+    time.sleep(0.02)
+    assert worker_1.conversation_version("u1", "c1") == etag
+    worker_1.invalidate("u1", ["c1"])
+    assert worker_2.conversation_version("u1", "c1") != etag
+
+    async def run():
+        store = AsyncCachedConversationStore(AsyncSQLiteConversationStore(), HistoryCache(
+            backend=MemoryCacheBackend("history", maxsize=100, ttl=60), versions=worker_cache().versions))
+        conversation = await store.create_conversation("u1", "First")
+        etag = await store.conversation_etag("u1", conversation["id"])
+        assert await store.get_messages("u1", conversation["id"]) == []
+        await store.create_messages(conversation["id"], "u1", [{"role": "user", "content": "Hi"}])
+        assert [m["content"] for m in await store.get_messages("u1", conversation["id"])] == ["Hi"]
+        assert await store.conversation_etag("u1", conversation["id"]) != etag
+
+    asyncio.run(run())
+
+
+def test_async_sqlite_store_does_not_block_the_loop():
+    import threading
+    from backend.history.localstore import AsyncSQLiteConversationStore
+
+    async def run():
+        store = AsyncSQLiteConversationStore()
+        ticks = []
+        async def ticker():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+        # another caller holds the database for a while
+        store.store._lock.acquire()
+        threading.Timer(0.2, store.store._lock.release).start()
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        assert await store.get_conversations("u1") == []
+        task.cancel()
+        return len(ticks)
+
+    assert asyncio.run(run()) > 5
+
+
+def test_history_routes_answer_alike(monkeypatch):
+    import app
+    from backend.history.localstore import AsyncSQLiteConversationStore, SQLiteConversationStore
+
+    store = SQLiteConversationStore()
+    async_store = AsyncSQLiteConversationStore()
+    async_store.store = store
+    monkeypatch.setattr(app, "cosmos_conversation_client", store)
+    monkeypatch.setattr(app, "deletion_jobs_resumed", True)
+    monkeypatch.setattr(app_async, "cosmos_conversation_client", async_store)
+    user_id = app.get_user_id({})
+    conversation = store.create_conversation(user_id, "First")
+    store.create_messages(conversation["id"], user_id, [{"role": "user", "content": "Hi"}])
+
+    def flask_call(method, path, json=None, headers=None):
+        response = app.app.test_client().open(path, method=method, json=json, headers=headers)
+        return response.status_code, response.get_json(silent=True), response.headers.get("ETag")
+
+    def quart_call(method, path, json=None, headers=None):
+        async def run():
+            response = await app_async.app.test_client().open(path, method=method, json=json, headers=headers)
+            return response.status_code, await response.get_json(), response.headers.get("ETag")
+        return asyncio.run(run())
+
+    calls = [
+        ("POST", "/history/read", {}),
+        ("POST", "/history/read", {"conversation_id": "missing"}),
+        ("POST", "/history/rename", {"conversation_id": conversation["id"]}),
+        ("POST", "/history/update", {"conversation_id": conversation["id"], "messages": [{"role": "user", "content": "Hi"}]}),
+        ("GET", "/history/list?page_size=500", None),
+        ("GET", "/history/delete_status/missing", None),
+    ]
+    for method, path, json in calls:
+        assert flask_call(method, path, json) == quart_call(method, path, json)
+
+    status, body, _ = flask_call("POST", "/history/read", {"conversation_id": conversation["id"]})
+    assert (status, [m["content"] for m in body["messages"]]) == (200, ["Hi"])
+    assert flask_call("POST", "/history/rename", {"conversation_id": "missing", "title": "New"})[0] == 404
+    assert flask_call("POST", "/history/update", {"conversation_id": conversation["id"], "messages": []})[:2] == (500, {"error": "No bot messages found"})